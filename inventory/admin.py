@@ -1,7 +1,21 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.forms.models import BaseInlineFormSet
+from django.http import StreamingHttpResponse
+from django.template.response import TemplateResponse
+from django.urls import path
 from django.utils.html import format_html
 from django.db.models import F
-from .models import Category, Supplier, Product, Purchase, PurchaseItem
+from .models import (
+    AlertState, Category, PriceChange, Supplier, Product, Purchase, PurchaseItem, StockBatch, StockMovement,
+    StockSnapshot,
+)
+from .catalogue_file_service import (
+    CATALOGUE_COLUMNS, CatalogueImportError, export_catalogue_csv, import_catalogue,
+)
+from .forms import CatalogueImportForm
+from .purchase_service import PurchaseError, clean_lines, receive_draft, receive_purchase
+from .stock_service import save_product
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -15,7 +29,7 @@ class CategoryAdmin(admin.ModelAdmin):
 
 @admin.register(Supplier)
 class SupplierAdmin(admin.ModelAdmin):
-    list_display = ['name', 'contact_person', 'phone', 'email', 'product_count']
+    list_display = ['name', 'contact_person', 'phone', 'email', 'lead_time_days', 'product_count']
     search_fields = ['name', 'contact_person', 'phone', 'email']
     list_filter = ['created_at']
     
@@ -23,6 +37,22 @@ class SupplierAdmin(admin.ModelAdmin):
         return obj.products.count()
     product_count.short_description = 'Products'
 
+class StockBatchInline(admin.TabularInline):
+    model = StockBatch
+    fields = ['batch_number', 'expiry_date', 'quantity', 'received_at', 'purchase']
+    readonly_fields = ['quantity', 'received_at', 'purchase']
+    extra = 0
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).filter(quantity__gt=0)
+    
+    # Batches come from receiving and move with the stock ledger
+    def has_add_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
     list_display = [
@@ -36,6 +66,8 @@ class ProductAdmin(admin.ModelAdmin):
     search_fields = ['name', 'generic_name', 'barcode']
     list_editable = ['selling_price', 'quantity_in_stock', 'is_active']
     readonly_fields = ['created_at', 'updated_at']
+    inlines = [StockBatchInline]
+    actions = ['export_catalogue']
     
     fieldsets = (
         ('Basic Information', {
@@ -55,6 +87,10 @@ class ProductAdmin(admin.ModelAdmin):
         })
     )
     
+    def get_queryset(self, request):
+        # The status columns read each row's prefetched alerts
+        return super().get_queryset(request).prefetch_related('alerts')
+    
     def stock_status(self, obj):
         if obj.is_low_stock:
             return format_html('<span style="color: red;">Low Stock</span>')
@@ -68,21 +104,211 @@ class ProductAdmin(admin.ModelAdmin):
             return format_html('<span style="color: orange;">Expires: {}</span>', obj.expiry_date)
         return 'No expiry date'
     expiry_status.short_description = 'Expiry Status'
+    
+    def save_model(self, request, obj, form, change):
+        # Stock edits (including list_editable) go through the ledger as adjustments
+        save_product(obj, reference=f'Admin edit by {request.user.username}')
+    
+    def get_urls(self):
+        return [
+            path('import/', self.admin_site.admin_view(self.import_catalogue_view), name='inventory_product_import'),
+            *super().get_urls(),
+        ]
+    
+    @admin.action(description='Export selected products as a catalogue file (CSV)')
+    def export_catalogue(self, request, queryset):
+        response = StreamingHttpResponse(export_catalogue_csv(queryset), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="catalogue.csv"'
+        return response
+    
+    def import_catalogue_view(self, request):
+        if not (self.has_add_permission(request) and self.has_change_permission(request)):
+            raise PermissionDenied
+        form = CatalogueImportForm(request.POST or None, request.FILES or None)
+        result = None
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['file']
+            supplier = form.cleaned_data['supplier']
+            try:
+                result = import_catalogue(
+                    upload, filename=upload.name, default_supplier=supplier.name if supplier else '',
+                    create_categories=form.cleaned_data['create_categories'],
+                    reference=f'Catalogue import by {request.user.username}',
+                )
+            except CatalogueImportError as exc:
+                form.add_error('file', str(exc))
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Import catalogue',
+            'form': form,
+            'result': result,
+            'columns': CATALOGUE_COLUMNS,
+        }
+        return TemplateResponse(request, 'admin/inventory/product/import_catalogue.html', context)
+
+class PurchaseItemFormSet(BaseInlineFormSet):
+    def clean(self):
+        super().clean()
+        lines = [
+            form.cleaned_data for form in self.forms
+            if form.cleaned_data and not form.cleaned_data.get('DELETE')
+        ]
+        if not self.instance.pk and not lines:
+            raise ValidationError('Add at least one line to receive.')
+        if any(line.get('quantity') == 0 for line in lines):
+            raise ValidationError('Quantities must be at least 1.')
+        if not self.instance.pk:
+            # The checks receive_purchase makes, so a bad line is a form error rather than a 500
+            try:
+                clean_lines(lines)
+            except PurchaseError as error:
+                raise ValidationError(error.errors)
 
 class PurchaseItemInline(admin.TabularInline):
     model = PurchaseItem
+    formset = PurchaseItemFormSet
     extra = 1
     readonly_fields = ['total_cost']
+    autocomplete_fields = ['product']
+    
+    # Received lines are in the stock ledger; correct stock with an adjustment instead
+    def has_add_permission(self, request, obj=None):
+        return obj is None and super().has_add_permission(request, obj)
+    
+    def has_change_permission(self, request, obj=None):
+        return obj is None and super().has_change_permission(request, obj)
+    
+    def has_delete_permission(self, request, obj=None):
+        return obj is None and super().has_delete_permission(request, obj)
 
 @admin.register(Purchase)
 class PurchaseAdmin(admin.ModelAdmin):
-    list_display = ['invoice_number', 'supplier', 'total_amount', 'purchase_date', 'created_by']
-    list_filter = ['supplier', 'purchase_date', 'created_by']
+    list_display = ['invoice_number', 'supplier', 'status', 'total_amount', 'purchase_date', 'created_by']
+    list_filter = ['status', 'supplier', 'purchase_date', 'created_by']
     search_fields = ['invoice_number', 'supplier__name']
-    readonly_fields = ['purchase_date', 'total_amount']
+    # created_by is the user saving the purchase
+    readonly_fields = ['status', 'purchase_date', 'total_amount', 'created_by']
+    list_select_related = ['supplier', 'created_by']
     inlines = [PurchaseItemInline]
+    actions = ['receive_drafts']
+    
+    def get_readonly_fields(self, request, obj=None):
+        if obj is None:
+            return self.readonly_fields
+        if obj.status == 'draft':
+            # The supplier's invoice number can be filled in before the draft is received
+            return [*self.readonly_fields, 'supplier']
+        return [*self.readonly_fields, 'supplier', 'invoice_number']
+    
+    @admin.action(description='Receive the selected draft orders', permissions=['change'])
+    def receive_drafts(self, request, queryset):
+        received = 0
+        for purchase in queryset.filter(status='draft').order_by('pk'):
+            try:
+                receive_draft(purchase)
+            except PurchaseError as error:
+                self.message_user(request, f'Purchase #{purchase.invoice_number}: {error}', messages.ERROR)
+            else:
+                received += 1
+        self.message_user(request, f'{received} draft orders received')
     
     def save_model(self, request, obj, form, change):
-        if not change:  # If creating new
+        if change:
+            super().save_model(request, obj, form, change)
+        else:
+            # Saved together with its lines in save_related
             obj.created_by = request.user
-        super().save_model(request, obj, form, change)
\ No newline at end of file
+    
+    def save_related(self, request, form, formsets, change):
+        if change:
+            return super().save_related(request, form, formsets, change)
+        lines = [
+            item_form.cleaned_data
+            for formset in formsets for item_form in formset.forms
+            if item_form.cleaned_data and not item_form.cleaned_data.get('DELETE')
+        ]
+        purchase = receive_purchase(form.instance, lines)
+        # The admin's change message lists the formsets' saved objects
+        for formset in formsets:
+            formset.new_objects = list(purchase.items.select_related('product'))
+            formset.changed_objects, formset.deleted_objects = [], []
+
+@admin.register(StockBatch)
+class StockBatchAdmin(admin.ModelAdmin):
+    list_display = ['product', 'batch_number', 'expiry_date', 'quantity', 'received_at', 'purchase']
+    list_filter = ['expiry_date', 'received_at']
+    search_fields = ['product__name', 'batch_number']
+    list_select_related = ['product', 'purchase']
+    # Batch numbers and expiry dates can be corrected; quantities only move with the stock ledger
+    readonly_fields = ['product', 'quantity', 'received_at', 'purchase']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(AlertState)
+class AlertStateAdmin(admin.ModelAdmin):
+    list_display = ['product', 'kind', 'expiry_date', 'quantity', 'raised_at']
+    list_filter = ['kind']
+    search_fields = ['product__name']
+    list_select_related = ['product']
+    
+    # Alerts are raised and cleared by stock changes and the nightly sweep
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(PriceChange)
+class PriceChangeAdmin(admin.ModelAdmin):
+    list_display = ['changed_at', 'product', 'old_price', 'new_price', 'rule', 'changed_by']
+    list_filter = ['changed_at']
+    search_fields = ['product__name', 'product__barcode', 'rule']
+    list_select_related = ['product', 'changed_by']
+    
+    # Price history is written by bulk price updates
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ['timestamp', 'product', 'movement_type', 'quantity', 'reference']
+    list_filter = ['movement_type', 'timestamp']
+    search_fields = ['product__name', 'reference']
+    list_select_related = ['product']
+    
+    # The ledger is append-only
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(StockSnapshot)
+class StockSnapshotAdmin(admin.ModelAdmin):
+    list_display = ['taken_at', 'product', 'quantity']
+    list_filter = ['taken_at']
+    search_fields = ['product__name']
+    list_select_related = ['product']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
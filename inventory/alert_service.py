@@ -0,0 +1,125 @@
+"""
+Materialised stock alerts.
+
+AlertState keeps one row for each alert that currently applies to a product:
+low stock, expired stock still on the shelf, or stock that expires within
+EXPIRY_WARNING_DAYS. A row is added when its condition starts and deleted
+when it ends, so stock reports, dashboards and list badges all read one small
+indexed table instead of each re-deriving the conditions.
+
+refresh_alerts() recomputes the alerts of the products a stock change
+touched, inside that change's transaction, with the same handful of queries
+however many products it covers. Expiry also moves with the calendar, so
+`manage.py sweep_stock_alerts` refreshes every product once a night. A refresh
+that raises or clears alerts sends stock_alerts_changed.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, F, Min, Q, Sum
+from django.dispatch import Signal
+from django.utils import timezone
+
+from .models import AlertState, Product, StockBatch
+
+# Sent inside the transaction that raised or cleared alerts.
+# Arguments: raised, cleared - lists of (product_id, kind)
+stock_alerts_changed = Signal()
+
+
+def expiry_warning_days():
+    return getattr(settings, 'EXPIRY_WARNING_DAYS', 30)
+
+
+def _expiry_alerts(batches, today):
+    # Expired and expiring soon come out of one pass over the batch expiry index
+    expired = Q(expiry_date__lt=today)
+    soon = Q(expiry_date__gte=today)
+    rows = batches.filter(expiry_date__lte=today + timedelta(days=expiry_warning_days())).order_by().values(
+        'product_id'
+    ).annotate(
+        expired_from=Min('expiry_date', filter=expired), expired_units=Sum('quantity', filter=expired),
+        soon_from=Min('expiry_date', filter=soon), soon_units=Sum('quantity', filter=soon),
+    )
+    alerts = {}
+    for row in rows:
+        if row['expired_units']:
+            alerts[(row['product_id'], AlertState.EXPIRED)] = {
+                'expiry_date': row['expired_from'], 'quantity': row['expired_units'],
+            }
+        if row['soon_units']:
+            alerts[(row['product_id'], AlertState.EXPIRING_SOON)] = {
+                'expiry_date': row['soon_from'], 'quantity': row['soon_units'],
+            }
+    return alerts
+
+
+def current_alerts(product_ids=None, today=None):
+    """{(product_id, kind): {'expiry_date', 'quantity'}} for every alert that should exist"""
+    today = today or timezone.localdate()
+    products = Product.objects.filter(is_active=True)
+    batches = StockBatch.objects.filter(quantity__gt=0, product__is_active=True)
+    if product_ids is not None:
+        products = products.filter(pk__in=product_ids)
+        batches = batches.filter(product_id__in=product_ids)
+
+    alerts = {
+        (pk, AlertState.LOW_STOCK): {'expiry_date': None, 'quantity': None}
+        for pk in products.filter(quantity_in_stock__lte=F('minimum_stock_level')).values_list('pk', flat=True)
+    }
+    alerts.update(_expiry_alerts(batches, today))
+    return alerts
+
+
+def refresh_alerts(product_ids=None, today=None):
+    """
+    Bring the AlertState rows of ``product_ids`` (every product if None) in
+    line with their stock. Returns (raised, cleared) as lists of
+    (product_id, kind).
+    """
+    if product_ids is not None:
+        product_ids = list(product_ids)
+        if not product_ids:
+            return [], []
+    wanted = current_alerts(product_ids, today)
+    existing = AlertState.objects.all()
+    if product_ids is not None:
+        existing = existing.filter(product_id__in=product_ids)
+    existing = {(alert.product_id, alert.kind): alert for alert in existing}
+
+    raised = [key for key in wanted if key not in existing]
+    cleared = [key for key in existing if key not in wanted]
+    changed = []
+    for key, values in wanted.items():
+        alert = existing.get(key)
+        if alert is not None and (alert.expiry_date, alert.quantity) != (values['expiry_date'], values['quantity']):
+            alert.expiry_date, alert.quantity = values['expiry_date'], values['quantity']
+            changed.append(alert)
+
+    if raised:
+        # The nightly sweep doesn't lock products, so a till may raise the same alert first
+        AlertState.objects.bulk_create(
+            [AlertState(product_id=pk, kind=kind, **wanted[(pk, kind)]) for pk, kind in raised],
+            ignore_conflicts=True,
+        )
+    if cleared:
+        AlertState.objects.filter(pk__in=[existing[key].pk for key in cleared]).delete()
+    if changed:
+        AlertState.objects.bulk_update(changed, ['expiry_date', 'quantity'])
+    if raised or cleared:
+        stock_alerts_changed.send(sender=AlertState, raised=raised, cleared=cleared)
+    return raised, cleared
+
+
+def low_stock_products():
+    """Active products at or below their minimum stock level"""
+    return Product.objects.filter(alerts__kind=AlertState.LOW_STOCK)
+
+
+def alert_counts():
+    """{kind: number of products} for every alert kind, in one query"""
+    counts = dict.fromkeys((kind for kind, _ in AlertState.KIND_CHOICES), 0)
+    counts.update(
+        AlertState.objects.order_by().values_list('kind').annotate(count=Count('id'))
+    )
+    return counts
@@ -0,0 +1,120 @@
+"""
+Process-local LRU cache for barcode scans at the POS.
+
+Product post_save/post_delete receivers invalidate entries in this process.
+When BARCODE_CACHE_SHARED_ALIAS names a shared cache backend, invalidations
+also bump a version key there; other workers notice within
+VERSION_CHECK_INTERVAL seconds and drop their local entries.
+
+Cached stock levels are a hint for the till, like the stock shown on the POS
+page; checkout re-checks stock under row locks.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import Product
+
+VERSION_KEY = 'barcode-cache-version'
+VERSION_CHECK_INTERVAL = 1.0
+
+
+def product_payload(product):
+    """JSON-ready product data the POS uses to add an item to the cart"""
+    return {
+        'id': product.id,
+        'name': product.name,
+        'generic_name': product.generic_name or '',
+        'price': str(product.selling_price),
+        'cost_price': str(product.cost_price),
+        'stock': product.quantity_in_stock,
+        'barcode': product.barcode or '',
+        'category': product.category.name,
+        'is_low_stock': product.is_low_stock,
+        'profit_margin': str(product.profit_margin),
+    }
+
+
+class BarcodeCache:
+    def __init__(self, maxsize=None, shared_alias=None):
+        self.maxsize = maxsize or getattr(settings, 'BARCODE_CACHE_SIZE', 5000)
+        self.shared_alias = shared_alias or getattr(settings, 'BARCODE_CACHE_SHARED_ALIAS', None)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # barcode -> payload, least recently used first
+        self._barcodes = {}            # product id -> cached barcode
+        self._version = None
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def _shared(self):
+        return caches[self.shared_alias] if self.shared_alias else None
+
+    def _sync_version(self):
+        shared = self._shared()
+        if shared is None or time.monotonic() - self._checked_at < VERSION_CHECK_INTERVAL:
+            return
+        version = shared.get_or_set(VERSION_KEY, 1)
+        if version != self._version:
+            self._entries.clear()
+            self._barcodes.clear()
+            self._version = version
+        self._checked_at = time.monotonic()
+
+    def get(self, barcode):
+        """Payload for an active product with this barcode, or None"""
+        with self._lock:
+            self._sync_version()
+            payload = self._entries.get(barcode)
+            if payload is not None:
+                self._entries.move_to_end(barcode)
+                self.hits += 1
+                return payload
+            self.misses += 1
+
+        product = Product.objects.select_related('category').filter(barcode=barcode, is_active=True).first()
+        if product is None:
+            return None
+        payload = product_payload(product)
+        with self._lock:
+            self._entries[barcode] = payload
+            self._barcodes[product.pk] = barcode
+            if len(self._entries) > self.maxsize:
+                evicted = self._entries.popitem(last=False)[1]
+                self._barcodes.pop(evicted['id'], None)
+        return payload
+
+    def invalidate(self, product):
+        """Forget a product under its old and current barcode, here and in other workers"""
+        with self._lock:
+            for barcode in (self._barcodes.pop(product.pk, None), product.barcode):
+                if barcode:
+                    self._entries.pop(barcode, None)
+        shared = self._shared()
+        if shared is not None:
+            shared.add(VERSION_KEY, 1)
+            shared.incr(VERSION_KEY)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._barcodes.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'shared': bool(self.shared_alias),
+            }
+
+
+barcode_cache = BarcodeCache()
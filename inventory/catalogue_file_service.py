@@ -0,0 +1,352 @@
+"""
+Catalogue files: bulk product import and export.
+
+import_catalogue() reads a CSV or XLSX price list row by row and works through
+it IMPORT_CHUNK_SIZE rows at a time, so memory stays flat however long the
+file is. The rows of a chunk are checked, their category and supplier are
+looked up by name in maps loaded once per import, and then they are upserted
+with one bulk_create(update_conflicts=True) keyed on barcode. Categories the
+file introduces are created in the same transaction as the chunk's rows. Stock counts in
+the file are applied as stock-take adjustments through the stock ledger, so
+imported stock goes on the shelf as batches like any other. A bad row is
+reported with its line number and skipped, and the rest of the file is still
+imported.
+
+export_catalogue_csv() streams the catalogue in the same layout, so a file
+can be exported, edited and imported again.
+"""
+import csv
+import io
+from collections import namedtuple
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from itertools import chain
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import dashboard_service
+from .alert_service import refresh_alerts
+from .barcode_service import barcode_cache
+from .models import Category, Product, Supplier
+from .search_service import product_index
+from .stock_service import InsufficientStock, apply_stock_changes
+
+try:
+    import openpyxl
+except ImportError:  # optional; only needed for .xlsx files
+    openpyxl = None
+
+IMPORT_CHUNK_SIZE = 1000
+# Errors kept for the report; the count covers every bad row
+MAX_REPORTED_ERRORS = 500
+CATALOGUE_COLUMNS = [
+    'barcode', 'name', 'generic_name', 'category', 'supplier', 'cost_price', 'selling_price',
+    'quantity_in_stock', 'minimum_stock_level', 'batch_number', 'expiry_date', 'is_active',
+]
+REQUIRED_COLUMNS = ['barcode', 'name', 'category', 'supplier', 'cost_price', 'selling_price']
+# Upserts leave quantity_in_stock alone; stock only moves through the ledger
+UPSERT_FIELDS = [
+    'name', 'generic_name', 'category', 'supplier', 'cost_price', 'selling_price',
+    'minimum_stock_level', 'batch_number', 'expiry_date', 'is_active', 'updated_at',
+]
+# Product.cost_price / selling_price are DecimalField(max_digits=10, decimal_places=2)
+MAX_PRICE = Decimal('99999999.99')
+# Stock counts are PositiveIntegerFields, which every backend stores in 32 bits
+MAX_WHOLE_NUMBER = 2147483647
+CENTS = Decimal('0.01')
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 'active'}
+FALSE_VALUES = {'0', 'false', 'no', 'n', 'inactive'}
+
+ImportResult = namedtuple('ImportResult', 'created updated error_count errors')
+
+
+class CatalogueImportError(ValueError):
+    """Raised when a file can't be imported at all, e.g. it lacks a required column"""
+
+
+def _column(name):
+    return str(name or '').strip().lower().replace(' ', '_')
+
+
+def _csv_rows(source):
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    if not isinstance(source, io.TextIOBase):
+        source = io.TextIOWrapper(source, encoding='utf-8-sig', newline='')
+    reader = csv.reader(source)
+    yield [_column(name) for name in next(reader, [])]
+    yield from reader
+
+
+def _xlsx_rows(source):
+    if openpyxl is None:
+        raise CatalogueImportError('Reading .xlsx files needs the openpyxl package; upload a CSV instead')
+    workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        yield [_column(name) for name in next(rows, ())]
+        for row in rows:
+            yield ['' if value is None else value for value in row]
+    finally:
+        workbook.close()
+
+
+def read_rows(source, filename=''):
+    """Yield (line number, {column: value}) from a CSV or XLSX file object"""
+    rows = _xlsx_rows(source) if filename.lower().endswith('.xlsx') else _csv_rows(source)
+    header = next(rows)
+    for number, values in enumerate(rows, start=2):
+        if any(str(value).strip() for value in values):
+            yield number, dict(zip(header, values))
+
+
+def _text(value):
+    return str(value).strip() if value is not None else ''
+
+
+def _price(row, field):
+    try:
+        price = Decimal(_text(row.get(field))).quantize(CENTS)
+    except (InvalidOperation, ValueError):
+        raise ValueError(f'{field} must be a number')
+    if not 0 <= price <= MAX_PRICE:
+        raise ValueError(f'{field} is out of range')
+    return price
+
+
+def _whole_number(row, field):
+    value = _text(row.get(field))
+    if not value:
+        return None
+    try:
+        number = Decimal(value)
+    except (InvalidOperation, ValueError):
+        raise ValueError(f'{field} must be a whole number')
+    # inf and nan are Decimals too, and int() of them raises
+    if not number.is_finite() or number < 0 or number != number.to_integral_value():
+        raise ValueError(f'{field} must be a whole number')
+    if number > MAX_WHOLE_NUMBER:
+        raise ValueError(f'{field} is out of range')
+    return int(number)
+
+
+def _date(row, field):
+    value = row.get(field)
+    if isinstance(value, date):  # XLSX cells arrive as dates or datetimes
+        return value.date() if hasattr(value, 'date') else value
+    value = _text(value)
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value[:10])
+    except ValueError:
+        raise ValueError(f'{field} must be YYYY-MM-DD')
+
+
+def _flag(row, field):
+    value = _text(row.get(field)).lower()
+    if not value or value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError(f'{field} must be yes or no')
+
+
+class _NameMap:
+    """Case-insensitive name -> id map for categories or suppliers, loaded once per import"""
+
+    def __init__(self, model, create=False):
+        self.model = model
+        self.create = create
+        self.ids = {name.strip().lower(): pk for pk, name in model.objects.values_list('pk', 'name')}
+
+    def get(self, name):
+        return self.ids.get(name.strip().lower())
+
+    def create_missing(self, names):
+        """
+        {lowercased name: id} for ``names``, creating the ones that don't exist.
+        Called inside a chunk's transaction, so a chunk that is rolled back
+        leaves no categories behind.
+        """
+        ids = {}
+        for name in names:
+            key = name.strip().lower()
+            if key not in ids:
+                # get_or_create, as a concurrent import may have just added the same name
+                ids[key] = self.ids.get(key) or self.model.objects.get_or_create(
+                    name__iexact=name.strip(), defaults={'name': name.strip()},
+                )[0].pk
+        # Only remembered once committed; after a rollback they are looked up again
+        transaction.on_commit(lambda: self.ids.update(ids))
+        return ids
+
+
+def _parse(row, categories, suppliers, default_supplier):
+    barcode = _text(row.get('barcode'))
+    name = _text(row.get('name'))
+    if not barcode:
+        raise ValueError('barcode is required')
+    if len(barcode) > 50:
+        raise ValueError('barcode is longer than 50 characters')
+    if not name:
+        raise ValueError('name is required')
+    category_name = _text(row.get('category'))
+    if not category_name:
+        raise ValueError('category is required')
+    supplier_name = _text(row.get('supplier')) or default_supplier
+    supplier_id = suppliers.get(supplier_name) if supplier_name else None
+    if supplier_id is None:
+        raise ValueError(f'no supplier named {supplier_name!r}' if supplier_name else 'supplier is required')
+    minimum = _whole_number(row, 'minimum_stock_level')
+    product = Product(
+        barcode=barcode,
+        name=name[:200],
+        generic_name=_text(row.get('generic_name'))[:200] or None,
+        supplier_id=supplier_id,
+        cost_price=_price(row, 'cost_price'),
+        selling_price=_price(row, 'selling_price'),
+        minimum_stock_level=10 if minimum is None else minimum,
+        batch_number=_text(row.get('batch_number'))[:50] or None,
+        expiry_date=_date(row, 'expiry_date'),
+        is_active=_flag(row, 'is_active'),
+        quantity_in_stock=0,
+    )
+    stock = _whole_number(row, 'quantity_in_stock')
+    category_name = category_name[:100]
+    # Unknown categories are left unset and created with the chunk
+    product.category_id = categories.get(category_name)
+    if product.category_id is None and not categories.create:
+        raise ValueError(f'no category named {category_name!r}')
+    return product, stock, category_name
+
+
+def _import_chunk(chunk, reference, categories):
+    """Upsert [(line, product, stock or None, category name)]; returns (created, updated)"""
+    barcodes = [product.barcode for _, product, _, _ in chunk]
+    with transaction.atomic():
+        new_categories = [name for _, product, _, name in chunk if product.category_id is None]
+        if new_categories:
+            ids = categories.create_missing(new_categories)
+            for _, product, _, name in chunk:
+                if product.category_id is None:
+                    product.category_id = ids[name.strip().lower()]
+        # Lock the existing rows so stock counts are applied against current levels
+        existing = dict(
+            Product.objects.select_for_update().filter(barcode__in=barcodes).order_by('pk')
+            .values_list('barcode', 'quantity_in_stock')
+        )
+        now = timezone.now()
+        for _, product, _, _ in chunk:
+            product.created_at = product.updated_at = now
+        Product.objects.bulk_create(
+            [product for _, product, _, _ in chunk],
+            update_conflicts=True, unique_fields=['barcode'], update_fields=UPSERT_FIELDS,
+        )
+        pks = dict(Product.objects.filter(barcode__in=barcodes).values_list('barcode', 'pk'))
+        deltas = {}
+        for _, product, stock, _ in chunk:
+            product.pk = pks[product.barcode]
+            if stock is not None:
+                deltas[product.pk] = stock - existing.get(product.barcode, 0)
+        # New stock goes on the shelf as a batch with the row's batch number and expiry
+        apply_stock_changes(deltas, 'adjustment', reference)
+        refresh_alerts(pks.values())
+
+        products = [product for _, product, _, _ in chunk]
+
+        def refresh_caches():
+            for product in products:
+                product_index.update(product)
+                barcode_cache.invalidate(product)
+        transaction.on_commit(refresh_caches)
+    created = sum(1 for barcode in pks if barcode not in existing)
+    return created, len(pks) - created
+
+
+def import_catalogue(source, filename='', default_supplier='', create_categories=True,
+                     chunk_size=IMPORT_CHUNK_SIZE, reference='Catalogue import'):
+    """
+    Create or update products from a CSV or XLSX file object, matched on
+    barcode. Rows without a supplier use ``default_supplier``. Categories
+    that don't exist yet are created unless create_categories is False;
+    suppliers must already exist. Returns an ImportResult with the first
+    MAX_REPORTED_ERRORS problems as (line number, message).
+    """
+    rows = read_rows(source, filename)
+    categories = _NameMap(Category, create=create_categories)
+    suppliers = _NameMap(Supplier)
+    created = updated = error_count = 0
+    errors = []
+
+    def error(number, message):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append((number, message))
+
+    def flush(chunk):
+        nonlocal created, updated
+        try:
+            counts = _import_chunk(chunk, reference, categories)
+        except InsufficientStock as exc:
+            for number, *_ in chunk:
+                error(number, f'not imported with lines {chunk[0][0]}-{chunk[-1][0]}: {exc}')
+            return
+        created += counts[0]
+        updated += counts[1]
+
+    first = next(rows, None)
+    if first is None:
+        return ImportResult(0, 0, 0, [])
+    columns = set(first[1])
+    missing = [
+        column for column in REQUIRED_COLUMNS
+        if column not in columns and not (column == 'supplier' and default_supplier)
+    ]
+    if missing:
+        raise CatalogueImportError(f'The file has no {", ".join(missing)} column')
+
+    chunk = []
+    seen = {}
+    for number, row in chain([first], rows):
+        try:
+            product, stock, category = _parse(row, categories, suppliers, default_supplier)
+        except ValueError as exc:
+            error(number, str(exc))
+            continue
+        # One statement can't upsert the same barcode twice
+        if product.barcode in seen:
+            error(number, f'barcode {product.barcode} is already on line {seen[product.barcode]}')
+            continue
+        seen[product.barcode] = number
+        chunk.append((number, product, stock, category))
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk, seen = [], {}
+    if chunk:
+        flush(chunk)
+    if created or updated:
+        dashboard_service.stock_changed()
+    return ImportResult(created, updated, error_count, errors)
+
+
+class _Echo:
+    """File-like object whose write() hands back the line csv.writer formatted"""
+
+    def write(self, value):
+        return value
+
+
+def export_catalogue_csv(products=None):
+    """The catalogue as CSV lines in the import layout, read in chunks"""
+    products = Product.objects.all() if products is None else products
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CATALOGUE_COLUMNS)
+    rows = products.order_by('pk').values_list(
+        'barcode', 'name', 'generic_name', 'category__name', 'supplier__name', 'cost_price', 'selling_price',
+        'quantity_in_stock', 'minimum_stock_level', 'batch_number', 'expiry_date', 'is_active',
+    ).iterator(chunk_size=2000)
+    for *values, is_active in rows:
+        yield writer.writerow(['' if value is None else value for value in values] + ['yes' if is_active else 'no'])
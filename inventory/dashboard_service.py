@@ -0,0 +1,117 @@
+"""
+Cached headline figures for the staff dashboard.
+
+Product counts come from one aggregate pass over active products, and today's
+revenue from the daily sales rollup. Each part is cached per local day under
+its own key, so a sale only touches what it changes: it adjusts the cached
+revenue in place and drops the stock counts, while a product edit drops only
+the stock counts.
+
+With DASHBOARD_METRICS_BACKGROUND_REFRESH on, an entry older than
+DASHBOARD_METRICS_TTL is still served while a background thread recomputes
+it, so only the very first request of the day waits for the aggregates.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from reports.rollup_service import sales_totals
+from .models import AlertState, Product
+
+STOCK_KEY = 'dashboard-metrics:stock:{day}'
+SALES_KEY = 'dashboard-metrics:sales:{day}'
+# Stale entries are kept this many TTLs so background refreshes have something to serve
+STALE_TTLS = 10
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _ttl():
+    return getattr(settings, 'DASHBOARD_METRICS_TTL', 60)
+
+
+def _stock_counts(day):
+    # Low stock and expiry come from the alerts alert_service keeps for each product;
+    # a product has at most one alert of each kind, so the join doesn't inflate the counts
+    return Product.objects.filter(is_active=True).aggregate(
+        total_products=Count('id', distinct=True),
+        low_stock_products=Count('alerts', filter=Q(alerts__kind=AlertState.LOW_STOCK)),
+        expired_products=Count('alerts', filter=Q(alerts__kind=AlertState.EXPIRED)),
+    )
+
+
+def _sales_figures(day):
+    return {'today_revenue': sales_totals(day, day)['final_amount']}
+
+
+def _store(key, values):
+    cache.set(key, {'computed_at': time.monotonic(), 'values': values}, _ttl() * STALE_TTLS)
+    return values
+
+
+def _refresh(key, compute):
+    try:
+        _store(key, compute())
+    finally:
+        connection.close()
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+
+def _refresh_in_background(key, compute):
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    threading.Thread(target=_refresh, args=(key, compute), daemon=True).start()
+
+
+def _cached(key, compute):
+    entry = cache.get(key)
+    if entry is None:
+        return _store(key, compute())
+    if time.monotonic() - entry['computed_at'] < _ttl():
+        return entry['values']
+    if getattr(settings, 'DASHBOARD_METRICS_BACKGROUND_REFRESH', False):
+        _refresh_in_background(key, compute)
+        return entry['values']
+    return _store(key, compute())
+
+
+def dashboard_metrics(day=None):
+    """total_products, low_stock_products, expired_products and today_revenue"""
+    day = day or timezone.localdate()
+    return {
+        **_cached(STOCK_KEY.format(day=day), lambda: _stock_counts(day)),
+        **_cached(SALES_KEY.format(day=day), lambda: _sales_figures(day)),
+    }
+
+
+def stock_changed():
+    cache.delete(STOCK_KEY.format(day=timezone.localdate()))
+
+
+def sale_changed(sale, sign=1):
+    """
+    Fold a paid sale (sign=-1 for a refund) into the cached revenue of its day.
+
+    Concurrent workers can race on the read-modify-write; the TTL bounds how
+    long a lost adjustment can show.
+    """
+    key = SALES_KEY.format(day=timezone.localdate(sale.sale_date))
+    entry = cache.get(key)
+    if entry is not None:
+        entry['values']['today_revenue'] += sign * sale.final_amount
+        cache.set(key, entry, _ttl() * STALE_TTLS)
+    stock_changed()
+
+
+def sale_edited(sale):
+    cache.delete(SALES_KEY.format(day=timezone.localdate(sale.sale_date)))
+    stock_changed()
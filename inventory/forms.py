@@ -1,7 +1,10 @@
+from decimal import Decimal
+
 from django import forms
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Submit, Row, Column, Field, HTML, Div
 from .models import Product, Category, Supplier, Purchase, PurchaseItem
+from .pricing_service import DIRECTION_CHOICES, METHOD_CHOICES, price_rule, price_scope
 
 class ProductForm(forms.ModelForm):
     class Meta:
@@ -74,7 +77,7 @@ class CategoryForm(forms.ModelForm):
 class SupplierForm(forms.ModelForm):
     class Meta:
         model = Supplier
-        fields = ['name', 'contact_person', 'phone', 'email', 'address']
+        fields = ['name', 'contact_person', 'phone', 'email', 'address', 'lead_time_days']
         widgets = {
             'address': forms.Textarea(attrs={'rows': 3}),
         }
@@ -94,9 +97,63 @@ class SupplierForm(forms.ModelForm):
                 css_class='form-row'
             ),
             'address',
+            'lead_time_days',
             Submit('submit', 'Save Supplier', css_class='btn btn-primary')
         )
 
+class CatalogueImportForm(forms.Form):
+    file = forms.FileField(help_text='CSV, or XLSX when openpyxl is installed')
+    supplier = forms.ModelChoiceField(
+        Supplier.objects.all(), required=False, help_text='For rows that don\'t name a supplier'
+    )
+    create_categories = forms.BooleanField(
+        initial=True, required=False, help_text='Create categories the file names that don\'t exist yet'
+    )
+
+class BulkPriceForm(forms.Form):
+    ROUNDING_STEPS = [
+        ('', 'No rounding'), ('0.05', '0.05'), ('0.10', '0.10'), ('0.50', '0.50'), ('1', '1.00'),
+        ('5', '5.00'), ('10', '10.00'),
+    ]
+
+    category = forms.ModelChoiceField(Category.objects.all(), required=False, empty_label='All categories')
+    supplier = forms.ModelChoiceField(Supplier.objects.all(), required=False, empty_label='All suppliers')
+    method = forms.ChoiceField(choices=METHOD_CHOICES, label='Rule')
+    percent = forms.DecimalField(
+        max_digits=7, decimal_places=2, min_value=Decimal('-99.99'), max_value=Decimal('10000'),
+        label='Percentage', help_text='Markup on the selling price, or margin over cost',
+    )
+    step = forms.ChoiceField(choices=ROUNDING_STEPS, required=False, label='Round to')
+    direction = forms.ChoiceField(choices=DIRECTION_CHOICES, label='Rounding')
+    allow_below_cost = forms.BooleanField(required=False, label='Allow prices below cost')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.helper = FormHelper()
+        self.helper.form_tag = False
+        self.helper.layout = Layout(
+            Row(
+                Column('category', css_class='form-group col-md-6 mb-0'),
+                Column('supplier', css_class='form-group col-md-6 mb-0'),
+                css_class='form-row'
+            ),
+            Row(
+                Column('method', css_class='form-group col-md-4 mb-0'),
+                Column('percent', css_class='form-group col-md-4 mb-0'),
+                Column('step', css_class='form-group col-md-2 mb-0'),
+                Column('direction', css_class='form-group col-md-2 mb-0'),
+                css_class='form-row'
+            ),
+            'allow_below_cost',
+        )
+
+    def rule(self):
+        data = self.cleaned_data
+        return price_rule(data['method'], data['percent'], data['step'], data['direction'], data['allow_below_cost'])
+
+    def products(self):
+        return price_scope(self.cleaned_data['category'], self.cleaned_data['supplier'])
+
 class PurchaseForm(forms.ModelForm):
     class Meta:
         model = Purchase
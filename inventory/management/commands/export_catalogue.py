@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from inventory.catalogue_file_service import export_catalogue_csv
+
+
+class Command(BaseCommand):
+    help = 'Write the product catalogue as CSV in the layout import_catalogue reads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='File to write, defaults to standard output')
+
+    def handle(self, *args, **options):
+        if options['path']:
+            with open(options['path'], 'w', newline='', encoding='utf-8') as target:
+                target.writelines(export_catalogue_csv())
+        else:
+            for line in export_catalogue_csv():
+                self.stdout.write(line, ending='')
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.catalogue_file_service import IMPORT_CHUNK_SIZE, CatalogueImportError, import_catalogue
+
+
+class Command(BaseCommand):
+    help = 'Create or update products from a CSV or XLSX price list, matched on barcode'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or XLSX file with a header row')
+        parser.add_argument('--supplier', default='', help='Supplier for rows that don\'t name one')
+        parser.add_argument('--no-new-categories', action='store_true',
+                            help='Reject rows whose category doesn\'t exist instead of creating it')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            with open(path, 'rb') as source:
+                result = import_catalogue(
+                    source, filename=path, default_supplier=options['supplier'],
+                    create_categories=not options['no_new_categories'], chunk_size=options['chunk_size'],
+                )
+        except (OSError, CatalogueImportError) as exc:
+            raise CommandError(str(exc))
+
+        for number, message in result.errors:
+            self.stderr.write(f'Line {number}: {message}')
+        if result.error_count > len(result.errors):
+            self.stderr.write(f'... and {result.error_count - len(result.errors)} more')
+        summary = f'Created {result.created} and updated {result.updated} products'
+        if result.error_count:
+            self.stdout.write(self.style.WARNING(f'{summary}; skipped {result.error_count} rows'))
+        else:
+            self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,39 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.reorder_service import (
+    METHODS, apply_reorder_levels, demand_forecast, draft_purchase_orders, reorder_suggestions,
+)
+
+
+class Command(BaseCommand):
+    help = 'Forecast demand from sales history and suggest reorder levels and quantities (e.g. weekly from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--history-days', type=int, help='Days of sales to read, defaults to REORDER_HISTORY_DAYS')
+        parser.add_argument('--method', choices=METHODS, default='ewma',
+                            help='Exponential smoothing (ewma) or a moving average (sma)')
+        parser.add_argument('--window', type=int, default=28, help='Days averaged by the sma method')
+        parser.add_argument('--apply-levels', action='store_true',
+                            help='Write the reorder levels to each product\'s minimum stock level')
+        parser.add_argument('--drafts-for', metavar='USERNAME',
+                            help='Replace the draft purchase orders, created as this user')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['drafts_for']:
+            user = User.objects.filter(username=options['drafts_for']).first()
+            if user is None:
+                raise CommandError(f'No user named "{options["drafts_for"]}"')
+
+        forecast = demand_forecast(options['history_days'], options['method'], window=options['window'])
+        suggestions = reorder_suggestions(forecast)
+        to_order = sum(1 for suggestion in suggestions if suggestion.order_quantity)
+        self.stdout.write(f'Forecast {len(forecast)} products, {to_order} to reorder')
+        if options['apply_levels']:
+            changed = apply_reorder_levels(suggestions)
+            self.stdout.write(f'Updated the minimum stock level of {changed} products')
+        if user is not None:
+            drafts = draft_purchase_orders(suggestions, user)
+            self.stdout.write(f'Drafted {len(drafts)} purchase orders')
+        self.stdout.write(self.style.SUCCESS('Reorder plan complete'))
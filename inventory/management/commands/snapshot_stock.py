@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from inventory.stock_service import take_snapshots
+
+
+class Command(BaseCommand):
+    help = 'Record a stock level snapshot for every product (run nightly, e.g. from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = take_snapshots(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Recorded {count} stock snapshots'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from inventory.alert_service import refresh_alerts
+
+
+class Command(BaseCommand):
+    help = 'Refresh the stock alerts of every product, e.g. nightly from cron so expiry alerts follow the calendar'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            raised, cleared = refresh_alerts()
+        self.stdout.write(self.style.SUCCESS(f'Raised {len(raised)} and cleared {len(cleared)} stock alerts'))
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.5 on 2026-10-18 01:18
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def split_existing_stock(apps, schema_editor):
+    """Put each product's current stock on the shelf as one batch with the product's lot details"""
+    Product = apps.get_model('inventory', 'Product')
+    StockBatch = apps.get_model('inventory', 'StockBatch')
+    stocked = Product.objects.filter(quantity_in_stock__gt=0).values_list(
+        'pk', 'batch_number', 'expiry_date', 'quantity_in_stock', 'created_at'
+    )
+    StockBatch.objects.bulk_create(
+        (
+            StockBatch(
+                product_id=pk, batch_number=batch_number or '', expiry_date=expiry_date,
+                quantity=quantity, received_at=created_at,
+            )
+            for pk, batch_number, expiry_date, quantity, created_at in stocked.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0006_category_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='purchaseitem',
+            name='batch_number',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='purchaseitem',
+            name='expiry_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='StockBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch_number', models.CharField(blank=True, max_length=50)),
+                ('expiry_date', models.DateField(blank=True, null=True)),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('received_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='batches', to='inventory.product')),
+                ('purchase', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='batches', to='inventory.purchase')),
+            ],
+            options={
+                'verbose_name_plural': 'stock batches',
+                'ordering': ['product', 'expiry_date', 'id'],
+                'indexes': [models.Index(condition=models.Q(('quantity__gt', 0)), fields=['product', 'expiry_date', 'id'], name='stockbatch_fefo_idx'), models.Index(condition=models.Q(('quantity__gt', 0)), fields=['expiry_date'], name='stockbatch_expiry_idx')],
+            },
+        ),
+        migrations.RunPython(split_existing_stock, migrations.RunPython.noop),
+    ]
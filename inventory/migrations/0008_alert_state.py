@@ -0,0 +1,63 @@
+# Generated by Django 5.2.5 on 2026-10-18 01:28
+
+import django.db.models.deletion
+import django.utils.timezone
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def raise_existing_alerts(apps, schema_editor):
+    """The alerts that already apply, as alert_service.refresh_alerts() would raise them"""
+    Product = apps.get_model('inventory', 'Product')
+    StockBatch = apps.get_model('inventory', 'StockBatch')
+    AlertState = apps.get_model('inventory', 'AlertState')
+    today = django.utils.timezone.localdate()
+    warn_until = today + timedelta(days=getattr(settings, 'EXPIRY_WARNING_DAYS', 30))
+    alerts = [
+        AlertState(product_id=pk, kind='low_stock')
+        for pk in Product.objects.filter(
+            is_active=True, quantity_in_stock__lte=models.F('minimum_stock_level')
+        ).values_list('pk', flat=True).iterator()
+    ]
+    batches = StockBatch.objects.filter(quantity__gt=0, product__is_active=True).order_by()
+    for kind, window in [
+        ('expired', models.Q(expiry_date__lt=today)),
+        ('expiring_soon', models.Q(expiry_date__gte=today, expiry_date__lte=warn_until)),
+    ]:
+        rows = batches.filter(window).values('product_id').annotate(
+            earliest=models.Min('expiry_date'), units=models.Sum('quantity')
+        )
+        alerts += [
+            AlertState(product_id=row['product_id'], kind=kind, expiry_date=row['earliest'], quantity=row['units'])
+            for row in rows
+        ]
+    AlertState.objects.bulk_create(alerts, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0007_stock_batches'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlertState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('low_stock', 'Low stock'), ('expired', 'Expired stock'), ('expiring_soon', 'Expiring soon')], max_length=20)),
+                ('expiry_date', models.DateField(blank=True, null=True)),
+                ('quantity', models.PositiveIntegerField(blank=True, null=True)),
+                ('raised_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alerts', to='inventory.product')),
+            ],
+            options={
+                'ordering': ['kind', 'expiry_date', 'product'],
+                'indexes': [models.Index(fields=['kind', 'product'], name='alertstate_kind_idx')],
+                'constraints': [models.UniqueConstraint(fields=('product', 'kind'), name='alertstate_product_kind_uniq')],
+            },
+        ),
+        migrations.RunPython(raise_existing_alerts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-18 01:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0008_alert_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='purchase',
+            name='status',
+            field=models.CharField(choices=[('received', 'Received'), ('draft', 'Draft order')], default='received', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='supplier',
+            name='lead_time_days',
+            field=models.PositiveIntegerField(default=7),
+        ),
+    ]
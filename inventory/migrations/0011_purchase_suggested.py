@@ -0,0 +1,25 @@
+# Generated by Django 5.2.5 on 2026-10-18 02:30
+
+from django.db import migrations, models
+
+
+def mark_engine_drafts(apps, schema_editor):
+    """Until now only the reorder engine wrote drafts"""
+    Purchase = apps.get_model('inventory', 'Purchase')
+    Purchase.objects.filter(status='draft').update(suggested=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0010_price_changes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='purchase',
+            name='suggested',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(mark_engine_drafts, migrations.RunPython.noop),
+    ]
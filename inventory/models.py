@@ -4,10 +4,18 @@ from django.urls import reverse
 from django.utils import timezone
 from decimal import Decimal
 
+def profit_margin(cost_price, selling_price):
+    """Profit as a percentage of cost"""
+    if cost_price > 0:
+        return ((selling_price - cost_price) / cost_price) * 100
+    return 0
+
+
 class Category(models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         verbose_name_plural = "Categories"
@@ -23,6 +31,8 @@ class Supplier(models.Model):
     phone = models.CharField(max_length=15)
     email = models.EmailField(blank=True, null=True)
     address = models.TextField()
+    # Days from ordering to the goods being on the shelf; sizes the reorder engine's safety stock
+    lead_time_days = models.PositiveIntegerField(default=7)
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
@@ -60,6 +70,28 @@ class Product(models.Model):
     
     class Meta:
         ordering = ['name']
+        indexes = [
+            # POS listings, search and product counts only ever look at active products
+            models.Index(
+                fields=['quantity_in_stock'],
+                condition=models.Q(is_active=True),
+                name='product_active_stock_idx',
+            ),
+            # Dashboard, POS and report low-stock alerts
+            models.Index(
+                fields=['name'],
+                condition=models.Q(is_active=True, quantity_in_stock__lte=models.F('minimum_stock_level')),
+                name='product_low_stock_idx',
+            ),
+            # Expired / expiring soon checks
+            models.Index(
+                fields=['expiry_date'],
+                condition=models.Q(is_active=True),
+                name='product_active_expiry_idx',
+            ),
+            # POS catalogue version and delta sync
+            models.Index(fields=['updated_at'], name='product_updated_idx'),
+        ]
     
     def __str__(self):
         return self.name
@@ -69,27 +101,46 @@ class Product(models.Model):
     
     @property
     def is_low_stock(self):
+        kinds = self._alert_kinds()
+        if kinds is not None:
+            return AlertState.LOW_STOCK in kinds
         return self.quantity_in_stock <= self.minimum_stock_level
     
     @property
     def is_expired(self):
+        kinds = self._alert_kinds()
+        if kinds is not None:
+            return AlertState.EXPIRED in kinds
         if self.expiry_date:
             return self.expiry_date < timezone.now().date()
         return False
+
+    def _alert_kinds(self):
+        # Lists prefetch 'alerts' so each row's badges cost no queries
+        if 'alerts' in getattr(self, '_prefetched_objects_cache', {}):
+            return {alert.kind for alert in self.alerts.all()}
+        return None
     
     @property
     def profit_margin(self):
-        if self.cost_price > 0:
-            return ((self.selling_price - self.cost_price) / self.cost_price) * 100
-        return 0
+        return profit_margin(self.cost_price, self.selling_price)
 
 class Purchase(models.Model):
+    STATUS_CHOICES = [
+        ('received', 'Received'),
+        # Suggested by the reorder engine; puts nothing on the shelf
+        ('draft', 'Draft order'),
+    ]
+
     supplier = models.ForeignKey(Supplier, on_delete=models.CASCADE, related_name='purchases')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='received')
     purchase_date = models.DateTimeField(auto_now_add=True)
     invoice_number = models.CharField(max_length=50, unique=True)
     total_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
     notes = models.TextField(blank=True, null=True)
+    # Drafted by the reorder engine, which replaces its own drafts on each run
+    suggested = models.BooleanField(default=False, editable=False)
     
     class Meta:
         ordering = ['-purchase_date']
@@ -103,15 +154,185 @@ class PurchaseItem(models.Model):
     quantity = models.PositiveIntegerField()
     unit_cost = models.DecimalField(max_digits=10, decimal_places=2)
     total_cost = models.DecimalField(max_digits=10, decimal_places=2)
+    # The lot the line was delivered as; each line goes on the shelf as its own StockBatch
+    batch_number = models.CharField(max_length=50, blank=True)
+    expiry_date = models.DateField(blank=True, null=True)
     
     def save(self, *args, **kwargs):
+        """Save a single line; whole invoices go through purchase_service.receive_purchase"""
         self.total_cost = self.quantity * self.unit_cost
+        adding = self._state.adding
         super().save(*args, **kwargs)
+        if not adding:
+            # The goods were put on the shelf when the line was first saved
+            return
         
-        # Update product stock
+        # Update product stock in the database so concurrent receipts and sales don't clash
+        Product.objects.filter(pk=self.product_id).update(
+            quantity_in_stock=models.F('quantity_in_stock') + self.quantity,
+            cost_price=self.unit_cost,
+            updated_at=timezone.now(),
+        )
+        StockMovement.objects.create(
+            product_id=self.product_id,
+            movement_type='purchase',
+            quantity=self.quantity,
+            reference=f"Purchase #{self.purchase.invoice_number}",
+        )
+        StockBatch.objects.create(
+            product_id=self.product_id,
+            purchase_id=self.purchase_id,
+            batch_number=self.batch_number,
+            expiry_date=self.expiry_date,
+            quantity=self.quantity,
+        )
+        Purchase.objects.filter(pk=self.purchase_id).update(
+            total_amount=models.F('total_amount') + self.total_cost,
+        )
         self.product.quantity_in_stock += self.quantity
         self.product.cost_price = self.unit_cost
-        self.product.save()
     
     def __str__(self):
-        return f"{self.product.name} - {self.quantity} units"
\ No newline at end of file
+        return f"{self.product.name} - {self.quantity} units"
+
+class StockMovement(models.Model):
+    """Append-only record of every change to a product's quantity_in_stock"""
+    MOVEMENT_TYPES = [
+        ('sale', 'Sale'),
+        ('purchase', 'Purchase'),
+        ('refund', 'Refund'),
+        ('adjustment', 'Adjustment'),
+    ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_movements')
+    movement_type = models.CharField(max_length=20, choices=MOVEMENT_TYPES)
+    quantity = models.IntegerField(help_text='Signed change in stock: negative for stock leaving the shelf')
+    reference = models.CharField(max_length=100, blank=True)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['product', 'timestamp'], name='stockmove_product_time_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product.name} {self.quantity:+d} ({self.get_movement_type_display()})"
+
+
+class StockSnapshot(models.Model):
+    """Periodic per-product stock level, so history is snapshot + a short ledger scan"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_snapshots')
+    quantity = models.IntegerField()
+    taken_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-taken_at']
+        indexes = [
+            models.Index(fields=['product', 'taken_at'], name='stocksnap_product_time_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product.name}: {self.quantity} @ {self.taken_at:%Y-%m-%d %H:%M}"
+
+
+class StockBatch(models.Model):
+    """
+    One lot of a product on the shelf, with its own quantity and expiry date.
+
+    A product's quantity_in_stock is the sum of its batches. Sales take stock
+    from the unexpired batch that expires first (FEFO), see
+    stock_service.take_from_batches. Product.batch_number and expiry_date
+    describe the lot a product was first stocked with.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='batches')
+    batch_number = models.CharField(max_length=50, blank=True)
+    expiry_date = models.DateField(blank=True, null=True)
+    quantity = models.PositiveIntegerField(default=0)
+    purchase = models.ForeignKey(
+        Purchase, on_delete=models.SET_NULL, null=True, blank=True, related_name='batches'
+    )
+    received_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['product', 'expiry_date', 'id']
+        verbose_name_plural = 'stock batches'
+        indexes = [
+            # FEFO allocation walks a product's stocked batches in expiry order
+            models.Index(
+                fields=['product', 'expiry_date', 'id'],
+                condition=models.Q(quantity__gt=0),
+                name='stockbatch_fefo_idx',
+            ),
+            # Expired / expiring soon reports
+            models.Index(
+                fields=['expiry_date'],
+                condition=models.Q(quantity__gt=0),
+                name='stockbatch_expiry_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.product.name} {self.batch_number or 'unnumbered'}: {self.quantity}"
+
+    @property
+    def is_expired(self):
+        return self.expiry_date is not None and self.expiry_date < timezone.localdate()
+
+
+class AlertState(models.Model):
+    """
+    A stock alert that currently applies to a product.
+
+    A row exists only while its condition holds and is removed as soon as it
+    stops, so lists, counts and badges read this small table instead of
+    re-deriving the conditions. Kept current by alert_service.refresh_alerts.
+    """
+    LOW_STOCK = 'low_stock'
+    EXPIRED = 'expired'
+    EXPIRING_SOON = 'expiring_soon'
+    KIND_CHOICES = [
+        (LOW_STOCK, 'Low stock'),
+        (EXPIRED, 'Expired stock'),
+        (EXPIRING_SOON, 'Expiring soon'),
+    ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='alerts')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    # Earliest expiry among the batches the alert covers (expiry alerts only)
+    expiry_date = models.DateField(blank=True, null=True)
+    # Units in those batches (expiry alerts only)
+    quantity = models.PositiveIntegerField(blank=True, null=True)
+    raised_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['kind', 'expiry_date', 'product']
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'kind'], name='alertstate_product_kind_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['kind', 'product'], name='alertstate_kind_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product.name}: {self.get_kind_display()}"
+
+
+class PriceChange(models.Model):
+    """A selling price changed by a bulk price update, kept as price history"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='price_changes')
+    old_price = models.DecimalField(max_digits=10, decimal_places=2)
+    new_price = models.DecimalField(max_digits=10, decimal_places=2)
+    # The rule that set the price, as shown to the user who applied it
+    rule = models.CharField(max_length=200)
+    changed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    changed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-changed_at']
+        indexes = [
+            models.Index(fields=['product', 'changed_at'], name='pricechange_product_time_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product.name}: {self.old_price} -> {self.new_price}"
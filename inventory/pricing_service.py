@@ -0,0 +1,199 @@
+"""
+Bulk price updates.
+
+A PriceRule sets new selling prices for a group of products: a markup marks
+the current selling price up (or down) by a percentage, and cost plus sets it
+to the cost price plus a margin. The result can be rounded to a step, such as
+0.05 or 1.00, to the nearest step or always up or down. The group is every
+active product, narrowed by category and/or supplier.
+
+The new price is a database expression, so it is worked out for the whole
+group inside the query. price_preview() compares old and new prices and
+margins with one aggregate and lists the first changed products.
+apply_price_rule() locks the group, records each change as a PriceChange and
+writes every new price with one UPDATE, all in one transaction. Prices below
+cost are refused unless the rule allows them.
+"""
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.db.models import Avg, Count, DecimalField, ExpressionWrapper, F, Q, Sum, Value
+from django.db.models.functions import Ceil, Floor, Round
+from django.utils import timezone
+
+from .barcode_service import barcode_cache
+from .models import PriceChange, Product, profit_margin
+
+PriceRule = namedtuple('PriceRule', 'method percent step direction allow_below_cost')
+PricePreview = namedtuple('PricePreview', 'summary rows')
+METHOD_CHOICES = [
+    ('markup', 'Mark up selling price'),
+    ('cost_plus', 'Cost plus margin'),
+]
+DIRECTION_CHOICES = [
+    ('nearest', 'Nearest'),
+    ('up', 'Up'),
+    ('down', 'Down'),
+]
+ROUNDING = {'nearest': Round, 'up': Ceil, 'down': Floor}
+PREVIEW_ROWS = 100
+# Product.selling_price is DecimalField(max_digits=10, decimal_places=2)
+MAX_PRICE = Decimal('99999999.99')
+CENTS = Decimal('0.01')
+PRICE_FIELD = DecimalField(max_digits=10, decimal_places=2)
+
+
+class PriceRuleError(ValueError):
+    """Raised when a price rule can't be applied; ``errors`` lists every problem found"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('; '.join(errors))
+
+
+def price_rule(method, percent, step=None, direction='nearest', allow_below_cost=False):
+    """A checked PriceRule; percent and step may be numbers or strings"""
+    if method not in dict(METHOD_CHOICES):
+        raise PriceRuleError([f'Unknown pricing method {method!r}'])
+    if direction not in ROUNDING:
+        raise PriceRuleError([f'Unknown rounding direction {direction!r}'])
+    try:
+        percent = Decimal(str(percent))
+        step = Decimal(str(step)) if step else None
+    except (InvalidOperation, ValueError):
+        raise PriceRuleError(['The percentage and rounding step must be numbers'])
+    if not percent.is_finite() or (step is not None and not step.is_finite()):
+        raise PriceRuleError(['The percentage and rounding step must be finite'])
+    if percent <= -100:
+        raise PriceRuleError(['The percentage must be above -100'])
+    if step is not None and step <= 0:
+        raise PriceRuleError(['The rounding step must be positive'])
+    return PriceRule(method, percent, step, direction, allow_below_cost)
+
+
+def describe(rule):
+    """The rule in words, as kept on each PriceChange"""
+    if rule.method == 'markup':
+        text = f'Selling price {rule.percent:+}%'
+    else:
+        text = f'Cost plus {rule.percent}%'
+    if rule.step:
+        text += f', rounded {rule.direction} to {rule.step}' if rule.direction != 'nearest' else f', rounded to {rule.step}'
+    return text
+
+
+def new_price(rule):
+    """The rule's new selling price as an expression over a product row"""
+    base = F('selling_price') if rule.method == 'markup' else F('cost_price')
+    price = ExpressionWrapper(base * Value(1 + rule.percent / 100), output_field=PRICE_FIELD)
+    if rule.step:
+        step = Value(rule.step, output_field=PRICE_FIELD)
+        # Steps counted to 6 places first, so float noise (5.50 * 1.1 = 6.0500000001
+        # on SQLite) can't push a price that is on a step up or down to the next one
+        steps = Round(price / step, 6, output_field=PRICE_FIELD)
+        price = ExpressionWrapper(
+            ROUNDING[rule.direction](steps, output_field=PRICE_FIELD) * step, output_field=PRICE_FIELD,
+        )
+    return Round(price, 2, output_field=PRICE_FIELD)
+
+
+def price_scope(category=None, supplier=None):
+    """Active products, narrowed to a category and/or supplier"""
+    products = Product.objects.filter(is_active=True)
+    if category is not None:
+        products = products.filter(category=category)
+    if supplier is not None:
+        products = products.filter(supplier=supplier)
+    return products
+
+
+def _priced(products, rule):
+    return products.order_by().annotate(new_price=new_price(rule))
+
+
+def _changed(products, rule):
+    return _priced(products, rule).exclude(new_price=F('selling_price'))
+
+
+def _margin(price):
+    return ExpressionWrapper((price - F('cost_price')) * 100 / F('cost_price'), output_field=PRICE_FIELD)
+
+
+def price_preview(products, rule, limit=PREVIEW_ROWS):
+    """
+    A PricePreview of ``rule`` over ``products``: summary totals from one
+    aggregate, and the first ``limit`` changed products by name with their
+    old and new prices and margins. Nothing is written.
+    """
+    priced = _priced(products, rule)
+    changed = ~Q(new_price=F('selling_price'))
+    costed = Q(cost_price__gt=0)
+    summary = priced.aggregate(
+        products=Count('id'),
+        changed=Count('id', filter=changed),
+        raised=Count('id', filter=Q(new_price__gt=F('selling_price'))),
+        lowered=Count('id', filter=Q(new_price__lt=F('selling_price'))),
+        below_cost=Count('id', filter=Q(new_price__lt=F('cost_price'))),
+        old_margin=Avg(_margin(F('selling_price')), filter=costed),
+        new_margin=Avg(_margin(F('new_price')), filter=costed),
+        # Value of the stock on the shelf at the old and new prices
+        old_value=Sum(F('selling_price') * F('quantity_in_stock')),
+        new_value=Sum(F('new_price') * F('quantity_in_stock')),
+    )
+    rows = []
+    for row in _changed(products, rule).order_by('name', 'pk').values(
+        'pk', 'name', 'barcode', 'cost_price', 'selling_price', 'new_price',
+    )[:limit]:
+        price = Decimal(row.pop('new_price')).quantize(CENTS)
+        rows.append({
+            **row,
+            'new_price': price,
+            'change': price - row['selling_price'],
+            'old_margin': profit_margin(row['cost_price'], row['selling_price']),
+            'new_margin': profit_margin(row['cost_price'], price),
+        })
+    return PricePreview(summary, rows)
+
+
+def apply_price_rule(products, rule, changed_by=None):
+    """
+    Give ``products`` their new prices under ``rule`` in one transaction:
+    one PriceChange per product whose price moves, then one UPDATE for all
+    of them. Raises PriceRuleError, writing nothing, if a price would be
+    zero or out of range or, unless the rule allows it, below cost. Returns the
+    number of products repriced.
+    """
+    with transaction.atomic():
+        # Locked so the recorded old prices are the ones the UPDATE replaces
+        rows = list(
+            _changed(products, rule).select_for_update().order_by('pk')
+            .values_list('pk', 'barcode', 'cost_price', 'selling_price', 'new_price')
+        )
+        errors = []
+        changes = []
+        text = describe(rule)
+        now = timezone.now()
+        for pk, barcode, cost, old, price in rows:
+            price = Decimal(price).quantize(CENTS)
+            if not 0 < price <= MAX_PRICE:
+                errors.append(f'Product {barcode}: {price} is out of range')
+            elif price < cost and not rule.allow_below_cost:
+                errors.append(f'Product {barcode}: {price} is below its cost of {cost}')
+            changes.append(PriceChange(
+                product_id=pk, old_price=old, new_price=price, rule=text, changed_by=changed_by, changed_at=now,
+            ))
+        if errors:
+            raise PriceRuleError(errors)
+        if not changes:
+            return 0
+        PriceChange.objects.bulk_create(changes, batch_size=1000)
+        _changed(products, rule).update(selling_price=new_price(rule), updated_at=now)
+
+        repriced = [Product(pk=pk, barcode=barcode) for pk, barcode, *_ in rows]
+
+        def refresh_caches():
+            for product in repriced:
+                barcode_cache.invalidate(product)
+        transaction.on_commit(refresh_caches)
+    return len(changes)
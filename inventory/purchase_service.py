@@ -0,0 +1,171 @@
+"""
+Receiving supplier deliveries.
+
+receive_purchase() books a whole supplier invoice in one transaction, with the
+same number of queries for 2 lines as for 200. The products are read once to
+check the lines. The purchase is inserted with its total already worked out
+and the lines go in with one bulk_create. Stock levels and cost prices then
+change in a single UPDATE with one CASE per column. Each line goes on the
+shelf as its own StockBatch, with the line's batch number and expiry date,
+and the batches and stock ledger rows take one bulk_create each. The
+products' stock alerts are refreshed before the transaction commits.
+
+A draft order from the reorder engine is received the same way, by
+receive_draft(), which books the draft's lines as they stand.
+"""
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.db.models import Case, When, Value, F, IntegerField, DecimalField
+from django.utils import timezone
+
+from . import dashboard_service
+from .alert_service import refresh_alerts
+from .barcode_service import barcode_cache
+from .models import Product, Purchase, PurchaseItem, StockBatch
+from .stock_service import record_movements
+
+# PurchaseItem.unit_cost / total_cost are DecimalField(max_digits=10, decimal_places=2)
+MAX_LINE_AMOUNT = Decimal('99999999.99')
+CENTS = Decimal('0.01')
+
+
+class PurchaseError(ValueError):
+    """Raised when a purchase can't be received; ``errors`` lists every problem found"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('; '.join(errors))
+
+
+def _line_values(line):
+    product = line.get('product')
+    product_id = getattr(product, 'pk', product) if product is not None else line.get('product_id')
+    return product_id, line.get('quantity'), line.get('unit_cost'), line.get('expiry_date')
+
+
+def clean_lines(lines):
+    """
+    Check purchase lines given as mappings with product (or product_id),
+    quantity, unit_cost and optionally batch_number and expiry_date (a date
+    or YYYY-MM-DD). Returns [(product_id, quantity, unit_cost, batch_number,
+    expiry_date)] and {product_id: product}, or raises PurchaseError listing
+    every bad line.
+    """
+    errors = []
+    cleaned = []
+    for number, line in enumerate(lines, start=1):
+        product_id, quantity, unit_cost, expiry_date = _line_values(line)
+        if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity <= 0:
+            errors.append(f'Line {number}: quantity must be a positive whole number')
+            continue
+        try:
+            unit_cost = Decimal(str(unit_cost)).quantize(CENTS)
+        except (InvalidOperation, ValueError):
+            errors.append(f'Line {number}: unit cost must be a number')
+            continue
+        if unit_cost < 0 or quantity * unit_cost > MAX_LINE_AMOUNT:
+            errors.append(f'Line {number}: unit cost is out of range')
+            continue
+        if isinstance(expiry_date, str):
+            try:
+                expiry_date = date.fromisoformat(expiry_date) if expiry_date else None
+            except ValueError:
+                errors.append(f'Line {number}: expiry date must be YYYY-MM-DD')
+                continue
+        batch_number = str(line.get('batch_number') or '')[:50]
+        cleaned.append((number, product_id, quantity, unit_cost, batch_number, expiry_date))
+
+    products = Product.objects.only('pk', 'barcode').in_bulk(
+        {line[1] for line in cleaned if isinstance(line[1], int)}
+    )
+    for number, product_id, *_ in cleaned:
+        if product_id not in products:
+            errors.append(f'Line {number}: no product with id {product_id!r}')
+    if not cleaned and not errors:
+        errors.append('A purchase needs at least one line')
+    if errors:
+        raise PurchaseError(errors)
+    return [line[1:] for line in cleaned], products
+
+
+def _apply_receipt(received, reference):
+    """Add {product_id: (quantity, unit_cost)} to stock and cost prices with one UPDATE"""
+    quantity = Case(
+        *[When(pk=pk, then=Value(qty)) for pk, (qty, _) in received.items()],
+        output_field=IntegerField(),
+    )
+    cost_price = Case(
+        *[When(pk=pk, then=Value(cost)) for pk, (_, cost) in received.items()],
+        output_field=DecimalField(max_digits=10, decimal_places=2),
+    )
+    Product.objects.filter(pk__in=list(received)).update(
+        quantity_in_stock=F('quantity_in_stock') + quantity,
+        cost_price=cost_price,
+        updated_at=timezone.now(),
+    )
+    record_movements({pk: qty for pk, (qty, _) in received.items()}, 'purchase', reference)
+
+
+def _refresh_caches(products):
+    for product in products:
+        barcode_cache.invalidate(product)
+    dashboard_service.stock_changed()
+
+
+def receive_purchase(purchase, lines):
+    """
+    Save an unsaved Purchase (supplier, invoice_number, created_by, notes)
+    together with its lines, and put the goods on the shelf. A saved draft
+    order may be given instead; its lines are replaced by ``lines``.
+
+    A product on several lines gets their quantities added together and
+    takes the unit cost of its last line as its cost price. Nothing is
+    written if any line is invalid. Returns the saved purchase.
+    """
+    if purchase.pk and purchase.status != 'draft':
+        raise PurchaseError([f'Purchase #{purchase.invoice_number} has already been received'])
+    lines, products = clean_lines(lines)
+
+    received = {}
+    total_amount = Decimal('0')
+    items = []
+    batches = []
+    for product_id, quantity, unit_cost, batch_number, expiry_date in lines:
+        line_total = quantity * unit_cost
+        total_amount += line_total
+        items.append(PurchaseItem(
+            product_id=product_id, quantity=quantity, unit_cost=unit_cost, total_cost=line_total,
+            batch_number=batch_number, expiry_date=expiry_date,
+        ))
+        batches.append(StockBatch(
+            product_id=product_id, batch_number=batch_number, expiry_date=expiry_date, quantity=quantity,
+        ))
+        received[product_id] = (received.get(product_id, (0, None))[0] + quantity, unit_cost)
+
+    with transaction.atomic():
+        if purchase.pk:
+            # Locked so two managers receiving the same draft can't both book it
+            if not Purchase.objects.select_for_update().filter(pk=purchase.pk, status='draft').exists():
+                raise PurchaseError([f'Purchase #{purchase.invoice_number} has already been received'])
+            purchase.items.all().delete()
+            purchase.status = 'received'
+            purchase.purchase_date = timezone.now()
+        purchase.total_amount = total_amount
+        purchase.save()
+        for item, batch in zip(items, batches):
+            item.purchase = batch.purchase = purchase
+        PurchaseItem.objects.bulk_create(items)
+        StockBatch.objects.bulk_create(batches)
+        _apply_receipt(received, f'Purchase #{purchase.invoice_number}')
+        refresh_alerts(received)
+        received_products = [products[pk] for pk in received]
+        transaction.on_commit(lambda: _refresh_caches(received_products))
+    return purchase
+
+
+def receive_draft(purchase):
+    """Receive a draft order with the quantities and costs it was drafted with"""
+    lines = list(purchase.items.values('product_id', 'quantity', 'unit_cost', 'batch_number', 'expiry_date'))
+    return receive_purchase(purchase, lines)
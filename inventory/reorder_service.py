@@ -0,0 +1,196 @@
+"""
+Demand forecasting and reorder points.
+
+Daily demand is forecast from the paid sales in the daily rollup. Each
+product's forecast is a weighted mean of its daily sales, with weights that
+depend only on a day's age: exponential smoothing gives yesterday
+REORDER_SMOOTHING and each older day (1 - REORDER_SMOOTHING) times the next
+one's, and a moving average weighs the last `window` days equally. Because
+the weights are fixed, a day without sales adds nothing to the sums. The
+whole catalogue is then forecast in one streaming pass over the rollup rows
+that exist. There is no products x days matrix and no per-product query, so
+memory grows with the number of products, not with the history.
+
+The reorder level covers demand over the supplier's lead time plus
+REORDER_SERVICE_FACTOR standard deviations of it. A product at or below its
+level is ordered up to that level plus REORDER_REVIEW_DAYS of demand.
+apply_reorder_levels() writes the levels to minimum_stock_level, which drives
+the low stock alerts. draft_purchase_orders() turns the order quantities into
+one draft Purchase per supplier. `manage.py plan_reorders` runs both.
+"""
+import math
+from collections import defaultdict, namedtuple
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from reports.models import DailySalesRollup
+from . import dashboard_service
+from .alert_service import refresh_alerts
+from .barcode_service import barcode_cache
+from .models import Product, Purchase, PurchaseItem
+
+ReorderSuggestion = namedtuple(
+    'ReorderSuggestion', 'product_id supplier_id daily_demand demand_sd reorder_level order_quantity'
+)
+METHODS = ('ewma', 'sma')
+# Products updated per statement when writing reorder levels
+UPDATE_CHUNK = 900
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def day_weights(history_days, method='ewma', smoothing=None, window=28):
+    """Weight of a day by its age (0 = yesterday), summing to 1 over the history"""
+    if method not in METHODS:
+        raise ValueError(f'Unknown forecasting method {method!r}, expected one of {METHODS}')
+    if method == 'sma':
+        window = min(window, history_days)
+        return [1 / window if age < window else 0.0 for age in range(history_days)]
+    smoothing = smoothing or _setting('REORDER_SMOOTHING', 0.1)
+    weights = [smoothing * (1 - smoothing) ** age for age in range(history_days)]
+    total = sum(weights)
+    return [weight / total for weight in weights]
+
+
+def demand_forecast(history_days=None, method='ewma', smoothing=None, window=28, today=None):
+    """
+    {product_id: (daily demand, standard deviation of daily demand)} from the
+    closed days before today. Products that sold nothing in the history are
+    left out.
+    """
+    history_days = history_days or _setting('REORDER_HISTORY_DAYS', 365)
+    today = today or timezone.localdate()
+    last_day = today - timedelta(days=1)
+    weights = day_weights(history_days, method, smoothing, window)
+    # Daily units per product; the rollup also splits them by payment method
+    rows = (
+        DailySalesRollup.objects.filter(day__range=(today - timedelta(days=history_days), last_day))
+        .order_by().values_list('product_id', 'day').annotate(units=Sum('quantity'))
+    )
+    mean = defaultdict(float)
+    square = defaultdict(float)
+    for product_id, day, units in rows.iterator(chunk_size=10000):
+        weight = weights[(last_day - day).days]
+        if weight and units:
+            mean[product_id] += weight * units
+            square[product_id] += weight * units * units
+    return {
+        product_id: (level, _deviation(level, square[product_id]))
+        for product_id, level in mean.items() if level > 0
+    }
+
+
+def _deviation(mean, mean_square):
+    variance = mean_square - mean * mean
+    # What's left of a steady demand's variance is rounding error
+    return math.sqrt(variance) if variance > 1e-9 * mean_square else 0.0
+
+
+def reorder_suggestions(forecast, service_factor=None, review_days=None):
+    """A ReorderSuggestion for every active product in ``forecast``"""
+    service_factor = _setting('REORDER_SERVICE_FACTOR', 1.65) if service_factor is None else service_factor
+    review_days = _setting('REORDER_REVIEW_DAYS', 14) if review_days is None else review_days
+    products = Product.objects.filter(is_active=True).order_by().values_list(
+        'pk', 'supplier_id', 'supplier__lead_time_days', 'quantity_in_stock'
+    )
+    suggestions = []
+    for pk, supplier_id, lead_time, stock in products.iterator(chunk_size=10000):
+        if pk not in forecast:
+            continue
+        demand, sd = forecast[pk]
+        # Rounded first so float noise in a steady forecast doesn't add a unit
+        reorder_level = math.ceil(round(demand * lead_time + service_factor * sd * math.sqrt(lead_time), 6))
+        order_up_to = reorder_level + math.ceil(round(demand * review_days, 6))
+        order_quantity = order_up_to - stock if stock <= reorder_level else 0
+        suggestions.append(ReorderSuggestion(pk, supplier_id, demand, sd, reorder_level, order_quantity))
+    return suggestions
+
+
+def apply_reorder_levels(suggestions):
+    """
+    Write the suggested reorder levels to minimum_stock_level, one UPDATE per
+    level value (in chunks) rather than one per product. Returns the number
+    of products changed.
+    """
+    levels = {suggestion.product_id: suggestion.reorder_level for suggestion in suggestions}
+    current = Product.objects.order_by().values_list('pk', 'minimum_stock_level', 'barcode')
+    by_level = defaultdict(list)
+    changed = []
+    for pk, level, barcode in current.iterator(chunk_size=10000):
+        if pk in levels and levels[pk] != level:
+            by_level[levels[pk]].append(pk)
+            changed.append(Product(pk=pk, barcode=barcode))
+    if not changed:
+        return 0
+    with transaction.atomic():
+        now = timezone.now()
+        for level, product_ids in by_level.items():
+            for start in range(0, len(product_ids), UPDATE_CHUNK):
+                Product.objects.filter(pk__in=product_ids[start:start + UPDATE_CHUNK]).update(
+                    minimum_stock_level=level, updated_at=now,
+                )
+        # Levels moved across much of the catalogue, so sweep every product's alerts
+        refresh_alerts()
+
+        def refresh_caches():
+            for product in changed:
+                barcode_cache.invalidate(product)
+            dashboard_service.stock_changed()
+        transaction.on_commit(refresh_caches)
+    return len(changed)
+
+
+def _draft_number(number, taken):
+    """``number``, or with a -2, -3, ... suffix if a received or hand-made order already has it"""
+    candidate, suffix = number, 2
+    while candidate in taken:
+        candidate, suffix = f'{number}-{suffix}', suffix + 1
+    return candidate
+
+
+def draft_purchase_orders(suggestions, created_by, today=None):
+    """
+    Replace the engine's draft purchases with one per supplier, listing the
+    products to reorder at their current cost price. Drafts entered by hand
+    are left alone. Returns the new drafts.
+    """
+    today = today or timezone.localdate()
+    orders = defaultdict(dict)
+    for suggestion in suggestions:
+        if suggestion.order_quantity > 0:
+            orders[suggestion.supplier_id][suggestion.product_id] = suggestion.order_quantity
+    ordered = {pk for lines in orders.values() for pk in lines}
+    costs = {
+        pk: cost for pk, cost in Product.objects.order_by().values_list('pk', 'cost_price').iterator(chunk_size=10000)
+        if pk in ordered
+    }
+
+    with transaction.atomic():
+        Purchase.objects.filter(status='draft', suggested=True).delete()
+        prefix = f'DRAFT-{today:%Y%m%d}-'
+        taken = set(Purchase.objects.filter(invoice_number__startswith=prefix).values_list('invoice_number', flat=True))
+        drafts = Purchase.objects.bulk_create([
+            Purchase(
+                supplier_id=supplier_id, status='draft', suggested=True, created_by=created_by,
+                invoice_number=_draft_number(prefix + str(supplier_id), taken),
+                notes='Suggested by the reorder engine',
+                total_amount=sum((quantity * costs[pk] for pk, quantity in lines.items()), Decimal('0')),
+            )
+            for supplier_id, lines in sorted(orders.items())
+        ])
+        # bulk_create skips PurchaseItem.save, so a draft puts nothing on the shelf
+        PurchaseItem.objects.bulk_create([
+            PurchaseItem(
+                purchase=draft, product_id=pk, quantity=quantity,
+                unit_cost=costs[pk], total_cost=quantity * costs[pk],
+            )
+            for draft in drafts for pk, quantity in orders[draft.supplier_id].items()
+        ], batch_size=1000)
+    return drafts
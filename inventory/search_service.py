@@ -0,0 +1,204 @@
+"""
+Product search for the POS and the product list.
+
+A scanned barcode is looked up directly through its unique index. Text queries
+use pg_trgm word similarity on PostgreSQL (see migration 0004 for the GIN
+indexes). On other databases an in-process index of catalogue words answers
+word-prefix matches and, through word trigrams, words typed with a typo.
+"""
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+from django.db import connection
+from django.db.models import F, Q
+
+from .models import Product
+
+WORD = re.compile(r'[a-z0-9]+')
+BARCODE = re.compile(r'^\d{6,}$')
+
+# Weight of a match in each field; a name hit outranks a generic name hit
+FIELD_WEIGHTS = (('name', 1.0), ('generic_name', 0.8), ('barcode', 0.5))
+# Trigram similarity a word needs to stand in for a misspelt query word
+TYPO_SIMILARITY = 0.4
+TYPO_MIN_LENGTH = 4
+# Rebuild the in-process index this often to pick up changes made by other processes
+INDEX_MAX_AGE = 300
+FETCH_CHUNK = 200
+
+
+def _words(text):
+    return WORD.findall((text or '').lower())
+
+
+def _trigrams(word):
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ProductSearchIndex:
+    """Word index over product names, generic names and barcodes"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._built_at = None
+            self._postings = {}             # word -> {product_id: field weight}
+            self._vocabulary = []           # sorted words, for prefix ranges
+            self._grams = defaultdict(set)  # trigram -> words, for typo matches
+            self._documents = {}            # product_id -> (sort name, words)
+
+    def build(self):
+        with self._lock:
+            self.clear()
+            products = Product.objects.order_by().values_list('pk', 'name', 'generic_name', 'barcode')
+            for pk, name, generic_name, barcode in products.iterator(chunk_size=2000):
+                self._add(pk, {'name': name, 'generic_name': generic_name, 'barcode': barcode})
+            self._built_at = time.monotonic()
+
+    def _ensure_built(self):
+        if self._built_at is None or time.monotonic() - self._built_at > INDEX_MAX_AGE:
+            self.build()
+
+    def _add(self, pk, fields):
+        weights = {}
+        for field, field_weight in FIELD_WEIGHTS:
+            for word in _words(fields[field]):
+                weights[word] = max(weights.get(word, 0), field_weight)
+        for word, weight in weights.items():
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = {}
+                insort(self._vocabulary, word)
+                if not word.isdigit():
+                    for gram in _trigrams(word):
+                        self._grams[gram].add(word)
+            postings[pk] = weight
+        self._documents[pk] = ((fields['name'] or '').lower(), set(weights))
+
+    def _remove(self, pk):
+        document = self._documents.pop(pk, None)
+        if document is None:
+            return
+        for word in document[1]:
+            postings = self._postings[word]
+            postings.pop(pk, None)
+            if not postings:
+                del self._postings[word]
+                del self._vocabulary[bisect_left(self._vocabulary, word)]
+                for gram in _trigrams(word):
+                    self._grams[gram].discard(word)
+
+    def update(self, product):
+        """Re-index one saved product; a no-op until the index has been built"""
+        with self._lock:
+            if self._built_at is None:
+                return
+            self._remove(product.pk)
+            self._add(product.pk, {field: getattr(product, field) for field, _ in FIELD_WEIGHTS})
+
+    def remove(self, pk):
+        with self._lock:
+            self._remove(pk)
+
+    def _similar_words(self, token):
+        grams = _trigrams(token)
+        shared = defaultdict(int)
+        for gram in grams:
+            for word in self._grams.get(gram, ()):
+                shared[word] += 1
+        for word, count in shared.items():
+            similarity = count / (len(grams) + len(_trigrams(word)) - count)
+            if similarity >= TYPO_SIMILARITY:
+                yield word, similarity
+
+    def _token_scores(self, token):
+        scores = {}
+
+        def add(word, score):
+            for pk, field_weight in self._postings[word].items():
+                scores[pk] = max(scores.get(pk, 0), score * field_weight)
+
+        start = bisect_left(self._vocabulary, token)
+        end = bisect_left(self._vocabulary, token + '\uffff')
+        for word in self._vocabulary[start:end]:
+            # Whole words first, then the closest completions of a partly typed word
+            add(word, 3.0 if word == token else 1.0 + len(token) / len(word))
+        if start == end and len(token) >= TYPO_MIN_LENGTH:
+            for word, similarity in self._similar_words(token):
+                add(word, similarity)
+        return scores
+
+    def search(self, query):
+        """Product ids matching every word of ``query``, best match first"""
+        tokens = _words(query)
+        if not tokens:
+            return []
+        with self._lock:
+            self._ensure_built()
+            totals = None
+            for token in tokens:
+                scores = self._token_scores(token)
+                if totals is None:
+                    totals = scores
+                else:
+                    totals = {pk: totals[pk] + score for pk, score in scores.items() if pk in totals}
+                if not totals:
+                    return []
+            ranked = sorted(totals.items(), key=lambda item: (-item[1], self._documents[item[0]][0]))
+        return [pk for pk, _ in ranked]
+
+
+product_index = ProductSearchIndex()
+
+
+def _postgres_search(queryset, query):
+    from django.contrib.postgres.lookups import TrigramWordSimilar
+    from django.contrib.postgres.search import TrigramWordSimilarity
+    from django.db.models.functions import Greatest
+
+    matches = (
+        Q(TrigramWordSimilar(F('name'), query))
+        | Q(TrigramWordSimilar(F('generic_name'), query))
+        | Q(TrigramWordSimilar(F('barcode'), query))
+    )
+    rank = Greatest(*(TrigramWordSimilarity(query, field) for field, _ in FIELD_WEIGHTS))
+    return queryset.filter(matches).annotate(rank=rank).order_by('-rank', 'name')
+
+
+def _fetch_ranked(queryset, ranked_ids, limit):
+    products = []
+    for start in range(0, len(ranked_ids), FETCH_CHUNK):
+        chunk = ranked_ids[start:start + FETCH_CHUNK]
+        found = queryset.in_bulk(chunk)
+        products.extend(found[pk] for pk in chunk if pk in found)
+        if limit is not None and len(products) >= limit:
+            return products[:limit]
+    return products
+
+
+def search_products(query, queryset=None, limit=20):
+    """
+    Products in ``queryset`` matching ``query``, best first.
+
+    Pass limit=None for every match. Stock and active filters stay on the
+    queryset, so results always reflect the database even when the word index
+    is a few minutes old.
+    """
+    if queryset is None:
+        queryset = Product.objects.filter(is_active=True)
+    query = query.strip()
+    if BARCODE.match(query):
+        exact = list(queryset.filter(barcode=query)[:1])
+        if exact:
+            return exact
+    if connection.vendor == 'postgresql':
+        results = _postgres_search(queryset, query)
+        return list(results if limit is None else results[:limit])
+    return _fetch_ranked(queryset, product_index.search(query), limit)
@@ -0,0 +1,90 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from sales.signals import sale_completed, sale_refunded, sale_edited, sales_paid, sales_cancelled
+from . import dashboard_service
+from .alert_service import refresh_alerts, stock_alerts_changed
+from .barcode_service import barcode_cache
+from .models import Product, StockBatch
+from .search_service import product_index
+
+
+@receiver(post_save, sender=Product)
+def reindex_product(sender, instance, **kwargs):
+    product_index.update(instance)
+    barcode_cache.invalidate(instance)
+    transaction.on_commit(dashboard_service.stock_changed)
+
+
+@receiver(post_save, sender=Product)
+def open_first_batch(sender, instance, created, raw=False, **kwargs):
+    # Stock given to Product.objects.create() goes on the shelf as the product's own lot;
+    # save_product() creates products empty and adds their stock through the ledger
+    if created and not raw and instance.quantity_in_stock:
+        StockBatch.objects.create(
+            product=instance,
+            batch_number=instance.batch_number or '',
+            expiry_date=instance.expiry_date,
+            quantity=instance.quantity_in_stock,
+        )
+
+
+@receiver(post_save, sender=Product)
+def refresh_product_alerts(sender, instance, raw=False, **kwargs):
+    # After open_first_batch, so a new product's first lot is already on the shelf;
+    # also covers minimum level and is_active edits, which don't go through the ledger
+    if not raw:
+        refresh_alerts([instance.pk])
+
+
+@receiver(post_save, sender=StockBatch)
+def refresh_batch_alerts(sender, instance, raw=False, **kwargs):
+    # Batches edited one at a time, e.g. an expiry date corrected in the admin
+    if not raw:
+        refresh_alerts([instance.product_id])
+
+
+@receiver(stock_alerts_changed)
+def refresh_dashboard_alerts(sender, **kwargs):
+    transaction.on_commit(dashboard_service.stock_changed)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    product_index.remove(instance.pk)
+    barcode_cache.invalidate(instance)
+    transaction.on_commit(dashboard_service.stock_changed)
+
+
+# The sale signals fire inside the sale's transaction; only touch the cache once it commits
+
+@receiver(sale_completed)
+def add_sale_to_dashboard(sender, sale, **kwargs):
+    if sale.status == 'paid':
+        transaction.on_commit(lambda: dashboard_service.sale_changed(sale))
+    else:
+        transaction.on_commit(dashboard_service.stock_changed)
+
+
+@receiver(sale_refunded)
+def remove_sale_from_dashboard(sender, sale, **kwargs):
+    transaction.on_commit(lambda: dashboard_service.sale_changed(sale, sign=-1))
+
+
+@receiver(sale_edited)
+def refresh_dashboard_for_sale(sender, sale, **kwargs):
+    transaction.on_commit(lambda: dashboard_service.sale_edited(sale))
+
+
+@receiver(sales_paid)
+def add_paid_sales_to_dashboard(sender, sales, **kwargs):
+    def update():
+        for sale, _ in sales:
+            dashboard_service.sale_changed(sale)
+    transaction.on_commit(update)
+
+
+@receiver(sales_cancelled)
+def restock_dashboard(sender, **kwargs):
+    transaction.on_commit(dashboard_service.stock_changed)
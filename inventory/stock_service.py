@@ -0,0 +1,267 @@
+from datetime import datetime, timezone as dt_timezone
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import Case, When, Value, F, Q, Sum, IntegerField, OuterRef, Subquery, Window
+from django.db.models.functions import Coalesce, RowNumber
+from django.utils import timezone
+
+from .alert_service import refresh_alerts
+from .models import Product, StockBatch, StockMovement, StockSnapshot
+
+# Lower bound for products that have no snapshot yet: their whole (short) ledger is replayed
+LEDGER_START = datetime(2000, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class InsufficientStock(ValueError):
+    """Raised when a stock decrement would take a product below zero"""
+
+
+def lock_products(product_ids, **filters):
+    """
+    Lock product rows for the rest of the transaction and return {pk: product}.
+
+    Rows are always locked in primary key order so two tills selling
+    overlapping baskets cannot deadlock each other.
+    """
+    products = (
+        Product.objects.select_for_update()
+        .filter(pk__in=product_ids, **filters)
+        .order_by('pk')
+    )
+    return {product.pk: product for product in products}
+
+
+def record_movements(deltas, movement_type, reference=''):
+    """Append one StockMovement per product in {product_id: signed quantity}"""
+    now = timezone.now()
+    StockMovement.objects.bulk_create([
+        StockMovement(
+            product_id=pk,
+            movement_type=movement_type,
+            quantity=qty,
+            reference=reference,
+            timestamp=now,
+        )
+        for pk, qty in deltas.items() if qty
+    ])
+
+
+def apply_stock_changes(deltas, movement_type, reference=''):
+    """
+    Apply {product_id: signed quantity} to quantity_in_stock in one UPDATE
+    and append the matching rows to the stock ledger.
+
+    The arithmetic runs in the database (F expressions), so concurrent
+    workers never overwrite each other's changes. Decrements only match rows
+    that still hold enough stock; if any row is missed the caller's
+    transaction must be rolled back, so InsufficientStock is raised. The
+    products' stock alerts are refreshed in the same transaction.
+    """
+    deltas = {pk: qty for pk, qty in deltas.items() if qty}
+    if not deltas:
+        return 0
+
+    change = Case(
+        *[When(pk=pk, then=Value(qty)) for pk, qty in deltas.items()],
+        output_field=IntegerField(),
+    )
+    matches = reduce(or_, [
+        Q(pk=pk, quantity_in_stock__gte=-qty) if qty < 0 else Q(pk=pk)
+        for pk, qty in deltas.items()
+    ])
+    updated = Product.objects.filter(matches).update(
+        quantity_in_stock=F('quantity_in_stock') + change,
+        updated_at=timezone.now(),
+    )
+    if updated != len(deltas):
+        raise InsufficientStock('Stock changed while processing, please try again')
+    # The UPDATE above holds the product rows until commit, so their batches
+    # are only ever allocated by one transaction at a time
+    take_from_batches({pk: -qty for pk, qty in deltas.items() if qty < 0})
+    return_to_batches({pk: qty for pk, qty in deltas.items() if qty > 0})
+    record_movements(deltas, movement_type, reference)
+    refresh_alerts(deltas)
+    return updated
+
+
+def _fefo_order():
+    return [F('expiry_date').asc(nulls_last=True), F('id').asc()]
+
+
+def _per_product(values):
+    return Case(
+        *[When(product_id=pk, then=Value(value)) for pk, value in values.items()],
+        output_field=IntegerField(),
+    )
+
+
+def _per_batch(values):
+    return Case(
+        *[When(pk=pk, then=Value(value)) for pk, value in values.items()],
+        output_field=IntegerField(),
+    )
+
+
+def take_from_batches(demand, today=None):
+    """
+    Take {product_id: quantity} out of the products' unexpired batches,
+    earliest expiry first, with one SELECT and one UPDATE.
+
+    A running total over each product's batches in FEFO order picks out
+    the batches the demand reaches. Returns {batch_id: quantity taken}.
+    Raises InsufficientStock if unexpired batches can't cover a product,
+    unless the rest is stock that was never put in a batch.
+    """
+    if not demand:
+        return {}
+    today = today or timezone.localdate()
+    reached = (
+        StockBatch.objects.filter(product_id__in=list(demand), quantity__gt=0)
+        .exclude(expiry_date__lt=today)
+        .annotate(stocked_through=Window(Sum('quantity'), partition_by=[F('product_id')], order_by=_fefo_order()))
+        .annotate(stocked_before=F('stocked_through') - F('quantity'), wanted=_per_product(demand))
+        .filter(stocked_before__lt=F('wanted'))
+        .values_list('pk', 'product_id', 'quantity', 'stocked_before', 'wanted')
+    )
+    taken = {}
+    short = dict(demand)
+    for pk, product_id, quantity, stocked_before, wanted in reached:
+        taken[pk] = min(quantity, wanted - stocked_before)
+        short[product_id] -= taken[pk]
+    short = {pk: qty for pk, qty in short.items() if qty > 0}
+    if short:
+        _check_unbatched_stock(short, demand)
+    if taken:
+        StockBatch.objects.filter(pk__in=list(taken)).update(quantity=F('quantity') - _per_batch(taken))
+    return taken
+
+
+def _check_unbatched_stock(short, demand):
+    # Products created with bulk_create have stock that isn't in any batch; it
+    # can cover what the batches can't. Expired batches never do.
+    batched = dict(
+        StockBatch.objects.filter(product_id__in=list(short)).order_by()
+        .values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total')
+    )
+    products = Product.objects.filter(pk__in=list(short)).values_list('pk', 'name', 'quantity_in_stock')
+    for pk, name, remaining in products:
+        unbatched = remaining + demand[pk] - batched.get(pk, 0)
+        if short[pk] > unbatched:
+            raise InsufficientStock(f'Not enough unexpired stock of {name}')
+
+
+def return_to_batches(additions, today=None):
+    """
+    Put {product_id: quantity} back on the shelf (refunds, cancelled sales,
+    stock take surpluses).
+
+    Units go into the product's unexpired batch that expires first, so
+    returned stock never looks fresher than the lot it most likely came
+    from. A product with no such batch gets a new one with the product's
+    own lot details.
+    """
+    if not additions:
+        return
+    today = today or timezone.localdate()
+    targets = dict(
+        StockBatch.objects.filter(product_id__in=list(additions))
+        .exclude(expiry_date__lt=today)
+        .annotate(rank=Window(RowNumber(), partition_by=[F('product_id')], order_by=_fefo_order()))
+        .filter(rank=1)
+        .values_list('product_id', 'pk')
+    )
+    if targets:
+        StockBatch.objects.filter(pk__in=list(targets.values())).update(
+            quantity=F('quantity') + _per_batch({targets[pk]: additions[pk] for pk in targets})
+        )
+    missing = [pk for pk in additions if pk not in targets]
+    StockBatch.objects.bulk_create([
+        StockBatch(product_id=pk, batch_number=batch_number or '', expiry_date=expiry_date, quantity=additions[pk])
+        for pk, batch_number, expiry_date in Product.objects.filter(pk__in=missing).values_list(
+            'pk', 'batch_number', 'expiry_date'
+        )
+    ])
+
+
+def set_stock_level(product, quantity, reference='Manual adjustment'):
+    """Move a product to an absolute stock count (stock take), recording the difference"""
+    with transaction.atomic():
+        current = lock_products([product.pk])[product.pk].quantity_in_stock
+        if quantity != current:
+            apply_stock_changes({product.pk: quantity - current}, 'adjustment', reference)
+        product.quantity_in_stock = quantity
+
+
+def save_product(product, reference='Manual adjustment'):
+    """
+    Save a product edited through a form or the admin.
+
+    Every other field is saved as usual, but a changed stock count is
+    applied as an adjustment against the locked database value so the
+    ledger stays complete and concurrent sales are not overwritten.
+    """
+    with transaction.atomic():
+        target = product.quantity_in_stock
+        if product.pk:
+            product.quantity_in_stock = lock_products([product.pk])[product.pk].quantity_in_stock
+        else:
+            product.quantity_in_stock = 0
+        product.save()
+        set_stock_level(product, target, reference)
+    return product
+
+
+def take_snapshots(taken_at=None, batch_size=1000):
+    """
+    Store the current stock level of every product; returns the number of snapshots.
+
+    Each batch of products is locked (in primary key order, as lock_products
+    does) before it is read and stamped. A sale or receipt updates the product
+    row before stamping its StockMovement, so any change still in flight is
+    committed before the snapshot reads it, and any change that waited on the
+    lock is stamped after the snapshot. No movement is counted twice or lost.
+    """
+    count = 0
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            levels = list(
+                Product.objects.select_for_update().filter(pk__gt=last_pk)
+                .order_by('pk').values_list('pk', 'quantity_in_stock')[:batch_size]
+            )
+            if not levels:
+                return count
+            stamp = taken_at or timezone.now()
+            StockSnapshot.objects.bulk_create([
+                StockSnapshot(product_id=pk, quantity=quantity, taken_at=stamp)
+                for pk, quantity in levels
+            ])
+        count += len(levels)
+        last_pk = levels[-1][0]
+
+
+def with_stock_at(queryset, when):
+    """
+    Annotate products with ``stock_at``: their stock level at ``when``.
+
+    Each product starts from its latest snapshot at or before ``when`` and
+    only the ledger rows between that snapshot and ``when`` are summed, so
+    the cost depends on the snapshot interval rather than on total history.
+    """
+    latest = StockSnapshot.objects.filter(
+        product=OuterRef('pk'), taken_at__lte=when
+    ).order_by('-taken_at')
+    delta = StockMovement.objects.filter(
+        product=OuterRef('pk'),
+        timestamp__gt=OuterRef('snapshot_at'),
+        timestamp__lte=when,
+    ).values('product').annotate(total=Sum('quantity')).values('total')
+
+    return queryset.annotate(
+        snapshot_at=Coalesce(Subquery(latest.values('taken_at')[:1]), Value(LEDGER_START)),
+        snapshot_quantity=Coalesce(Subquery(latest.values('quantity')[:1]), Value(0)),
+    ).annotate(
+        stock_at=F('snapshot_quantity') + Coalesce(Subquery(delta), Value(0)),
+    )
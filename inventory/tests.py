@@ -1,3 +1,1084 @@
-from django.test import TestCase
+import math
+import os
+import time
+from datetime import timedelta
+from decimal import Decimal
+from importlib import import_module
+from io import BytesIO, StringIO
+from statistics import median
+from tempfile import TemporaryDirectory
+from unittest import skipIf
+from unittest.mock import patch
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.db import connection
+from django.utils import timezone
+
+from pharmacy.query_plans import full_table_scans
+from reports.models import DailySalesRollup
+from sales.checkout_service import CheckoutError, checkout
+from .models import (
+    AlertState, Category, PriceChange, Supplier, Product, Purchase, PurchaseItem, StockBatch, StockMovement,
+    StockSnapshot,
+)
+from .alert_service import refresh_alerts, stock_alerts_changed
+from .barcode_service import BarcodeCache, barcode_cache
+from .catalogue_file_service import CatalogueImportError, export_catalogue_csv, import_catalogue, openpyxl
+from .dashboard_service import dashboard_metrics
+from .pricing_service import PriceRuleError, apply_price_rule, price_preview, price_rule, price_scope
+from .purchase_service import PurchaseError, receive_draft, receive_purchase
+from .reorder_service import apply_reorder_levels, demand_forecast, draft_purchase_orders, reorder_suggestions
+from .search_service import product_index, search_products
+from .stock_service import InsufficientStock, apply_stock_changes, save_product, take_snapshots, with_stock_at
+
+
+class StockLedgerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass')
+        self.supplier = Supplier.objects.create(
+            name='Supplier', contact_person='Contact', phone='0700000000', address='Eldoret'
+        )
+        self.product = Product.objects.create(
+            name='Paracetamol',
+            category=Category.objects.create(name='Analgesics'),
+            supplier=self.supplier,
+            cost_price=Decimal('5.00'),
+            selling_price=Decimal('10.00'),
+            quantity_in_stock=0,
+        )
+
+    def _stock_at(self, when):
+        return with_stock_at(Product.objects.filter(pk=self.product.pk), when).get().stock_at
+
+    def test_every_stock_change_is_recorded(self):
+        purchase = Purchase.objects.create(supplier=self.supplier, invoice_number='INV-1', created_by=self.user)
+        PurchaseItem.objects.create(purchase=purchase, product=self.product, quantity=20, unit_cost=Decimal('5.00'))
+        sale, _ = checkout(self.user, [{'id': self.product.id, 'quantity': 3}])
+        self.product.refresh_from_db()
+        self.product.quantity_in_stock = 15
+        save_product(self.product)
+
+        movements = list(
+            StockMovement.objects.filter(product=self.product)
+            .order_by('id').values_list('movement_type', 'quantity')
+        )
+        self.assertEqual(movements, [('purchase', 20), ('sale', -3), ('adjustment', -2)])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity_in_stock, 15)
+
+    def test_historical_stock_is_snapshot_plus_delta(self):
+        start = timezone.now() - timedelta(days=10)
+        StockSnapshot.objects.create(product=self.product, quantity=40, taken_at=start)
+        StockMovement.objects.create(product=self.product, movement_type='sale', quantity=-5,
+                                     timestamp=start + timedelta(days=1))
+        StockMovement.objects.create(product=self.product, movement_type='purchase', quantity=10,
+                                     timestamp=start + timedelta(days=3))
+        # Movements before the latest snapshot must not be replayed
+        StockMovement.objects.create(product=self.product, movement_type='sale', quantity=-100,
+                                     timestamp=start - timedelta(days=1))
+
+        self.assertEqual(self._stock_at(start + timedelta(days=2)), 35)
+        self.assertEqual(self._stock_at(start + timedelta(days=4)), 45)
+
+        StockSnapshot.objects.create(product=self.product, quantity=44, taken_at=start + timedelta(days=5))
+        self.assertEqual(self._stock_at(start + timedelta(days=6)), 44)
+
+    def test_stock_report_values_stock_as_of_a_past_day(self):
+        StockSnapshot.objects.create(product=self.product, quantity=4,
+                                     taken_at=timezone.now() - timedelta(days=3))
+        self.client.force_login(self.user)
+        as_of = (timezone.localdate() - timedelta(days=1)).isoformat()
+        response = self.client.get('/reports/stock/', {'as_of': as_of})
+        self.assertEqual(response.context['total_stock_value']['cost_value'], Decimal('20.00'))
+
+    def test_stock_report_falls_back_to_current_stock_for_a_bad_date(self):
+        Product.objects.filter(pk=self.product.pk).update(quantity_in_stock=10)
+        self.client.force_login(self.user)
+        for as_of in ['yesterday', '2024-02-30', '0001-01-01', '9999-12-31']:
+            response = self.client.get('/reports/stock/', {'as_of': as_of})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['as_of'], '')
+            self.assertEqual(response.context['total_stock_value']['cost_value'], Decimal('50.00'))
+        self.assertContains(self.client.get('/reports/stock/', {'as_of': 'yesterday'}), 'not a valid date')
+
+    def test_take_snapshots_records_current_levels(self):
+        Product.objects.filter(pk=self.product.pk).update(quantity_in_stock=7)
+        self.assertEqual(take_snapshots(), 1)
+        self.assertEqual(self._stock_at(timezone.now()), 7)
+
+    def test_take_snapshots_counts_movements_around_each_batch(self):
+        others = Product.objects.bulk_create([
+            Product(name=f'Other {i}', category=self.product.category, supplier=self.supplier, cost_price=Decimal('5.00'),
+                    selling_price=Decimal('10.00'), quantity_in_stock=3)
+            for i in range(2)
+        ])
+        Product.objects.filter(pk=self.product.pk).update(quantity_in_stock=7)
+        self.assertEqual(take_snapshots(batch_size=1), 3)
+        self.assertEqual(StockSnapshot.objects.count(), 3)
+        apply_stock_changes({self.product.pk: -2, others[0].pk: 4}, 'adjustment')
+        levels = dict(with_stock_at(Product.objects.all(), timezone.now()).values_list('pk', 'stock_at'))
+        self.assertEqual(levels, {self.product.pk: 5, others[0].pk: 7, others[1].pk: 3})
+
+
+class PurchaseReceivingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass', is_staff=True, is_superuser=True)
+        self.supplier = Supplier.objects.create(
+            name='Supplier', contact_person='Contact', phone='0700000000', address='Eldoret'
+        )
+        category = Category.objects.create(name='Analgesics')
+        self.products = Product.objects.bulk_create([
+            Product(name=f'Product {i}', category=category, supplier=self.supplier,
+                    cost_price=Decimal('5.00'), selling_price=Decimal('10.00'), quantity_in_stock=10)
+            for i in range(200)
+        ])
+
+    def _purchase(self, invoice_number='INV-1'):
+        return Purchase(supplier=self.supplier, invoice_number=invoice_number, created_by=self.user)
+
+    def _receive(self, count, invoice_number):
+        lines = [
+            {'product': product, 'quantity': 3, 'unit_cost': Decimal('4.50')}
+            for product in self.products[:count]
+        ]
+        with CaptureQueriesContext(connection) as ctx:
+            purchase = receive_purchase(self._purchase(invoice_number), lines)
+        return purchase, len(ctx)
+
+    def test_query_count_does_not_grow_with_the_invoice(self):
+        _, small = self._receive(2, 'INV-1')
+        purchase, large = self._receive(200, 'INV-2')
+        # SQLite splits the bulk inserts at its 999 parameter limit; nothing is per line
+        self.assertLessEqual(large, small + 3)
+
+        purchase.refresh_from_db()
+        self.assertEqual(purchase.total_amount, Decimal('2700.00'))
+        self.assertEqual(purchase.items.count(), 200)
+        product = Product.objects.get(pk=self.products[150].pk)
+        self.assertEqual((product.quantity_in_stock, product.cost_price), (13, Decimal('4.50')))
+        self.assertEqual(
+            StockMovement.objects.filter(reference='Purchase #INV-2', movement_type='purchase').count(), 200
+        )
+
+    def test_repeated_product_adds_up_and_takes_the_last_cost(self):
+        product = self.products[0]
+        receive_purchase(self._purchase(), [
+            {'product_id': product.pk, 'quantity': 5, 'unit_cost': '4.00'},
+            {'product_id': product.pk, 'quantity': 7, 'unit_cost': '6.00'},
+        ])
+        product.refresh_from_db()
+        self.assertEqual((product.quantity_in_stock, product.cost_price), (22, Decimal('6.00')))
+        self.assertEqual(StockMovement.objects.get(product=product).quantity, 12)
+
+    def test_invalid_lines_write_nothing(self):
+        with self.assertRaises(PurchaseError) as raised:
+            receive_purchase(self._purchase(), [
+                {'product': self.products[0], 'quantity': 5, 'unit_cost': '4.00'},
+                {'product': self.products[1], 'quantity': 0, 'unit_cost': '4.00'},
+                {'product_id': 999999, 'quantity': 1, 'unit_cost': '4.00'},
+                {'product': self.products[2], 'quantity': 1, 'unit_cost': 'free'},
+            ])
+        self.assertEqual(len(raised.exception.errors), 3)
+        self.assertFalse(Purchase.objects.exists())
+        self.assertFalse(StockMovement.objects.exists())
+        with self.assertRaises(PurchaseError):
+            receive_purchase(self._purchase(), [])
+
+    def test_single_line_saves_update_the_total_once(self):
+        purchase = self._purchase()
+        purchase.save()
+        item = PurchaseItem.objects.create(
+            purchase=purchase, product=self.products[0], quantity=4, unit_cost=Decimal('5.00')
+        )
+        item.save()
+        purchase.refresh_from_db()
+        self.assertEqual(purchase.total_amount, Decimal('20.00'))
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).quantity_in_stock, 14)
+
+    def test_admin_receives_the_invoice_in_one_go(self):
+        self.client.force_login(self.user)
+        data = {
+            'supplier': self.supplier.pk, 'invoice_number': 'INV-9', 'notes': '',
+            'items-TOTAL_FORMS': 2, 'items-INITIAL_FORMS': 0,
+            'items-MIN_NUM_FORMS': 0, 'items-MAX_NUM_FORMS': 1000,
+        }
+        for i, product in enumerate(self.products[:2]):
+            data.update({f'items-{i}-product': product.pk, f'items-{i}-quantity': 2, f'items-{i}-unit_cost': '4.00'})
+        response = self.client.post('/admin/inventory/purchase/add/', data)
+        self.assertEqual(response.status_code, 302)
+        purchase = Purchase.objects.get(invoice_number='INV-9')
+        self.assertEqual((purchase.total_amount, purchase.created_by), (Decimal('16.00'), self.user))
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).quantity_in_stock, 12)
+
+        # Saving the purchase again leaves its lines and the stock alone
+        response = self.client.post(f'/admin/inventory/purchase/{purchase.pk}/change/', {
+            'notes': 'Checked', 'items-TOTAL_FORMS': 2, 'items-INITIAL_FORMS': 2,
+            'items-MIN_NUM_FORMS': 0, 'items-MAX_NUM_FORMS': 1000,
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).quantity_in_stock, 12)
+
+    def test_admin_rejects_an_empty_invoice(self):
+        self.client.force_login(self.user)
+        response = self.client.post('/admin/inventory/purchase/add/', {
+            'supplier': self.supplier.pk, 'invoice_number': 'INV-9', 'notes': '',
+            'items-TOTAL_FORMS': 0, 'items-INITIAL_FORMS': 0,
+            'items-MIN_NUM_FORMS': 0, 'items-MAX_NUM_FORMS': 1000,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Purchase.objects.exists())
+
+    def test_admin_reports_lines_receive_purchase_would_refuse(self):
+        self.client.force_login(self.user)
+        response = self.client.post('/admin/inventory/purchase/add/', {
+            'supplier': self.supplier.pk, 'invoice_number': 'INV-9', 'notes': '',
+            'items-TOTAL_FORMS': 1, 'items-INITIAL_FORMS': 0,
+            'items-MIN_NUM_FORMS': 0, 'items-MAX_NUM_FORMS': 1000,
+            'items-0-product': self.products[0].pk, 'items-0-quantity': 2, 'items-0-unit_cost': '99999999.99',
+        })
+        self.assertContains(response, 'Line 1: unit cost is out of range')
+        self.assertFalse(Purchase.objects.exists())
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).quantity_in_stock, 10)
+
+
+class StockBatchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass', is_superuser=True)
+        self.supplier = Supplier.objects.create(
+            name='Supplier', contact_person='Contact', phone='0700000000', address='Eldoret'
+        )
+        self.category = Category.objects.create(name='Analgesics')
+        self.product = Product.objects.create(
+            name='Amoxicillin', category=self.category, supplier=self.supplier,
+            cost_price=Decimal('5.00'), selling_price=Decimal('10.00'), quantity_in_stock=0,
+        )
+        today = timezone.localdate()
+        self.expired, self.soon, self.later, self.undated = StockBatch.objects.bulk_create([
+            StockBatch(product=self.product, batch_number='A', expiry_date=today - timedelta(days=1), quantity=4),
+            StockBatch(product=self.product, batch_number='B', expiry_date=today + timedelta(days=10), quantity=5),
+            StockBatch(product=self.product, batch_number='C', expiry_date=today + timedelta(days=60), quantity=10),
+            StockBatch(product=self.product, batch_number='D', quantity=20),
+        ])
+        Product.objects.filter(pk=self.product.pk).update(quantity_in_stock=39)
+
+    def _quantities(self):
+        return dict(StockBatch.objects.filter(product=self.product).values_list('batch_number', 'quantity'))
+
+    def test_sales_take_the_first_expiring_unexpired_batches_in_one_query(self):
+        with CaptureQueriesContext(connection) as ctx:
+            checkout(self.user, [{'id': self.product.id, 'quantity': 12}])
+        batch_queries = [q['sql'] for q in ctx.captured_queries if 'inventory_stockbatch' in q['sql']]
+        # One SELECT to allocate and one UPDATE, plus one read for the product's expiry alerts
+        self.assertEqual(len(batch_queries), 3)
+        self.assertEqual(self._quantities(), {'A': 4, 'B': 0, 'C': 3, 'D': 20})
+
+    def test_expired_batches_are_never_sold(self):
+        with self.assertRaisesMessage(CheckoutError, 'Not enough unexpired stock of Amoxicillin'):
+            checkout(self.user, [{'id': self.product.id, 'quantity': 36}])
+        self.assertEqual(self._quantities(), {'A': 4, 'B': 5, 'C': 10, 'D': 20})
+        self.assertEqual(Product.objects.get(pk=self.product.pk).quantity_in_stock, 39)
+
+    def test_refunds_go_back_to_the_first_expiring_unexpired_batch(self):
+        sale, _ = checkout(self.user, [{'id': self.product.id, 'quantity': 7}])
+        self.client.force_login(self.user)
+        self.assertTrue(self.client.post(f'/sales/refund/{sale.pk}/').json()['success'])
+        self.assertEqual(self._quantities(), {'A': 4, 'B': 7, 'C': 8, 'D': 20})
+
+    def test_received_lines_become_batches(self):
+        expiry = timezone.localdate() + timedelta(days=365)
+        purchase = receive_purchase(
+            Purchase(supplier=self.supplier, invoice_number='INV-1', created_by=self.user),
+            [{'product': self.product, 'quantity': 30, 'unit_cost': '4.00',
+              'batch_number': 'E', 'expiry_date': expiry.isoformat()}],
+        )
+        batch = StockBatch.objects.get(batch_number='E')
+        self.assertEqual((batch.quantity, batch.expiry_date, batch.purchase), (30, expiry, purchase))
+
+    def test_stock_without_batches_can_still_be_sold(self):
+        product, = Product.objects.bulk_create([Product(
+            name='Bulk', category=self.category, supplier=self.supplier,
+            cost_price=Decimal('5.00'), selling_price=Decimal('10.00'), quantity_in_stock=5,
+        )])
+        checkout(self.user, [{'id': product.id, 'quantity': 5}])
+        self.assertEqual(Product.objects.get(pk=product.pk).quantity_in_stock, 0)
+
+    def test_new_products_put_their_stock_in_a_batch(self):
+        expiry = timezone.localdate() + timedelta(days=90)
+        product = Product.objects.create(
+            name='Ibuprofen', category=self.category, supplier=self.supplier, batch_number='X1',
+            expiry_date=expiry, cost_price=Decimal('5.00'), selling_price=Decimal('10.00'), quantity_in_stock=8,
+        )
+        self.assertEqual(list(product.batches.values_list('batch_number', 'expiry_date', 'quantity')),
+                         [('X1', expiry, 8)])
+
+    def test_migration_splits_existing_stock_into_a_batch(self):
+        StockBatch.objects.all().delete()
+        migration = import_module('inventory.migrations.0007_stock_batches')
+        migration.split_existing_stock(apps, None)
+        self.assertEqual(list(StockBatch.objects.values_list('product', 'quantity')), [(self.product.pk, 39)])
+
+    def test_expiry_alerts_read_the_batch_expiry_index(self):
+        refresh_alerts()
+        self.client.force_login(self.user)
+        response = self.client.get('/reports/stock/')
+        expired, = response.context['expired']
+        soon, = response.context['expiring_soon']
+        self.assertEqual((expired.product, expired.expiry_date, expired.quantity),
+                         (self.product, self.expired.expiry_date, 4))
+        self.assertEqual((soon.expiry_date, soon.quantity), (self.soon.expiry_date, 5))
+        with CaptureQueriesContext(connection) as ctx:
+            refresh_alerts([self.product.pk])
+        batch_query, = [q['sql'] for q in ctx.captured_queries if 'inventory_stockbatch' in q['sql']]
+        self.assertNotIn('inventory_stockbatch', full_table_scans(batch_query))
+
+
+class StockAlertTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass', is_superuser=True)
+        self.supplier = Supplier.objects.create(
+            name='Supplier', contact_person='Contact', phone='0700000000', address='Eldoret'
+        )
+        self.category = Category.objects.create(name='Analgesics')
+        self.product = Product.objects.create(
+            name='Paracetamol', category=self.category, supplier=self.supplier,
+            cost_price=Decimal('5.00'), selling_price=Decimal('10.00'), quantity_in_stock=12, minimum_stock_level=10,
+        )
+
+    def _alerts(self):
+        return set(AlertState.objects.values_list('product', 'kind'))
+
+    def test_stock_changes_raise_and_clear_low_stock(self):
+        events = []
+
+        def record(sender, raised, cleared, **kwargs):
+            events.append((raised, cleared))
+        stock_alerts_changed.connect(record)
+        self.addCleanup(stock_alerts_changed.disconnect, record)
+
+        sale, _ = checkout(self.user, [{'id': self.product.id, 'quantity': 3}])
+        self.assertEqual(self._alerts(), {(self.product.pk, 'low_stock')})
+        self.assertEqual(events, [([(self.product.pk, 'low_stock')], [])])
+
+        self.client.force_login(self.user)
+        self.assertTrue(self.client.post(f'/sales/refund/{sale.pk}/').json()['success'])
+        self.assertEqual(self._alerts(), set())
+        self.assertEqual(events[-1], ([], [(self.product.pk, 'low_stock')]))
+
+    def test_product_edits_refresh_alerts(self):
+        self.product.minimum_stock_level = 20
+        self.product.save()
+        self.assertEqual(self._alerts(), {(self.product.pk, 'low_stock')})
+        self.product.is_active = False
+        self.product.save()
+        self.assertEqual(self._alerts(), set())
+
+    def test_receiving_stock_clears_low_stock_and_flags_short_dated_lines(self):
+        checkout(self.user, [{'id': self.product.id, 'quantity': 5}])
+        expiry = timezone.localdate() + timedelta(days=20)
+        receive_purchase(
+            Purchase(supplier=self.supplier, invoice_number='INV-1', created_by=self.user),
+            [{'product': self.product, 'quantity': 30, 'unit_cost': '4.00', 'expiry_date': expiry}],
+        )
+        alert = AlertState.objects.get()
+        self.assertEqual((alert.kind, alert.expiry_date, alert.quantity), ('expiring_soon', expiry, 30))
+
+    def test_sweep_moves_alerts_with_the_calendar(self):
+        today = timezone.localdate()
+        StockBatch.objects.create(product=self.product, expiry_date=today + timedelta(days=40), quantity=8)
+        self.assertEqual(self._alerts(), set())
+
+        refresh_alerts(today=today + timedelta(days=15))
+        alert = AlertState.objects.get()
+        self.assertEqual((alert.kind, alert.quantity), ('expiring_soon', 8))
+        raised, cleared = refresh_alerts(today=today + timedelta(days=41))
+        self.assertEqual(raised, [(self.product.pk, 'expired')])
+        self.assertEqual(cleared, [(self.product.pk, 'expiring_soon')])
+
+        out = StringIO()
+        call_command('sweep_stock_alerts', stdout=out)
+        self.assertIn('Raised 0 and cleared 1 stock alerts', out.getvalue())
+        self.assertEqual(self._alerts(), set())
+
+    def test_list_badges_read_prefetched_alerts(self):
+        for i in range(5):
+            Product.objects.create(
+                name=f'Product {i}', category=self.category, supplier=self.supplier,
+                cost_price=Decimal('5.00'), selling_price=Decimal('10.00'), quantity_in_stock=i,
+            )
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/inventory/products/')
+        self.assertEqual(sum('inventory_alertstate' in q['sql'] for q in ctx.captured_queries), 1)
+        self.assertContains(response, 'Low Stock', count=5)
+
+    def test_stock_report_lists_expiry_alerts_once(self):
+        today = timezone.localdate()
+        StockBatch.objects.create(product=self.product, expiry_date=today - timedelta(days=1), quantity=2)
+        StockBatch.objects.create(product=self.product, expiry_date=today + timedelta(days=10), quantity=3)
+        self.client.force_login(self.user)
+        response = self.client.get('/reports/stock/')
+        self.assertContains(response, 'Products With Expired or Soon-Expiring Stock', count=1)
+        self.assertContains(response, '(expired)', count=1)
+        self.assertLess(len(response.content), 100_000)
+
+
+class CatalogueImportTests(TestCase):
+    HEADER = 'barcode,name,category,supplier,cost_price,selling_price,quantity_in_stock,batch_number,expiry_date\n'
+
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass', is_superuser=True, is_staff=True)
+        self.supplier = Supplier.objects.create(
+            name='Dawa Ltd', contact_person='Contact', phone='0700000000', address='Eldoret'
+        )
+        self.category = Category.objects.create(name='Analgesics')
+        self.expiry = timezone.localdate() + timedelta(days=400)
+
+    def _import(self, text, **kwargs):
+        return import_catalogue(BytesIO(text.encode()), 'catalogue.csv', **kwargs)
+
+    def _rows(self, count, start=0, price='10.00'):
+        return ''.join(
+            f'61610{i:07d},Product {i},analgesics,DAWA LTD,5.00,{price},12,LOT{i},{self.expiry}\n'
+            for i in range(start, start + count)
+        )
+
+    def test_new_products_are_created_with_their_stock_on_the_shelf(self):
+        result = self._import(self.HEADER + self._rows(2) + '61619999999,Cough Syrup,Syrups,Dawa Ltd,3,6,,,\n')
+        self.assertEqual((result.created, result.updated, result.error_count), (3, 0, 0))
+        product = Product.objects.get(barcode='616100000001')
+        self.assertEqual((product.category, product.supplier, product.quantity_in_stock), (self.category, self.supplier, 12))
+        self.assertEqual(list(product.batches.values_list('batch_number', 'expiry_date', 'quantity')),
+                         [('LOT1', self.expiry, 12)])
+        self.assertEqual(list(product.stock_movements.values_list('movement_type', 'quantity')), [('adjustment', 12)])
+        # New categories are created; rows without stock start empty
+        syrup = Product.objects.get(barcode='61619999999')
+        self.assertEqual((syrup.category.name, syrup.quantity_in_stock), ('Syrups', 0))
+
+    def test_reimport_updates_in_place_and_records_stock_differences(self):
+        self._import(self.HEADER + self._rows(3))
+        result = self._import(self.HEADER + self._rows(3, price='11.50').replace(',12,', ',20,'))
+        self.assertEqual((result.created, result.updated), (0, 3))
+        self.assertEqual(Product.objects.count(), 3)
+        product = Product.objects.get(barcode='616100000002')
+        self.assertEqual((product.selling_price, product.quantity_in_stock), (Decimal('11.50'), 20))
+        self.assertEqual(sorted(product.stock_movements.values_list('quantity', flat=True)), [8, 12])
+
+    def test_bad_rows_are_reported_and_skipped(self):
+        result = self._import(self.HEADER + self._rows(1) + ''.join([
+            '616100000000,Duplicate,Analgesics,Dawa Ltd,5,10,1,,\n',
+            '616100000002,,Analgesics,Dawa Ltd,5,10,1,,\n',
+            '616100000003,Priceless,Analgesics,Dawa Ltd,free,10,1,,\n',
+            '616100000004,Orphan,Analgesics,Nobody,5,10,1,,\n',
+            '616100000005,Fraction,Analgesics,Dawa Ltd,5,10,1.5,,\n',
+            '616100000006,Good,Analgesics,Dawa Ltd,5,10,1,,2027-13-01\n',
+        ]))
+        self.assertEqual((result.created, result.error_count), (1, 6))
+        self.assertEqual(result.errors, [
+            (3, 'barcode 616100000000 is already on line 2'),
+            (4, 'name is required'),
+            (5, 'cost_price must be a number'),
+            (6, "no supplier named 'Nobody'"),
+            (7, 'quantity_in_stock must be a whole number'),
+            (8, 'expiry_date must be YYYY-MM-DD'),
+        ])
+
+    def test_non_finite_and_huge_counts_are_row_errors(self):
+        result = self._import(self.HEADER + self._rows(1) + ''.join([
+            '616100000002,Infinite,Analgesics,Dawa Ltd,5,10,inf,,\n',
+            '616100000003,Missing,Analgesics,Dawa Ltd,5,10,NaN,,\n',
+            '616100000004,Huge,Analgesics,Dawa Ltd,5,10,1e20,,\n',
+        ]))
+        self.assertEqual((result.created, result.error_count), (1, 3))
+        self.assertEqual(result.errors, [
+            (3, 'quantity_in_stock must be a whole number'),
+            (4, 'quantity_in_stock must be a whole number'),
+            (5, 'quantity_in_stock is out of range'),
+        ])
+
+    def test_a_failed_chunk_leaves_no_new_categories(self):
+        with patch('inventory.catalogue_file_service.apply_stock_changes',
+                   side_effect=InsufficientStock('Stock changed while processing, please try again')):
+            result = self._import(self.HEADER + '1234,New,Vitamins,Dawa Ltd,5,10,3,,\n')
+        self.assertEqual((result.created, result.error_count), (0, 1))
+        self.assertFalse(Category.objects.filter(name='Vitamins').exists())
+        # Names differing only in case share one new category
+        result = self._import(self.HEADER + '1234,New,Vitamins,Dawa Ltd,5,10,3,,\n1235,Other,VITAMINS,Dawa Ltd,5,10,3,,\n')
+        self.assertEqual(result.created, 2)
+        self.assertEqual(Category.objects.filter(name__iexact='vitamins').count(), 1)
+
+    def test_unknown_categories_can_be_rejected(self):
+        result = self._import(self.HEADER + '1234,New,Vitamins,Dawa Ltd,5,10,,,\n', create_categories=False)
+        self.assertEqual(result.errors, [(2, "no category named 'Vitamins'")])
+        self.assertFalse(Category.objects.filter(name='Vitamins').exists())
+
+    def test_files_without_required_columns_are_refused(self):
+        with self.assertRaisesMessage(CatalogueImportError, 'The file has no supplier column'):
+            self._import('barcode,name,category,cost_price,selling_price\n1,A,B,1,2\n')
+        result = self._import('barcode,name,category,cost_price,selling_price\n1,A,B,1,2\n', default_supplier='dawa ltd')
+        self.assertEqual(result.created, 1)
+
+    @skipIf(openpyxl is not None, 'openpyxl is installed')
+    def test_xlsx_needs_openpyxl(self):
+        with self.assertRaisesMessage(CatalogueImportError, 'openpyxl'):
+            import_catalogue(BytesIO(b'PK'), 'catalogue.xlsx')
+
+    def test_rows_are_upserted_in_batches(self):
+        def queries(rows, start):
+            with CaptureQueriesContext(connection) as ctx:
+                self._import(self.HEADER + self._rows(rows, start=start), chunk_size=100)
+            return len(ctx.captured_queries)
+        # SQLite splits an insert past 999 parameters, so allow a statement or two more
+        self.assertLessEqual(queries(60, 0), queries(10, 100) + 2)
+        self.assertLessEqual(queries(200, 200), queries(100, 400) * 2)
+
+    def test_export_round_trips(self):
+        self._import(self.HEADER + self._rows(3))
+        exported = ''.join(export_catalogue_csv())
+        self.assertTrue(exported.startswith('barcode,name,generic_name,category,supplier,'))
+        result = self._import(exported)
+        self.assertEqual((result.created, result.updated, result.error_count), (0, 3, 0))
+        self.assertEqual(StockMovement.objects.count(), 3)
+
+    def test_admin_import_and_export(self):
+        self.client.force_login(self.user)
+        upload = SimpleUploadedFile('prices.csv', (self.HEADER + self._rows(2) + 'x,,,,,,,,\n').encode())
+        response = self.client.post('/admin/inventory/product/import/', {'file': upload, 'create_categories': 'on'})
+        self.assertContains(response, 'Created 2 and updated 0 products')
+        self.assertContains(response, 'name is required')
+
+        response = self.client.post('/admin/inventory/product/', {
+            'action': 'export_catalogue', '_selected_action': list(Product.objects.values_list('pk', flat=True)),
+        })
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 3)
+
+    def test_commands(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'prices.csv')
+        with open(path, 'w') as target:
+            target.write(self.HEADER + self._rows(2))
+        out = StringIO()
+        call_command('import_catalogue', path, stdout=out, stderr=StringIO())
+        self.assertIn('Created 2 and updated 0 products', out.getvalue())
+        out = StringIO()
+        call_command('export_catalogue', stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+
+class BulkPriceUpdateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass', is_superuser=True, is_staff=True)
+        self.supplier = Supplier.objects.create(
+            name='Dawa Ltd', contact_person='Contact', phone='0700000000', address='Eldoret'
+        )
+        self.other_supplier = Supplier.objects.create(
+            name='Other Ltd', contact_person='Contact', phone='0700000001', address='Nakuru'
+        )
+        self.category = Category.objects.create(name='Analgesics')
+        self.syrups = Category.objects.create(name='Syrups')
+        self.panadol = self._product('Panadol', '1001', '10.00', '12.00')
+        self.brufen = self._product('Brufen', '1002', '5.00', '5.50')
+        self.syrup = self._product('Cough Syrup', '1003', '20.00', '30.00', category=self.syrups)
+        self.other = self._product('Aspirin', '1004', '2.00', '3.00', supplier=self.other_supplier)
+
+    def _product(self, name, barcode, cost, price, category=None, supplier=None):
+        return Product.objects.create(
+            name=name, barcode=barcode, category=category or self.category, supplier=supplier or self.supplier,
+            cost_price=Decimal(cost), selling_price=Decimal(price), quantity_in_stock=10,
+        )
+
+    def _prices(self):
+        return dict(Product.objects.values_list('barcode', 'selling_price'))
+
+    def test_markup_rounds_up_to_the_step(self):
+        # 5.50 * 1.1 is 6.0500000001 in floating point; it must still round to 6.05
+        preview = price_preview(price_scope(self.category), price_rule('markup', 10, '0.05', 'up'))
+        self.assertEqual([(row['barcode'], row['new_price']) for row in preview.rows],
+                         [('1004', Decimal('3.30')), ('1002', Decimal('6.05')), ('1001', Decimal('13.20'))])
+        self.assertEqual(preview.summary['products'], 3)
+        self.assertEqual(preview.summary['changed'], 3)
+        # Margins come from the same calculation as Product.profit_margin
+        panadol = preview.rows[2]
+        self.assertEqual((panadol['old_margin'], panadol['new_margin']), (self.panadol.profit_margin, Decimal('32')))
+        # A preview writes nothing
+        self.assertEqual(self._prices()['1001'], Decimal('12.00'))
+
+    def test_cost_plus_margin_scoped_by_category_and_supplier(self):
+        products = price_scope(self.category, self.supplier)
+        preview = price_preview(products, price_rule('cost_plus', 25, '0.50', 'nearest'))
+        self.assertEqual({row['barcode']: row['new_price'] for row in preview.rows},
+                         {'1001': Decimal('12.50'), '1002': Decimal('6.50')})
+        self.assertEqual(preview.summary['below_cost'], 0)
+
+    def test_apply_records_history_and_updates_in_one_statement(self):
+        rule = price_rule('markup', 10, '0.50', 'up')
+        with CaptureQueriesContext(connection) as queries:
+            count = apply_price_rule(price_scope(self.category), rule, changed_by=self.user)
+        self.assertEqual(count, 3)
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "inventory_product"')]
+        self.assertEqual(len(updates), 1)
+        prices = self._prices()
+        self.assertEqual((prices['1001'], prices['1002'], prices['1003']),
+                         (Decimal('13.50'), Decimal('6.50'), Decimal('30.00')))
+        change = PriceChange.objects.get(product=self.panadol)
+        self.assertEqual((change.old_price, change.new_price, change.changed_by), (Decimal('12.00'), Decimal('13.50'), self.user))
+        self.assertEqual(change.rule, 'Selling price +10%, rounded up to 0.50')
+        # Applying the same rule to prices already on a step changes nothing
+        self.assertEqual(apply_price_rule(price_scope(self.category), price_rule('markup', 0, '0.50', 'up')), 0)
+        self.assertEqual(PriceChange.objects.count(), 3)
+
+    def test_prices_below_cost_are_refused_unless_allowed(self):
+        rule = price_rule('markup', -50)
+        with self.assertRaises(PriceRuleError) as raised:
+            apply_price_rule(price_scope(), rule)
+        self.assertEqual(len(raised.exception.errors), 4)
+        self.assertEqual(self._prices()['1001'], Decimal('12.00'))
+        self.assertFalse(PriceChange.objects.exists())
+
+        allowed = rule._replace(allow_below_cost=True)
+        self.assertEqual(apply_price_rule(price_scope(), allowed), 4)
+        self.assertEqual(self._prices()['1001'], Decimal('6.00'))
+
+    def test_invalid_rules_are_rejected(self):
+        for args in [
+            ('discount', 10), ('markup', -100), ('markup', 10, '-1'), ('markup', 10, '1', 'sideways'),
+            ('markup', 'ten'), ('markup', 'inf'), ('markup', 'NaN'), ('markup', 10, 'half'), ('markup', 10, 'Infinity'),
+        ]:
+            with self.assertRaises(PriceRuleError):
+                price_rule(*args)
+
+    def test_view_previews_then_applies(self):
+        self.client.force_login(self.user)
+        url = reverse('inventory:bulk_price_update')
+        data = {'category': self.syrups.pk, 'method': 'cost_plus', 'percent': '60', 'step': '1', 'direction': 'down'}
+        response = self.client.post(url, {**data, 'preview': ''})
+        self.assertContains(response, 'KES 32.00')
+        self.assertEqual(self._prices()['1003'], Decimal('30.00'))
+
+        response = self.client.post(url, {**data, 'apply': ''})
+        self.assertRedirects(response, reverse('inventory:product_list'))
+        self.assertEqual(self._prices()['1003'], Decimal('32.00'))
+
+    def test_view_needs_change_product_permission(self):
+        cashier = User.objects.create_user('cashier', password='pass')
+        self.client.force_login(cashier)
+        response = self.client.get(reverse('inventory:bulk_price_update'))
+        self.assertEqual(response.status_code, 403)
+
+
+class ReorderEngineTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass', is_superuser=True)
+        self.category = Category.objects.create(name='Analgesics')
+        self.suppliers = [
+            Supplier.objects.create(
+                name=f'Supplier {i}', contact_person='Contact', phone='0700000000', address='Eldoret',
+                lead_time_days=lead_time,
+            )
+            for i, lead_time in enumerate([7, 4])
+        ]
+        self.steady, self.recent, self.idle = [
+            Product.objects.create(
+                name=name, category=self.category, supplier=supplier,
+                cost_price=Decimal('5.00'), selling_price=Decimal('10.00'), quantity_in_stock=stock,
+            )
+            for name, supplier, stock in [
+                ('Steady', self.suppliers[0], 20), ('Recent', self.suppliers[1], 100), ('Idle', self.suppliers[0], 3),
+            ]
+        ]
+        self.today = timezone.localdate()
+
+    def _sell_daily(self, product, days, **quantities):
+        DailySalesRollup.objects.bulk_create([
+            DailySalesRollup(
+                day=self.today - timedelta(days=age), payment_method=method, category=self.category,
+                product=product, quantity=quantity, revenue=quantity * 10, cost=quantity * 5,
+            )
+            for age in range(1, days + 1) for method, quantity in quantities.items()
+        ])
+
+    def test_steady_demand_sets_lead_time_level_and_order_quantity(self):
+        self._sell_daily(self.steady, 365, cash=3, mpesa=2)
+        forecast = demand_forecast(today=self.today)
+        self.assertAlmostEqual(forecast[self.steady.pk][0], 5)
+        self.assertAlmostEqual(forecast[self.steady.pk][1], 0)
+        self.assertNotIn(self.idle.pk, forecast)
+
+        suggestion, = reorder_suggestions(forecast)
+        # 7 days of lead time at 5 a day, then ordered up to that plus 14 days of demand
+        self.assertEqual((suggestion.reorder_level, suggestion.order_quantity), (35, 35 + 70 - 20))
+
+    def test_smoothing_follows_recent_demand_and_variable_demand_adds_safety_stock(self):
+        self._sell_daily(self.recent, 7, cash=28)
+        ewma = demand_forecast(today=self.today)[self.recent.pk]
+        moving = demand_forecast(method='sma', window=28, today=self.today)[self.recent.pk]
+        self.assertAlmostEqual(moving[0], 7)
+        self.assertGreater(ewma[0], moving[0])
+
+        suggestion, = reorder_suggestions({self.recent.pk: moving})
+        # 4 days at 7 a day, plus 1.65 standard deviations of 4 days' demand
+        self.assertEqual(suggestion.reorder_level, math.ceil(28 + 1.65 * moving[1] * 2))
+        self.assertEqual(suggestion.order_quantity, 0)
+
+    def test_applied_levels_drive_low_stock_alerts(self):
+        self._sell_daily(self.steady, 30, cash=5)
+        with self.captureOnCommitCallbacks(execute=True):
+            changed = apply_reorder_levels(reorder_suggestions(demand_forecast(30, today=self.today)))
+        self.assertEqual(changed, 1)
+        levels = dict(Product.objects.values_list('name', 'minimum_stock_level'))
+        self.assertEqual(levels, {'Steady': 35, 'Recent': 10, 'Idle': 10})
+        self.assertTrue(AlertState.objects.filter(product=self.steady, kind='low_stock').exists())
+
+    def test_drafts_one_order_per_supplier_without_touching_stock(self):
+        self._sell_daily(self.steady, 30, cash=5)
+        self._sell_daily(self.recent, 30, cash=30)
+        suggestions = reorder_suggestions(demand_forecast(30, today=self.today))
+        draft_purchase_orders(suggestions, self.user, today=self.today)
+        drafts = draft_purchase_orders(suggestions, self.user, today=self.today)
+
+        self.assertEqual(Purchase.objects.filter(status='draft').count(), 2)
+        lines = {
+            (draft.supplier_id, item.product_id, item.quantity)
+            for draft in drafts for item in draft.items.all()
+        }
+        self.assertEqual(lines, {(self.suppliers[0].pk, self.steady.pk, 85), (self.suppliers[1].pk, self.recent.pk, 440)})
+        self.assertEqual(drafts[0].total_amount, Decimal('425.00'))
+        stock = dict(Product.objects.values_list('name', 'quantity_in_stock'))
+        self.assertEqual(stock, {'Steady': 20, 'Recent': 100, 'Idle': 3})
+
+    def test_redrafting_keeps_hand_made_drafts_and_drafts_can_be_received(self):
+        self._sell_daily(self.steady, 30, cash=5)
+        suggestions = reorder_suggestions(demand_forecast(30, today=self.today))
+        number = f'DRAFT-{self.today:%Y%m%d}-{self.suppliers[0].pk}'
+        by_hand = Purchase.objects.create(
+            supplier=self.suppliers[1], status='draft', invoice_number=number, created_by=self.user,
+        )
+        draft_purchase_orders(suggestions, self.user, today=self.today)
+        draft, = draft_purchase_orders(suggestions, self.user, today=self.today)
+        self.assertEqual(draft.invoice_number, f'{number}-2')
+        self.assertEqual(Purchase.objects.filter(status='draft').count(), 2)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        response = self.client.post('/admin/inventory/purchase/', {
+            'action': 'receive_drafts', '_selected_action': [draft.pk, by_hand.pk],
+        }, follow=True)
+        self.assertContains(response, 'A purchase needs at least one line')
+        self.assertContains(response, '1 draft orders received')
+        draft.refresh_from_db()
+        self.assertEqual((draft.status, draft.total_amount), ('received', Decimal('425.00')))
+        self.assertEqual(Product.objects.get(pk=self.steady.pk).quantity_in_stock, 20 + 85)
+        self.assertEqual(StockBatch.objects.get(purchase=draft).quantity, 85)
+        self.assertEqual(Purchase.objects.get(pk=by_hand.pk).status, 'draft')
+        with self.assertRaises(PurchaseError):
+            receive_draft(draft)
+
+        redrafted, = draft_purchase_orders(suggestions, self.user, today=self.today)
+        self.assertEqual(redrafted.invoice_number, f'{number}-3')
+        self.assertTrue(Purchase.objects.filter(pk=draft.pk, status='received').exists())
+
+    def test_command(self):
+        self._sell_daily(self.steady, 30, cash=5)
+        out = StringIO()
+        call_command('plan_reorders', '--apply-levels', '--drafts-for', 'manager', stdout=out)
+        self.assertIn('Forecast 1 products, 1 to reorder', out.getvalue())
+        self.assertIn('Drafted 1 purchase orders', out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('plan_reorders', '--drafts-for', 'nobody', stdout=StringIO())
+
+
+@tag('benchmark')
+class ReorderEngineBenchmark(TestCase):
+    """Forecast and reorder suggestions for 50k products over two years of daily sales"""
+
+    PRODUCTS = 50000
+    DAYS = 730
+    # Each product sells on one day in SALE_EVERY, about a million rollup rows in all
+    SALE_EVERY = 30
+    BUDGET_SECONDS = 30
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='General')
+        supplier = Supplier.objects.create(
+            name='Supplier', contact_person='Contact', phone='0700000000', address='Eldoret'
+        )
+        Product.objects.bulk_create([
+            Product(
+                name=f'Product {i}', category=category, supplier=supplier,
+                cost_price=Decimal('5.00'), selling_price=Decimal('10.00'), quantity_in_stock=i % 50,
+            )
+            for i in range(cls.PRODUCTS)
+        ], batch_size=2000)
+        product_ids = list(Product.objects.values_list('pk', flat=True))
+        today = timezone.localdate()
+        # A million model instances would take minutes to build; insert plain rows instead
+        table = connection.ops.quote_name(DailySalesRollup._meta.db_table)
+        with connection.cursor() as cursor:
+            for age in range(1, cls.DAYS + 1):
+                day = today - timedelta(days=age)
+                cursor.executemany(
+                    f'INSERT INTO {table} (day, payment_method, category_id, product_id, quantity, revenue, cost) '
+                    'VALUES (%s, %s, %s, %s, %s, 0, 0)',
+                    [(day, 'cash', category.pk, pk, pk % 7 + 1) for pk in product_ids[age % cls.SALE_EVERY::cls.SALE_EVERY]],
+                )
+
+    def test_whole_catalogue_forecast(self):
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as ctx:
+            suggestions = reorder_suggestions(demand_forecast(history_days=self.DAYS))
+        elapsed = time.perf_counter() - started
+        self.assertEqual(len(suggestions), self.PRODUCTS)
+        # One pass over the rollup and one over the catalogue, however many products
+        self.assertLessEqual(len(ctx.captured_queries), 2)
+        self.assertLess(elapsed, self.BUDGET_SECONDS)
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        product_index.clear()
+        self.user = User.objects.create_user('cashier', password='pass')
+        category = Category.objects.create(name='General')
+        supplier = Supplier.objects.create(
+            name='Supplier', contact_person='Contact', phone='0700000000', address='Eldoret'
+        )
+
+        def product(name, generic_name='', barcode=None, stock=50):
+            return Product.objects.create(
+                name=name, generic_name=generic_name, barcode=barcode, category=category,
+                supplier=supplier, cost_price=Decimal('5.00'), selling_price=Decimal('10.00'),
+                quantity_in_stock=stock,
+            )
+
+        self.panadol = product('Panadol Extra', 'Paracetamol', '6161000000017')
+        self.paracetamol = product('Paracetamol 500mg', 'Paracetamol', '6161000000024')
+        self.amoxil = product('Amoxil 250mg Capsules', 'Amoxicillin', '6161000000031')
+        self.amoxicillin = product('Amoxicillin 500mg Capsules', 'Amoxicillin', '6161000000048', stock=0)
+
+    def _names(self, query, **kwargs):
+        return [p.name for p in search_products(query, **kwargs)]
+
+    def test_name_matches_rank_above_generic_name_matches(self):
+        self.assertEqual(self._names('paracetamol'), ['Paracetamol 500mg', 'Panadol Extra'])
+
+    def test_every_query_word_must_match(self):
+        self.assertEqual(self._names('amox 500'), ['Amoxicillin 500mg Capsules'])
+
+    def test_typo_tolerance(self):
+        self.assertEqual(self._names('amoxicilin 250mg'), ['Amoxil 250mg Capsules'])
+        self.assertIn('Paracetamol 500mg', self._names('paracetmol'))
+
+    def test_exact_barcode_is_a_single_indexed_lookup(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self._names('6161000000031'), ['Amoxil 250mg Capsules'])
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(self._names('61610000000'), [
+            'Amoxicillin 500mg Capsules', 'Amoxil 250mg Capsules', 'Panadol Extra', 'Paracetamol 500mg',
+        ])
+
+    def test_saved_and_deleted_products_update_the_index(self):
+        self.assertEqual(self._names('panadol'), ['Panadol Extra'])
+        self.panadol.name = 'Panadol Advance'
+        self.panadol.save()
+        self.assertEqual(self._names('advance'), ['Panadol Advance'])
+        self.assertEqual(self._names('extra'), [])
+        self.panadol.delete()
+        self.assertEqual(self._names('panadol'), [])
+
+    def test_pos_search_only_returns_products_in_stock(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/sales/api/search-products/', {'q': 'amoxicillin'})
+        self.assertEqual([p['name'] for p in response.json()['products']], ['Amoxil 250mg Capsules'])
+
+
+@tag('benchmark')
+class ProductSearchLatencyBenchmark(TestCase):
+    """Keystroke latency over a 50k-product catalogue once the word index is warm"""
+
+    PRODUCTS = 50000
+    STEMS = [
+        'paracetamol', 'amoxicillin', 'ibuprofen', 'metformin', 'amlodipine', 'omeprazole',
+        'ciprofloxacin', 'azithromycin', 'cetirizine', 'diclofenac', 'losartan', 'atorvastatin',
+        'salbutamol', 'prednisolone', 'doxycycline', 'fluconazole', 'metronidazole', 'artemether',
+    ]
+    FORMS = ['tablets', 'capsules', 'syrup', 'suspension', 'injection', 'cream']
+    QUERIES = [
+        'para', 'amoxicillin 500', 'ibuprofen syrup', 'metfromin', 'azithromycn capsules',
+        'cetirizine 10mg', 'artemether', 'dicl', 'brand 4242', '616100012345',
+    ]
+    BUDGET_MS = 50
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='General')
+        supplier = Supplier.objects.create(
+            name='Supplier', contact_person='Contact', phone='0700000000', address='Eldoret'
+        )
+        Product.objects.bulk_create([
+            Product(
+                name=f'{cls.STEMS[i % 18].title()} {(i % 7 + 1) * 50}mg {cls.FORMS[i % 6]} Brand {i}',
+                generic_name=cls.STEMS[i % 18],
+                barcode=f'6161{i:08d}',
+                category=category, supplier=supplier,
+                cost_price=Decimal('5.00'), selling_price=Decimal('10.00'), quantity_in_stock=100,
+            )
+            for i in range(cls.PRODUCTS)
+        ], batch_size=2000)
+
+    def test_search_latency(self):
+        product_index.build()
+        queryset = Product.objects.filter(is_active=True, quantity_in_stock__gt=0)
+        timings = []
+        for _ in range(5):
+            for query in self.QUERIES:
+                started = time.perf_counter()
+                results = search_products(query, queryset)
+                timings.append((time.perf_counter() - started) * 1000)
+                self.assertTrue(results, query)
+        self.assertLess(median(timings), self.BUDGET_MS)
+
+
+class BarcodeCacheTests(TestCase):
+    def setUp(self):
+        barcode_cache.clear()
+        self.user = User.objects.create_user('cashier', password='pass')
+        self.category = Category.objects.create(name='General')
+        self.supplier = Supplier.objects.create(
+            name='Supplier', contact_person='Contact', phone='0700000000', address='Eldoret'
+        )
+        self.products = [
+            Product.objects.create(
+                name=f'Product {i}', barcode=f'616100000{i}', category=self.category,
+                supplier=self.supplier, cost_price=Decimal('5.00'), selling_price=Decimal('10.00'),
+                quantity_in_stock=20,
+            )
+            for i in range(3)
+        ]
+
+    def test_hits_are_served_without_queries_in_under_a_millisecond(self):
+        self.assertEqual(barcode_cache.get('6161000001')['name'], 'Product 1')
+        timings = []
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(200):
+                started = time.perf_counter()
+                barcode_cache.get('6161000001')
+                timings.append((time.perf_counter() - started) * 1000)
+        self.assertEqual(len(queries), 0)
+        self.assertLess(median(timings), 1)
+        stats = barcode_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (200, 1, 1))
+
+    def test_saving_a_product_invalidates_its_old_and_new_barcode(self):
+        product = self.products[0]
+        barcode_cache.get(product.barcode)
+        product.selling_price = Decimal('12.00')
+        product.barcode = '6161000099'
+        product.save()
+        self.assertIsNone(barcode_cache.get('6161000000'))
+        self.assertEqual(barcode_cache.get('6161000099')['price'], '12.00')
+        product.delete()
+        self.assertIsNone(barcode_cache.get('6161000099'))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = BarcodeCache(maxsize=2)
+        cache.get('6161000000')
+        cache.get('6161000001')
+        cache.get('6161000000')
+        cache.get('6161000002')
+        self.assertEqual(list(cache._entries), ['6161000000', '6161000002'])
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'barcodes'},
+    })
+    @patch('inventory.barcode_service.VERSION_CHECK_INTERVAL', 0)
+    def test_shared_backend_keeps_workers_coherent(self):
+        worker_a, worker_b = BarcodeCache(shared_alias='shared'), BarcodeCache(shared_alias='shared')
+        self.assertEqual(worker_b.get('6161000000')['price'], '10.00')
+        Product.objects.filter(pk=self.products[0].pk).update(selling_price=Decimal('11.00'))
+        worker_a.invalidate(self.products[0])
+        self.assertEqual(worker_b.get('6161000000')['price'], '11.00')
+
+    def test_scan_endpoint(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/sales/api/barcode/6161000002/')
+        self.assertEqual(response.json()['product']['id'], self.products[2].id)
+        self.assertEqual(self.client.get('/sales/api/barcode/0000000000/').status_code, 404)
+        self.assertEqual(self.client.get('/sales/api/barcode/stats/').json()['misses'], 2)
+
+
+class DashboardMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('manager', password='pass')
+        category = Category.objects.create(name='General')
+        supplier = Supplier.objects.create(
+            name='Supplier', contact_person='Contact', phone='0700000000', address='Eldoret'
+        )
+        self.products = [
+            Product.objects.create(
+                name=f'Product {i}', category=category, supplier=supplier,
+                cost_price=Decimal('5.00'), selling_price=Decimal('10.00'),
+                quantity_in_stock=stock, minimum_stock_level=5,
+                expiry_date=timezone.localdate() - timedelta(days=1) if i == 2 else None,
+            )
+            for i, stock in enumerate([20, 6, 3])
+        ]
+
+    def test_figures_take_two_queries_then_come_from_the_cache(self):
+        with self.assertNumQueries(2):
+            metrics = dashboard_metrics()
+        self.assertEqual(metrics, {
+            'total_products': 3, 'low_stock_products': 1, 'expired_products': 1, 'today_revenue': 0,
+        })
+        with self.assertNumQueries(0):
+            dashboard_metrics()
+
+    def test_sales_adjust_revenue_in_place_and_refresh_stock_counts(self):
+        dashboard_metrics()
+        with self.captureOnCommitCallbacks(execute=True):
+            checkout(self.user, [{'id': self.products[1].id, 'quantity': 2}])
+        # Revenue is already current; only the stock counts are recomputed
+        with self.assertNumQueries(1):
+            metrics = dashboard_metrics()
+        self.assertEqual(metrics['today_revenue'], Decimal('20.00'))
+        self.assertEqual(metrics['low_stock_products'], 2)
+
+    def test_product_edits_drop_only_the_stock_counts(self):
+        dashboard_metrics()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].is_active = False
+            self.products[0].save()
+        with self.assertNumQueries(1):
+            self.assertEqual(dashboard_metrics()['total_products'], 2)
+
+    def test_background_refresh_serves_the_stale_value(self):
+        dashboard_metrics()
+        Product.objects.filter(pk=self.products[0].pk).update(quantity_in_stock=1)
+        refresh_alerts([self.products[0].pk])
+        started = []
+
+        class InlineThread:
+            def __init__(self, target, args, daemon):
+                self.target, self.args = target, args
+
+            def start(self):
+                started.append(True)
+                self.target(*self.args)
+
+        with self.settings(DASHBOARD_METRICS_TTL=0, DASHBOARD_METRICS_BACKGROUND_REFRESH=True), \
+                patch('inventory.dashboard_service.connection'), \
+                patch('inventory.dashboard_service.threading.Thread', InlineThread):
+            self.assertEqual(dashboard_metrics()['low_stock_products'], 1)
+        self.assertTrue(started)
+        self.assertEqual(dashboard_metrics()['low_stock_products'], 2)
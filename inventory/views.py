@@ -1,47 +1,35 @@
 from django.shortcuts import render, get_object_or_404, redirect
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib import messages
-from django.db.models import Q, Sum, F
+from django.db.models import Q
 from django.http import JsonResponse
-from django.utils import timezone
 from django.core.paginator import Paginator
 from .models import Product, Category, Supplier, Purchase
 from sales.models import Sale, SaleItem
-from .forms import ProductForm, CategoryForm, SupplierForm  # Removed ProductEditForm from here
+from .alert_service import low_stock_products
+from .dashboard_service import dashboard_metrics
+from .forms import ProductForm, CategoryForm, SupplierForm, BulkPriceForm  # Removed ProductEditForm from here
+from .pricing_service import PriceRuleError, apply_price_rule, price_preview
+from .stock_service import save_product
+from .search_service import search_products
+from reports.live_service import live_events_enabled
 from django.db.models import Count, Q
 from .models import Category
 from django import forms  # Added this import
 
 @login_required
 def dashboard(request):
-    # Get key statistics
-    total_products = Product.objects.filter(is_active=True).count()
-    low_stock_products = Product.objects.filter(
-        quantity_in_stock__lte=F('minimum_stock_level'),
-        is_active=True
-    ).count()
-    
-    today_sales = Sale.objects.filter(sale_date__date=timezone.now().date())
-    today_revenue = today_sales.aggregate(Sum('final_amount'))['final_amount__sum'] or 0
-    
-    expired_products = Product.objects.filter(
-        expiry_date__lt=timezone.now().date(),
-        is_active=True
-    ).count()
+    # Key statistics, cached per day and kept current by sale/product signals
+    metrics = dashboard_metrics()
     
     recent_sales = Sale.objects.select_related('served_by')[:5]
-    low_stock_items = Product.objects.filter(
-        quantity_in_stock__lte=F('minimum_stock_level'),
-        is_active=True
-    )[:10]
+    low_stock_items = low_stock_products()[:10]
     
     context = {
-        'total_products': total_products,
-        'low_stock_products': low_stock_products,
-        'today_revenue': today_revenue,
-        'expired_products': expired_products,
+        **metrics,
         'recent_sales': recent_sales,
         'low_stock_items': low_stock_items,
+        'live_events': live_events_enabled(request),
     }
     return render(request, 'inventory/dashboard.html', context)
 
@@ -50,18 +38,15 @@ def product_list(request):
     query = request.GET.get('q')
     category = request.GET.get('category')
     
-    products = Product.objects.filter(is_active=True)
-    
-    if query:
-        products = products.filter(
-            Q(name__icontains=query) |
-            Q(generic_name__icontains=query) |
-            Q(barcode__icontains=query)
-        )
+    # Stock badges read the prefetched alerts
+    products = Product.objects.filter(is_active=True).prefetch_related('alerts')
     
     if category:
         products = products.filter(category_id=category)
     
+    if query:
+        products = search_products(query, products, limit=None)
+    
     categories = Category.objects.all()
     
     context = {
@@ -77,7 +62,7 @@ def add_product(request):
     if request.method == 'POST':
         form = ProductForm(request.POST, request.FILES)
         if form.is_valid():
-            form.save()
+            save_product(form.save(commit=False), reference='Opening stock')
             messages.success(request, 'Product added successfully!')
             return redirect('inventory:product_list')
     else:
@@ -321,7 +306,7 @@ def delete_category(request):
 
 @login_required
 def product_detail(request, pk):
-    product = get_object_or_404(Product, pk=pk)
+    product = get_object_or_404(Product.objects.prefetch_related('alerts'), pk=pk)
     context = {
         'product': product,
     }
@@ -368,7 +353,7 @@ def product_edit(request, pk):
     if request.method == 'POST':
         form = ProductEditForm(request.POST, request.FILES, instance=product)
         if form.is_valid():
-            updated_product = form.save()
+            updated_product = save_product(form.save(commit=False), reference=f'Edited by {request.user.username}')
             messages.success(request, f'Product "{updated_product.name}" has been updated successfully!')
             return redirect('inventory:product_detail', pk=updated_product.pk)
         else:
@@ -380,4 +365,35 @@ def product_edit(request, pk):
         'form': form,
         'product': product,
     }
-    return render(request, 'inventory/product_edit.html', context)
\ No newline at end of file
+    return render(request, 'inventory/product_edit.html', context)
+
+@login_required
+@permission_required('inventory.change_product', raise_exception=True)
+def bulk_price_update(request):
+    # Preview and apply post the same form, so what is applied is what was previewed
+    preview = None
+    if request.method == 'POST':
+        form = BulkPriceForm(request.POST)
+        if form.is_valid():
+            try:
+                rule = form.rule()
+                if 'apply' in request.POST:
+                    count = apply_price_rule(form.products(), rule, changed_by=request.user)
+                    messages.success(request, f'Updated the selling price of {count} products.')
+                    return redirect('inventory:product_list')
+                preview = price_preview(form.products(), rule)
+            except PriceRuleError as exc:
+                for error in exc.errors[:20]:
+                    messages.error(request, error)
+                if len(exc.errors) > 20:
+                    messages.error(request, f'...and {len(exc.errors) - 20} more products.')
+        else:
+            messages.error(request, 'Please correct the errors below.')
+    else:
+        form = BulkPriceForm()
+
+    context = {
+        'form': form,
+        'preview': preview,
+    }
+    return render(request, 'inventory/bulk_price_update.html', context)
@@ -0,0 +1,24 @@
+from django.contrib import admin
+from django.utils import timezone
+
+from .models import Job
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'name', 'status', 'priority', 'attempts', 'run_at', 'finished_at', 'created_by']
+    list_filter = ['status', 'name']
+    search_fields = ['name']
+    readonly_fields = ['locked_by', 'locked_until', 'started_at', 'finished_at', 'error', 'output_name']
+    exclude = ['output']
+    actions = ['requeue']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('output').select_related('created_by')
+
+    @admin.action(description='Run the selected jobs again')
+    def requeue(self, request, queryset):
+        count = queryset.exclude(status='running').update(
+            status='queued', attempts=0, run_at=timezone.now(), error=''
+        )
+        self.message_user(request, f'{count} jobs queued')
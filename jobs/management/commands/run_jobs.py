@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from jobs.queue_service import work, worker_name
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs (report PDFs, M-Pesa pushes, rollup rebuilds)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--burst', action='store_true', help='Exit once no job is due')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait between polls of an empty queue')
+        parser.add_argument('--max-jobs', type=int, help='Exit after running this many jobs')
+
+    def handle(self, *args, **options):
+        worker = worker_name()
+        self.stdout.write(f'Worker {worker} started')
+        try:
+            count = work(worker, burst=options['burst'], interval=options['interval'],
+                         max_jobs=options['max_jobs'])
+        except KeyboardInterrupt:
+            return
+        self.stdout.write(self.style.SUCCESS(f'Ran {count} jobs'))
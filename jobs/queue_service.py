@@ -0,0 +1,197 @@
+"""
+Database-backed background jobs.
+
+Slow work is registered with @task in an app's tasks.py and enqueued as a Job
+row, usually in the same transaction as the data it works on, so a job never
+runs for a write that was rolled back. `manage.py run_jobs` workers claim the
+highest-priority due job, run it and record the outcome. A failed attempt is
+retried with exponential backoff until max_attempts runs out. A worker only
+holds a job for its lease, so if the worker dies mid-job another one picks
+the job up once the lease runs out.
+
+Claiming uses SKIP LOCKED where the database supports it and a
+compare-and-set UPDATE everywhere, so the queue behaves the same on SQLite
+and PostgreSQL with no broker to run.
+"""
+import logging
+import os
+import socket
+import time
+import traceback
+import uuid
+from datetime import timedelta
+
+from django.db import OperationalError, close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# Retry n waits RETRY_BASE_DELAY * 2**(n-1) seconds, capped at RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 10
+RETRY_MAX_DELAY = 3600
+# A running job whose worker hasn't finished it within its lease is run again
+DEFAULT_LEASE = timedelta(minutes=10)
+
+_registry = {}
+
+
+class JobOutput:
+    """Return one from a task to store a file (e.g. a PDF) on the job for download"""
+
+    def __init__(self, content, filename, content_type):
+        self.content = content
+        self.filename = filename
+        self.content_type = content_type
+
+
+def task(name=None, priority=0, max_attempts=3, lease=DEFAULT_LEASE):
+    """
+    Register a function as a background task. It is called with the keyword
+    arguments it was enqueued with, which must be JSON serialisable.
+    """
+    def decorator(func):
+        func.task_name = name or f'{func.__module__}.{func.__name__}'
+        func.task_options = {'priority': priority, 'max_attempts': max_attempts, 'lease': lease}
+        func.enqueue = lambda **kwargs: enqueue(func, **kwargs)
+        _registry[func.task_name] = func
+        return func
+    return decorator
+
+
+def enqueue(func, *, priority=None, delay=None, created_by=None, **kwargs):
+    """Queue a run of a registered task; returns the Job"""
+    if _registry.get(getattr(func, 'task_name', None)) is not func:
+        raise ValueError(f'{func!r} is not a registered task')
+    options = func.task_options
+    return Job.objects.create(
+        name=func.task_name,
+        kwargs=kwargs,
+        priority=options['priority'] if priority is None else priority,
+        max_attempts=options['max_attempts'],
+        run_at=timezone.now() + (delay or timedelta(0)),
+        created_by=created_by,
+    )
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+
+
+def _lease(name):
+    func = _registry.get(name)
+    return func.task_options['lease'] if func else DEFAULT_LEASE
+
+
+def claim(worker):
+    """Take the next due job for this worker, or None if there is nothing to do"""
+    for _ in range(10):
+        now = timezone.now()
+        due = Q(status='queued', run_at__lte=now) | Q(status='running', locked_until__lt=now)
+        with transaction.atomic():
+            candidate = (
+                Job.objects.select_for_update(skip_locked=True)
+                .filter(due)
+                .order_by('-priority', 'run_at', 'id')
+                .defer('output')
+                .first()
+            )
+            if candidate is None:
+                return None
+            # Only one worker can move the job on from the state it read
+            current = Job.objects.filter(pk=candidate.pk, status=candidate.status, attempts=candidate.attempts)
+            if candidate.status == 'running' and candidate.attempts >= candidate.max_attempts:
+                # Its worker died on the last attempt it had
+                current.update(
+                    status='failed', finished_at=now, locked_until=None,
+                    error='The worker running this job stopped before it finished',
+                )
+                continue
+            changes = {
+                'status': 'running',
+                'attempts': candidate.attempts + 1,
+                'started_at': now,
+                'locked_by': worker,
+                'locked_until': now + _lease(candidate.name),
+            }
+            claimed = current.update(**changes)
+        if claimed:
+            for field, value in changes.items():
+                setattr(candidate, field, value)
+            return candidate
+    return None
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY))
+
+
+def run(job):
+    """Run a claimed job and record its outcome; returns the final status"""
+    now = timezone.now
+    try:
+        func = _registry.get(job.name)
+        if func is None:
+            raise LookupError(f'No task registered as {job.name}')
+        value = func(**job.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        logger.warning('Job %s (%s) failed, attempt %s of %s', job.pk, job.name, job.attempts, job.max_attempts)
+        if job.attempts < job.max_attempts:
+            status, changes = 'queued', {'run_at': now() + retry_delay(job.attempts)}
+        else:
+            status, changes = 'failed', {'finished_at': now()}
+        changes['error'] = error
+    else:
+        status, changes = 'succeeded', {'finished_at': now(), 'error': ''}
+        if isinstance(value, JobOutput):
+            changes.update(output=value.content, output_name=value.filename, output_type=value.content_type)
+        else:
+            changes['result'] = value
+    _record(job, status, changes)
+    return status
+
+
+def _record(job, status, changes, attempts=5):
+    # The task has run, so its outcome is worth waiting for a busy database
+    for attempt in range(attempts):
+        try:
+            # A worker that overran its lease has lost the job to another one; drop its outcome
+            Job.objects.filter(pk=job.pk, status='running', locked_by=job.locked_by).update(
+                status=status, locked_until=None, **changes
+            )
+            return
+        except OperationalError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.05 * (attempt + 1))
+
+
+def work(worker=None, burst=False, interval=1.0, max_jobs=None):
+    """
+    Claim and run jobs until stopped. With burst=True, return once nothing is
+    due. Returns the number of jobs run.
+    """
+    worker = worker or worker_name()
+    count = 0
+    while max_jobs is None or count < max_jobs:
+        # Long-running workers drop broken or expired connections between jobs
+        if not connection.in_atomic_block:
+            close_old_connections()
+        try:
+            job = claim(worker)
+        except OperationalError:
+            # e.g. SQLite refusing a second writer; another worker got there first
+            logger.info('Worker %s could not claim a job, retrying', worker)
+            time.sleep(min(interval, 0.05))
+            continue
+        if job is None:
+            if burst:
+                break
+            time.sleep(interval)
+            continue
+        run(job)
+        count += 1
+    return count
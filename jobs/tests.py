@@ -0,0 +1,127 @@
+import threading
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from .models import Job
+from .queue_service import task, enqueue, claim, run, work, JobOutput, RETRY_BASE_DELAY
+
+calls = []
+
+
+@task(name='jobs.tests.record')
+def record(value):
+    calls.append(value)
+    return {'value': value}
+
+
+@task(name='jobs.tests.broken', max_attempts=3)
+def broken():
+    raise RuntimeError('printer on fire')
+
+
+@task(name='jobs.tests.document')
+def document():
+    return JobOutput(b'%PDF-1.4 test', 'report.pdf', 'application/pdf')
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        calls.clear()
+
+    def test_higher_priority_runs_first(self):
+        enqueue(record, value='low')
+        enqueue(record, value='high', priority=10)
+        enqueue(record, value='later', delay=timedelta(hours=1))
+        self.assertEqual(work(burst=True), 2)
+        self.assertEqual(calls, ['high', 'low'])
+        self.assertEqual(Job.objects.get(kwargs__value='high').result, {'value': 'high'})
+        self.assertEqual(Job.objects.get(kwargs__value='later').status, 'queued')
+
+    def test_failures_retry_with_backoff_then_fail(self):
+        job = enqueue(broken)
+        for attempt in range(1, 4):
+            started = timezone.now()
+            self.assertEqual(run(claim('worker')), 'failed' if attempt == 3 else 'queued')
+            job.refresh_from_db()
+            self.assertEqual(job.attempts, attempt)
+            self.assertIn('printer on fire', job.error)
+            if attempt < 3:
+                # Not due again until the backoff has passed
+                self.assertGreaterEqual(job.run_at, started + timedelta(seconds=RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+                self.assertIsNone(claim('worker'))
+                Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        self.assertEqual(job.status, 'failed')
+
+    def test_expired_lease_is_taken_over(self):
+        enqueue(record, value='once')
+        stalled = claim('stalled')
+        Job.objects.filter(pk=stalled.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        rescued = claim('rescuer')
+        self.assertEqual((rescued.pk, rescued.attempts), (stalled.pk, 2))
+        self.assertEqual(run(rescued), 'succeeded')
+        # The stalled worker finishing late doesn't overwrite the outcome
+        Job.objects.filter(pk=stalled.pk).update(result=None)
+        run(stalled)
+        self.assertEqual(Job.objects.get(pk=stalled.pk).locked_by, 'rescuer')
+        self.assertIsNone(Job.objects.get(pk=stalled.pk).result)
+
+    def test_lost_last_attempt_fails_the_job(self):
+        job = enqueue(record, value='once')
+        Job.objects.filter(pk=job.pk).update(max_attempts=1)
+        claim('stalled')
+        Job.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(claim('rescuer'))
+        self.assertEqual(Job.objects.get(pk=job.pk).status, 'failed')
+        self.assertEqual(calls, [])
+
+    def test_only_registered_tasks_can_be_queued(self):
+        with self.assertRaises(ValueError):
+            enqueue(print)
+
+    def test_status_polling_and_output(self):
+        owner = User.objects.create_user('manager', password='pass')
+        other = User.objects.create_user('cashier', password='pass')
+        job = enqueue(document, created_by=owner)
+        self.client.force_login(owner)
+        self.assertEqual(self.client.get(f'/jobs/{job.pk}/').json()['status'], 'queued')
+        work(burst=True)
+        status = self.client.get(f'/jobs/{job.pk}/').json()
+        self.assertEqual(status['status'], 'succeeded')
+        response = self.client.get(status['output_url'])
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response.content, b'%PDF-1.4 test')
+
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(f'/jobs/{job.pk}/').status_code, 404)
+        self.assertEqual(self.client.get(f'/jobs/{job.pk}/output/').status_code, 404)
+
+
+class ConcurrentWorkerTest(TransactionTestCase):
+    """Workers racing for the same queue run every job exactly once"""
+
+    WORKERS = 4
+    JOBS = 40
+
+    def test_each_job_runs_once(self):
+        calls.clear()
+        for i in range(self.JOBS):
+            enqueue(record, value=i)
+
+        def worker(name):
+            try:
+                work(name, burst=True)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(f'worker-{n}',)) for n in range(self.WORKERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(calls), list(range(self.JOBS)))
+        self.assertEqual(Job.objects.filter(status='succeeded', attempts=1).count(), self.JOBS)
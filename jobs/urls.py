@@ -0,0 +1,9 @@
+from django.urls import path
+from . import views
+
+app_name = 'jobs'
+
+urlpatterns = [
+    path('<int:job_id>/', views.job_status, name='job_status'),
+    path('<int:job_id>/output/', views.job_output, name='job_output'),
+]
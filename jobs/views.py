@@ -0,0 +1,45 @@
+from django.contrib.auth.decorators import login_required
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+
+from .models import Job
+
+
+def _own_job(request, job_id, *fields):
+    job = get_object_or_404(Job.objects.only('created_by', *fields), pk=job_id)
+    if not (request.user.is_superuser or job.created_by_id == request.user.id):
+        raise Http404
+    return job
+
+
+@login_required
+def job_status(request, job_id):
+    """Polled by the browser until the job has succeeded or failed"""
+    job = _own_job(request, job_id, 'name', 'status', 'attempts', 'max_attempts',
+                   'run_at', 'finished_at', 'result', 'error', 'output_name')
+    data = {
+        'id': job.pk,
+        'name': job.name,
+        'status': job.status,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'run_at': job.run_at,
+        'finished_at': job.finished_at,
+        'result': job.result,
+        # Only the exception line; the traceback stays in the admin
+        'error': job.error.strip().splitlines()[-1] if job.error else '',
+    }
+    if job.status == 'succeeded' and job.output_name:
+        data['output_url'] = reverse('jobs:job_output', args=[job.pk])
+    return JsonResponse(data)
+
+
+@login_required
+def job_output(request, job_id):
+    job = _own_job(request, job_id, 'status', 'output', 'output_name', 'output_type')
+    if job.status != 'succeeded' or job.output is None:
+        raise Http404
+    response = HttpResponse(bytes(job.output), content_type=job.output_type)
+    response['Content-Disposition'] = f'attachment; filename="{job.output_name}"'
+    return response
@@ -2,6 +2,8 @@
 ASGI config for pharmacy project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it with an ASGI server (e.g. ``uvicorn pharmacy.asgi:application``) for
+the live dashboard stream at /reports/api/dashboard/events/.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -13,4 +15,21 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pharmacy.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    # Django only speaks HTTP; handle lifespan here so the live dashboard hub
+    # starts and stops with the server instead of on the first subscriber
+    if scope['type'] == 'lifespan':
+        from reports.live_service import hub
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                hub.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await hub.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    await django_application(scope, receive, send)
@@ -0,0 +1,48 @@
+"""
+Conditional GET support for read-only JSON endpoints.
+
+Decorate a view with @conditional(validator). The validator is a cheap
+function of the request, such as the latest updated_at or the newest sale id,
+that changes whenever the view's payload would. A client that already holds
+the payload for the current validator gets 304 Not Modified, and the view
+itself never runs.
+"""
+import hashlib
+from datetime import datetime
+from functools import wraps
+
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+
+def conditional(validator):
+    """
+    ``validator(request, *args, **kwargs)`` returns any value with a stable
+    repr, or None to skip revalidation (e.g. for a missing object). A datetime
+    is also sent as Last-Modified.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            value = validator(request, *args, **kwargs)
+            if value is None:
+                return view(request, *args, **kwargs)
+
+            # The query string is part of the payload, so it's part of the validator too
+            digest = hashlib.md5(f'{request.get_full_path()}|{value!r}'.encode()).hexdigest()
+            etag = quote_etag(digest)
+            last_modified = int(value.timestamp()) if isinstance(value, datetime) else None
+
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = view(request, *args, **kwargs)
+            if response.status_code in (200, 304):
+                response['ETag'] = etag
+                if last_modified is not None:
+                    response['Last-Modified'] = http_date(last_modified)
+                patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
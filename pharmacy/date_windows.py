@@ -0,0 +1,41 @@
+"""
+Half-open datetime bounds for local calendar windows.
+
+A lookup like sale_date__date=today wraps the column in a timezone
+conversion, so the database can't use an index on sale_date. These helpers
+turn local (Africa/Nairobi) days, months and day ranges into UTC datetimes
+instead, and the column is compared as stored: lower <= sale_date < upper.
+"""
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from django.db.models import Q
+from django.utils import timezone
+
+
+def _local_midnight(day):
+    return timezone.make_aware(datetime.combine(day, time.min)).astimezone(dt_timezone.utc)
+
+
+def range_window(start, end):
+    """(lower, upper) covering local days start..end inclusive"""
+    return _local_midnight(start), _local_midnight(end + timedelta(days=1))
+
+
+def day_window(day=None):
+    """(lower, upper) covering one local day, today by default"""
+    day = day or timezone.localdate()
+    return range_window(day, day)
+
+
+def month_window(day=None):
+    """(lower, upper) covering the local calendar month containing ``day``"""
+    day = day or timezone.localdate()
+    first = day.replace(day=1)
+    next_first = (first + timedelta(days=32)).replace(day=1)
+    return _local_midnight(first), _local_midnight(next_first)
+
+
+def within(field, window):
+    """Q object matching ``field`` inside a (lower, upper) window"""
+    lower, upper = window
+    return Q(**{f'{field}__gte': lower, f'{field}__lt': upper})
@@ -0,0 +1,70 @@
+"""
+Query plan inspection for the index regression tests.
+
+Wrap a block in capture_selects() to record every SELECT it runs, then ask
+full_table_scans() which tables the database would read end to end.
+"""
+import re
+from contextlib import contextmanager
+
+from django.db import connection
+
+# SQLite: "SCAN inventory_product", optionally "... USING [COVERING] INDEX name". A SCAN
+# with no search constraint reads every row, through an index or not, unless that
+# index is partial and so only holds the rows the query asked for, or the index
+# already yields the ORDER BY and a LIMIT stops the walk early.
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: USING (?:COVERING )?INDEX (\w+))?$')
+SQL_LIMIT = re.compile(r'\bLIMIT\s+\d+\s*$', re.IGNORECASE)
+# PostgreSQL: "Seq Scan on inventory_product"
+POSTGRES_FULL_SCAN = re.compile(r'Seq Scan on (\w+)')
+
+
+@contextmanager
+def capture_selects(using=connection):
+    """Record (sql, params) for every SELECT executed inside the block"""
+    statements = []
+
+    def record(execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith('SELECT'):
+            statements.append((sql, params))
+        return execute(sql, params, many, context)
+
+    with using.execute_wrapper(record):
+        yield statements
+
+
+def explain(sql, params=(), using=connection):
+    """Return the database's query plan for one statement as a list of lines"""
+    with using.cursor() as cursor:
+        if using.vendor == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return [row[-1] for row in cursor.fetchall()]
+        cursor.execute(f'EXPLAIN {sql}', params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _is_partial_sqlite_index(name, using):
+    with using.cursor() as cursor:
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = %s", [name])
+        row = cursor.fetchone()
+    return bool(row and row[0] and ' WHERE ' in row[0].upper())
+
+
+def full_table_scans(sql, params=(), using=connection):
+    """Tables the plan for this statement reads end to end"""
+    tables = []
+    plan = explain(sql, params, using)
+    limited_walk = SQL_LIMIT.search(sql) and not any('TEMP B-TREE' in line for line in plan)
+    for line in plan:
+        line = line.strip()
+        if using.vendor == 'sqlite':
+            match = SQLITE_SCAN.match(line)
+            if match and not (match.group(2) and (
+                limited_walk or _is_partial_sqlite_index(match.group(2), using)
+            )):
+                tables.append(match.group(1))
+        else:
+            match = POSTGRES_FULL_SCAN.search(line)
+            if match:
+                tables.append(match.group(1))
+    return tables
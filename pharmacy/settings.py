@@ -46,6 +46,7 @@ INSTALLED_APPS = [
     'inventory',
     'sales',
     'reports',
+    'jobs',
 ]
 
 MIDDLEWARE = [
@@ -79,6 +80,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'pharmacy.wsgi.application'
 
+# Benchmarks (tests tagged 'benchmark') only run with `manage.py test --tag benchmark`
+TEST_RUNNER = 'pharmacy.test_runner.TestRunner'
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -156,4 +160,48 @@ MPESA_PASSKEY = 'bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c91
 MPESA_BASE_URL = 'https://sandbox.safaricom.co.ke'
 #MPESA_CALLBACK_URL = 'https://your-ngrok-url.ngrok.io/sales/mpesa/callback/'
 # Temporary - use a dummy URL for testing
-MPESA_CALLBACK_URL = 'https://httpbin.org/post'
\ No newline at end of file
+MPESA_CALLBACK_URL = 'https://httpbin.org/post'
+
+# Barcode scanner lookups
+BARCODE_CACHE_SIZE = 5000
+# Name of a shared CACHES alias (e.g. Redis) that keeps every worker's barcode
+# cache coherent; None keeps invalidation local to each process
+BARCODE_CACHE_SHARED_ALIAS = None
+
+
+# Dashboard headline figures: seconds before a cached value is recomputed, and
+# whether to serve the stale value while a background thread recomputes it
+DASHBOARD_METRICS_TTL = 60
+DASHBOARD_METRICS_BACKGROUND_REFRESH = False
+
+
+# Stock batches expiring within this many days raise an "expiring soon" alert
+# (inventory.alert_service)
+EXPIRY_WARNING_DAYS = 30
+
+
+# Reorder engine (inventory.reorder_service): days of sales history read, the
+# exponential smoothing factor, standard deviations of lead-time demand held as
+# safety stock, and days of demand an order covers beyond the reorder level
+REORDER_HISTORY_DAYS = 365
+REORDER_SMOOTHING = 0.1
+REORDER_SERVICE_FACTOR = 1.65
+REORDER_REVIEW_DAYS = 14
+
+
+# Sales report figures for days before today, per filter set: the most entries
+# and the most product rows (summed over entries) each worker keeps
+REPORT_CACHE_SIZE = 256
+REPORT_CACHE_MAX_ROWS = 200000
+
+
+# Live dashboard stream (reports.live_service). It is only served when the site
+# runs under ASGI; set LIVE_EVENTS = False to turn it off there too. The
+# in-memory broker only reaches clients connected to the same ASGI worker.
+LIVE_EVENTS = True
+LIVE_EVENTS_BROKER = 'reports.live_service.InMemoryBroker'
+
+
+# Run report PDFs, M-Pesa STK pushes and rollup rebuilds on the database job
+# queue (`manage.py run_jobs`) instead of inside the request
+BACKGROUND_JOBS = False
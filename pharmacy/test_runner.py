@@ -0,0 +1,17 @@
+"""
+Test runner that leaves the benchmarks out of a plain `manage.py test`.
+
+Benchmarks seed tens of thousands of rows and assert wall-clock budgets, so
+they are slow and depend on the machine. They are tagged 'benchmark' and only
+run when asked for: `manage.py test --tag benchmark`.
+"""
+from django.test.runner import DiscoverRunner
+
+BENCHMARK_TAG = 'benchmark'
+
+
+class TestRunner(DiscoverRunner):
+    def __init__(self, *args, tags=None, exclude_tags=None, **kwargs):
+        if not tags or BENCHMARK_TAG not in tags:
+            exclude_tags = {*(exclude_tags or ()), BENCHMARK_TAG}
+        super().__init__(*args, tags=tags, exclude_tags=exclude_tags, **kwargs)
@@ -14,6 +14,7 @@ urlpatterns = [
     path('inventory/', include('inventory.urls')),
     path('sales/', include('sales.urls')),
     path('reports/', include('reports.urls')),
+    path('jobs/', include('jobs.urls')),
 ]
 
 if settings.DEBUG:
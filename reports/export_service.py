@@ -0,0 +1,152 @@
+"""
+Sales report exports.
+
+Exports cover every sale in the range, however many there are. Sales are read
+with .iterator() in chunks of EXPORT_CHUNK_SIZE and written out as they
+arrive: CSV through csv.writer into a StreamingHttpResponse, PDF one page at
+a time through StreamingPdf. Memory use depends on the chunk and page size,
+not on the number of sales.
+"""
+import csv
+
+from django.db.models import Count, Exists, OuterRef, Q, Sum
+from django.utils import timezone
+
+from pharmacy.date_windows import range_window, within
+from sales.models import Sale, SaleItem
+from .pdf_stream import PageCanvas, StreamingPdf
+
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_COLUMNS = [
+    'Date', 'Receipt', 'Customer', 'Payment Method', 'Status',
+    'Total', 'Discount', 'Final Amount', 'Served By',
+]
+# PDF layout on A4, in points
+PDF_MARGIN = 40
+PDF_ROW_HEIGHT = 14
+PDF_COLUMNS = [  # (x, right aligned)
+    (40, False), (130, False), (180, False), (300, False), (360, False),
+    (455, True), (505, True), (555, True),
+]
+
+
+def export_sales(start_date, end_date, payment_method='', category='', customer_search='', invoice_search=''):
+    """Sales matching the sales report filters, oldest first"""
+    filters = within('sale_date', range_window(start_date, end_date))
+    if payment_method:
+        filters &= Q(payment_method=payment_method)
+    if customer_search:
+        filters &= Q(customer_name__icontains=customer_search)
+    invoice = invoice_search.strip().lstrip('#')
+    if invoice:
+        # Receipts are numbered by sale id (#123), as on the report page
+        filters &= Q(pk=int(invoice)) if invoice.isdigit() else Q(pk__in=[])
+    sales = Sale.objects.filter(filters)
+    if category:
+        # EXISTS rather than a join, so a sale with several matching lines is listed once
+        sales = sales.filter(Exists(
+            SaleItem.objects.filter(sale=OuterRef('pk'), product__category__name=category)
+        ))
+    return sales
+
+
+def _rows(sales):
+    methods = dict(Sale.PAYMENT_METHODS)
+    statuses = dict(Sale.STATUS_CHOICES)
+    tz = timezone.get_current_timezone()
+    rows = sales.order_by('sale_date', 'id').values_list(
+        'id', 'sale_date', 'customer_name', 'payment_method', 'status',
+        'total_amount', 'discount', 'final_amount', 'served_by__username',
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    for pk, sale_date, customer, method, status, total, discount, final, served_by in rows:
+        yield [
+            sale_date.astimezone(tz).strftime('%Y-%m-%d %H:%M'),
+            f'#{pk}',
+            customer or 'Walk-in Customer',
+            methods.get(method, method),
+            statuses.get(status, status),
+            total, discount, final,
+            served_by,
+        ]
+
+
+class _Echo:
+    """File-like object whose write() hands back the line csv.writer formatted"""
+
+    def write(self, value):
+        return value
+
+
+def sales_csv(sales):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for row in _rows(sales):
+        yield writer.writerow(row)
+
+
+def _money(value):
+    return f'{value or 0:,.2f}'
+
+
+def sales_pdf(sales, start_date, end_date):
+    """The sales report as PDF, generated page by page"""
+    summary = sales.aggregate(
+        total_sales=Sum('total_amount'),
+        total_discount=Sum('discount'),
+        final_amount=Sum('final_amount'),
+        total_transactions=Count('id'),
+    )
+    pdf = StreamingPdf(title=f'Sales Report {start_date} to {end_date}')
+    width, height = pdf.width, pdf.height
+    yield pdf.begin()
+
+    page_number = 0
+
+    def new_page():
+        nonlocal page_number
+        page_number += 1
+        canvas = PageCanvas()
+        canvas.text(PDF_MARGIN, PDF_MARGIN / 2, f'Eldoret Chemist - Sales Report {start_date} to {end_date}', size=8)
+        canvas.text_right(width - PDF_MARGIN, PDF_MARGIN / 2, str(page_number), size=8)
+        return canvas, height - PDF_MARGIN
+
+    canvas, y = new_page()
+    canvas.text(PDF_MARGIN, y - 10, 'Eldoret Chemist - Sales Report', font='F2', size=18)
+    canvas.text(PDF_MARGIN, y - 34, f'Period: {start_date} to {end_date}', size=10)
+    y -= 64
+    for label, value in [
+        ('Total Sales', f"KES {_money(summary['total_sales'])}"),
+        ('Discounts', f"KES {_money(summary['total_discount'])}"),
+        ('Final Amount', f"KES {_money(summary['final_amount'])}"),
+        ('Total Transactions', str(summary['total_transactions'])),
+    ]:
+        canvas.text(PDF_MARGIN, y, label, font='F2', size=10)
+        canvas.text(PDF_MARGIN + 150, y, value, size=10)
+        y -= PDF_ROW_HEIGHT + 2
+    y -= PDF_ROW_HEIGHT
+
+    def table_header(canvas, y):
+        for (x, right), label in zip(PDF_COLUMNS, EXPORT_COLUMNS[:-1]):
+            label = label.replace(' Method', '').replace('Final Amount', 'Final')
+            (canvas.text_right if right else canvas.text)(x, y, label, font='F2')
+        canvas.line(PDF_MARGIN, y - 4, width - PDF_MARGIN, y - 4)
+        return y - PDF_ROW_HEIGHT - 2
+
+    y = table_header(canvas, y)
+    for row in _rows(sales):
+        if y < PDF_MARGIN + PDF_ROW_HEIGHT:
+            yield pdf.page(canvas)
+            canvas, y = new_page()
+            y = table_header(canvas, y)
+        date, receipt, customer, method, status, total, discount, final, _ = row
+        values = [date, receipt, customer[:22], method, status, _money(total), _money(discount), _money(final)]
+        for (x, right), value in zip(PDF_COLUMNS, values):
+            (canvas.text_right if right else canvas.text)(x, y, value)
+        y -= PDF_ROW_HEIGHT
+    yield pdf.page(canvas)
+    yield pdf.end()
+
+
+def sales_report_pdf(start_date, end_date, **filters):
+    """The whole PDF as bytes, for background jobs that store it"""
+    return b''.join(sales_pdf(export_sales(start_date, end_date, **filters), start_date, end_date))
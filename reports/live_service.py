@@ -0,0 +1,144 @@
+"""
+Live dashboard events over Server-Sent Events.
+
+Sale and stock alert signals publish small events to a broker. One DashboardHub per process
+listens to the broker, recomputes the dashboard figures once per event and
+fans the same message out to every connected browser. Open tabs no longer
+poll the aggregates independently.
+
+InMemoryBroker only reaches subscribers in the publishing process, which is
+enough for a single ASGI worker and for tests. LIVE_EVENTS_BROKER can point
+at a class with the same publish()/listen() interface backed by a shared
+pub/sub service.
+
+The stream never ends, so it is only served over ASGI. Under WSGI a worker
+would be tied up for as long as the page stayed open, so the endpoint answers
+204 and the dashboard doesn't open it (see live_events_enabled()).
+"""
+import asyncio
+import json
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from inventory.dashboard_service import dashboard_metrics
+from inventory.models import AlertState, Product
+from .rollup_service import sales_totals
+
+# Comment line sent when nothing happened, so proxies keep the stream open
+KEEPALIVE_SECONDS = 15
+# Messages buffered per client; a client that falls further behind loses the oldest ones
+CLIENT_BUFFER = 20
+
+
+def live_events_enabled(request):
+    """Whether ``request`` can be answered with a live stream: LIVE_EVENTS is on and it came in over ASGI"""
+    return getattr(settings, 'LIVE_EVENTS', True) and isinstance(request, ASGIRequest)
+
+
+class InMemoryBroker:
+    """Delivers published events to listeners in this process, from any thread"""
+
+    def __init__(self):
+        self._listeners = set()
+        self._lock = threading.Lock()
+
+    def publish(self, event, data):
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            loop, queue = listener
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, (event, data))
+            except RuntimeError:
+                # The listener's event loop has shut down
+                with self._lock:
+                    self._listeners.discard(listener)
+
+    async def listen(self):
+        listener = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            self._listeners.add(listener)
+        try:
+            while True:
+                yield await listener[1].get()
+        finally:
+            with self._lock:
+                self._listeners.discard(listener)
+
+
+def format_sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n'
+
+
+def dashboard_snapshot():
+    today = timezone.localdate()
+    return {'metrics': dashboard_metrics(today), 'today': sales_totals(today, today)}
+
+
+def low_stock_products(product_ids):
+    return list(
+        Product.objects.filter(pk__in=product_ids, alerts__kind=AlertState.LOW_STOCK).values('id', 'name', 'quantity_in_stock', 'minimum_stock_level')
+    )
+
+
+class DashboardHub:
+    def __init__(self, broker):
+        self.broker = broker
+        self.clients = set()
+        self._task = None
+
+    def start(self):
+        """Start listening on the running event loop; safe to call repeatedly"""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _send(self, message):
+        for queue in list(self.clients):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+    async def _run(self):
+        async for event, data in self.broker.listen():
+            # One aggregate computation per event, however many clients are connected
+            snapshot = await sync_to_async(dashboard_snapshot)()
+            self._send(format_sse(event, {**data, 'dashboard': snapshot}))
+            if data.get('product_ids'):
+                low_stock = await sync_to_async(low_stock_products)(data['product_ids'])
+                if low_stock:
+                    self._send(format_sse('low_stock', {'products': low_stock}))
+
+    async def subscribe(self):
+        """SSE stream for one client: the current figures, then every event"""
+        self.start()
+        queue = asyncio.Queue(maxsize=CLIENT_BUFFER)
+        self.clients.add(queue)
+        try:
+            yield format_sse('snapshot', {'dashboard': await sync_to_async(dashboard_snapshot)()})
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+        finally:
+            self.clients.discard(queue)
+
+
+broker = import_string(getattr(settings, 'LIVE_EVENTS_BROKER', 'reports.live_service.InMemoryBroker'))()
+hub = DashboardHub(broker)
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from sales.models import Sale
+from reports.rollup_service import rebuild_rollup
+from reports.tasks import rebuild_rollup_task
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily sales rollup tables for a range of local days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='First day to rebuild (YYYY-MM-DD), defaults to the first sale')
+        parser.add_argument('--end', help='Last day to rebuild (YYYY-MM-DD), defaults to today')
+        parser.add_argument('--chunk-days', type=int, default=31,
+                            help='Rebuild this many days per transaction')
+        parser.add_argument('--background', action='store_true',
+                            help='Queue one job per chunk for the run_jobs worker instead')
+
+    def _parse(self, value):
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError(f'Invalid date "{value}", expected YYYY-MM-DD')
+
+    def handle(self, *args, **options):
+        end = self._parse(options['end']) if options['end'] else timezone.localdate()
+        if options['start']:
+            start = self._parse(options['start'])
+        else:
+            first_sale = Sale.objects.aggregate(first=Min('sale_date'))['first']
+            if first_sale is None:
+                self.stdout.write('No sales to roll up')
+                return
+            start = timezone.localdate(first_sale)
+        if start > end:
+            raise CommandError('--start must not be after --end')
+
+        chunk_start = start
+        while chunk_start <= end:
+            chunk_end = min(chunk_start + timedelta(days=options['chunk_days'] - 1), end)
+            if options['background']:
+                job = rebuild_rollup_task.enqueue(start=str(chunk_start), end=str(chunk_end))
+                self.stdout.write(f'Queued job {job.pk} for {chunk_start} to {chunk_end}')
+            else:
+                rebuild_rollup(chunk_start, chunk_end)
+                self.stdout.write(f'Rebuilt {chunk_start} to {chunk_end}')
+            chunk_start = chunk_end + timedelta(days=1)
+
+        if not options['background']:
+            self.stdout.write(self.style.SUCCESS(f'Sales rollup rebuilt for {start} to {end}'))
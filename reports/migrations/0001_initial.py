@@ -0,0 +1,100 @@
+# Generated by Django 5.2.5 on 2026-10-18 00:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+
+def backfill_rollups(apps, schema_editor):
+    """Roll up existing paid sales; afterwards the tables are maintained incrementally"""
+    Sale = apps.get_model('sales', 'Sale')
+    SaleItem = apps.get_model('sales', 'SaleItem')
+    DailySalesRollup = apps.get_model('reports', 'DailySalesRollup')
+    DailySalesTotal = apps.get_model('reports', 'DailySalesTotal')
+    tz = timezone.get_current_timezone()
+
+    lines = (
+        SaleItem.objects.filter(sale__status='paid')
+        .annotate(day=TruncDate('sale__sale_date', tzinfo=tz))
+        .values('day', 'sale__payment_method', 'product__category_id', 'product_id')
+        .annotate(q=Sum('quantity'), r=Sum('total_price'), c=Sum(F('quantity') * F('unit_cost')))
+        .order_by()
+    )
+    DailySalesRollup.objects.bulk_create(
+        [
+            DailySalesRollup(
+                day=row['day'], payment_method=row['sale__payment_method'],
+                category_id=row['product__category_id'], product_id=row['product_id'],
+                quantity=row['q'], revenue=row['r'], cost=row['c'],
+            )
+            for row in lines
+        ],
+        batch_size=1000,
+    )
+
+    totals = (
+        Sale.objects.filter(status='paid')
+        .annotate(day=TruncDate('sale_date', tzinfo=tz))
+        .values('day', 'payment_method')
+        .annotate(n=Count('id'), t=Sum('total_amount'), d=Sum('discount'), f=Sum('final_amount'))
+        .order_by()
+    )
+    DailySalesTotal.objects.bulk_create(
+        [
+            DailySalesTotal(
+                day=row['day'], payment_method=row['payment_method'], sale_count=row['n'],
+                total_amount=row['t'], discount=row['d'], final_amount=row['f'],
+            )
+            for row in totals
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('inventory', '0002_stockmovement_stocksnapshot'),
+        ('sales', '0002_mpesatransaction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySalesTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('payment_method', models.CharField(choices=[('cash', 'Cash'), ('mpesa', 'M-Pesa'), ('card', 'Card'), ('credit', 'Credit')], max_length=10)),
+                ('sale_count', models.IntegerField(default=0)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('discount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('final_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'ordering': ['-day'],
+                'constraints': [models.UniqueConstraint(fields=('day', 'payment_method'), name='unique_daily_sales_total')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailySalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('payment_method', models.CharField(choices=[('cash', 'Cash'), ('mpesa', 'M-Pesa'), ('card', 'Card'), ('credit', 'Credit')], max_length=10)),
+                ('quantity', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('cost', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='inventory.category')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='inventory.product')),
+            ],
+            options={
+                'ordering': ['-day'],
+                'constraints': [models.UniqueConstraint(fields=('day', 'payment_method', 'category', 'product'), name='unique_daily_sales_rollup')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
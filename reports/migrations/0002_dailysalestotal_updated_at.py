@@ -0,0 +1,22 @@
+# Generated by Django 5.2.5 on 2026-10-18 00:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailysalestotal',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='dailysalestotal',
+            index=models.Index(fields=['updated_at'], name='dailysalestotal_updated_idx'),
+        ),
+    ]
@@ -1,3 +1,55 @@
 from django.db import models
+from inventory.models import Category, Product
+from sales.models import Sale
 
-# Create your models here.
+
+class DailySalesRollup(models.Model):
+    """Paid sale lines summed per local day, payment method, category and product"""
+    day = models.DateField()
+    payment_method = models.CharField(max_length=10, choices=Sale.PAYMENT_METHODS)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='+')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    quantity = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    cost = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['-day']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['day', 'payment_method', 'category', 'product'],
+                name='unique_daily_sales_rollup',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.payment_method} {self.product_id}: {self.quantity}"
+
+
+class DailySalesTotal(models.Model):
+    """
+    Sale-level totals per local day and payment method.
+
+    Kept beside DailySalesRollup because transaction counts and discounts
+    belong to a whole sale and cannot be summed from per-product rows.
+    """
+    day = models.DateField()
+    payment_method = models.CharField(max_length=10, choices=Sale.PAYMENT_METHODS)
+    sale_count = models.IntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    discount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    final_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    # Bumped on every write; the latest value versions the rollup for HTTP revalidation
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-day']
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'payment_method'], name='unique_daily_sales_total'),
+        ]
+        indexes = [
+            models.Index(fields=['updated_at'], name='dailysalestotal_updated_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.payment_method}: {self.sale_count} sales"
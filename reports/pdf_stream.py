@@ -0,0 +1,105 @@
+"""
+Minimal PDF writer that emits a document one page at a time.
+
+reportlab keeps every page of a document in memory until it is saved, which
+is fine for a receipt but not for a month of sales. StreamingPdf writes text
+pages in the standard Helvetica fonts, hands each page out as bytes as soon as
+it is finished, and keeps only the object offsets it needs for the
+cross-reference table at the end.
+"""
+import zlib
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase.pdfmetrics import stringWidth
+
+FONTS = {'F1': 'Helvetica', 'F2': 'Helvetica-Bold'}
+CATALOG, PAGES, FIRST_FONT = 1, 2, 3
+
+
+def escape(text):
+    return (
+        str(text).replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+        .encode('cp1252', 'replace')
+    )
+
+
+class PageCanvas:
+    """Collects the drawing operators for one page"""
+
+    def __init__(self):
+        self.ops = []
+
+    def text(self, x, y, text, font='F1', size=9):
+        self.ops.append(b'BT /%s %d Tf %.2f %.2f Td (%s) Tj ET' % (font.encode(), size, x, y, escape(text)))
+
+    def text_right(self, x, y, text, font='F1', size=9):
+        self.text(x - stringWidth(str(text), FONTS[font], size), y, text, font, size)
+
+    def line(self, x1, y1, x2, y2, width=0.5):
+        self.ops.append(b'%.2f w %.2f %.2f m %.2f %.2f l S' % (width, x1, y1, x2, y2))
+
+    def content(self):
+        return b'\n'.join(self.ops)
+
+
+class StreamingPdf:
+    def __init__(self, pagesize=A4, title=''):
+        self.width, self.height = pagesize
+        self.title = title
+        self.offset = 0
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = FIRST_FONT + len(FONTS)
+
+    def _object(self, obj_id, body):
+        self.offsets[obj_id] = self.offset
+        data = b'%d 0 obj\n%s\nendobj\n' % (obj_id, body)
+        self.offset += len(data)
+        return data
+
+    def _new_id(self):
+        obj_id = self.next_id
+        self.next_id += 1
+        return obj_id
+
+    def begin(self):
+        header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+        self.offset = len(header)
+        chunks = [header, self._object(CATALOG, b'<< /Type /Catalog /Pages %d 0 R >>' % PAGES)]
+        for number, name in enumerate(FONTS.values()):
+            chunks.append(self._object(
+                FIRST_FONT + number,
+                b'<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>' % name.encode(),
+            ))
+        return b''.join(chunks)
+
+    def page(self, canvas):
+        stream = zlib.compress(canvas.content())
+        content_id, page_id = self._new_id(), self._new_id()
+        self.page_ids.append(page_id)
+        fonts = b' '.join(
+            b'/%s %d 0 R' % (key.encode(), FIRST_FONT + number) for number, key in enumerate(FONTS)
+        )
+        return self._object(
+            content_id,
+            b'<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream' % (len(stream), stream),
+        ) + self._object(
+            page_id,
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.2f %.2f] /Contents %d 0 R '
+            b'/Resources << /Font << %s >> >> >>' % (PAGES, self.width, self.height, content_id, fonts),
+        )
+
+    def end(self):
+        kids = b' '.join(b'%d 0 R' % page_id for page_id in self.page_ids)
+        chunks = [self._object(PAGES, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self.page_ids)))]
+        info_id = self._new_id()
+        chunks.append(self._object(info_id, b'<< /Title (%s) /Producer (Eldoret Chemist) >>' % escape(self.title)))
+        xref_offset = self.offset
+        xref = [b'xref\n0 %d\n0000000000 65535 f \n' % self.next_id]
+        xref += [b'%010d 00000 n \n' % self.offsets[obj_id] for obj_id in range(1, self.next_id)]
+        chunks.append(b''.join(xref))
+        chunks.append(
+            b'trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+            % (self.next_id, CATALOG, info_id, xref_offset)
+        )
+        return b''.join(chunks)
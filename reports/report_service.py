@@ -0,0 +1,298 @@
+"""
+Sales report figures, with the days before today served from a cache.
+
+sales_report_figures() works out the sales report's totals, top products, top
+categories and payment breakdown. It splits the date range at today. The
+closed days before today come from ReportCache, keyed on the normalized
+filters, and only the part from today on is computed on every request. Each
+part is kept as per-product and per-payment-method sums so the two can be
+added together before the top ten lists are picked.
+
+A closed day only changes when one of its sales is refunded, edited or paid
+late, and each of those writes the day's DailySalesTotal rows. An entry is
+stored with the latest updated_at and row count of those rows over its days
+and is served while one indexed aggregate still returns the same pair, so a
+change made in any worker shows up on the next request. Entries don't expire
+otherwise. The cache is a process-local LRU bounded by REPORT_CACHE_SIZE
+entries and REPORT_CACHE_MAX_ROWS product rows.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, F, Max, Q, Sum
+from django.utils import timezone
+
+from pharmacy.date_windows import range_window, within
+from sales.models import Sale, SaleItem, LINE_COST
+from .models import DailySalesTotal
+from .rollup_service import sales_totals, sales_lines
+
+ReportFilters = namedtuple('ReportFilters', 'payment_method category customer_search invoice_search')
+TOTAL_FIELDS = ('total_sales', 'total_subtotal', 'total_discount', 'total_transactions', 'total_cost')
+TOP_LIMIT = 10
+
+
+def normalize_filters(payment_method='', category='', customer_search='', invoice_search=''):
+    """The report filters in a canonical form, so equivalent requests share a cache entry"""
+    return ReportFilters(
+        payment_method=(payment_method or '').strip().lower(),
+        category=(category or '').strip(),
+        # The search is case-insensitive, so its case doesn't make a different report
+        customer_search=(customer_search or '').strip().lower(),
+        invoice_search=(invoice_search or '').strip().lstrip('#'),
+    )
+
+
+def _sale_filters(window, filters):
+    q = within('sale_date', window)
+    if filters.payment_method:
+        q &= Q(payment_method=filters.payment_method)
+    if filters.customer_search:
+        q &= Q(customer_name__icontains=filters.customer_search)
+    if filters.invoice_search:
+        # Receipts are numbered by sale id (#123); anything else matches no sale
+        invoice = filters.invoice_search
+        q &= Q(pk=int(invoice)) if invoice.isdigit() else Q(pk__in=[])
+    if filters.category:
+        q &= Q(items__product__category__name=filters.category)
+    return q
+
+
+def report_sales(start, end, filters):
+    """Sales listed on the report page, newest first"""
+    return (
+        Sale.objects.filter(_sale_filters(range_window(start, end), filters))
+        .select_related('served_by').prefetch_related('items__product__category').distinct()
+    )
+
+
+def report_sales_count(start, end, filters):
+    """How many sales report_sales() lists, counted without a DISTINCT subquery"""
+    return Sale.objects.filter(_sale_filters(range_window(start, end), filters)).aggregate(
+        count=Count('pk', distinct=True)
+    )['count']
+
+
+def _raw_segment(start, end, filters):
+    # Customer and invoice filters can't be answered from the daily rollup
+    window = range_window(start, end)
+    # Paid sales only, as in the rollup, so the two kinds of segment can be added together
+    sale_filters = _sale_filters(window, filters) & Q(status='paid')
+    matching = Sale.objects.filter(sale_filters).values('pk')
+    sales = Sale.objects.filter(sale_filters).distinct()
+    # Top products and cost come from the same sales as the totals; like the
+    # rollup, a category filter counts only that category's lines of them
+    lines = SaleItem.objects.filter(sale__in=matching)
+    if filters.category:
+        lines = lines.filter(product__category__name=filters.category)
+    # Cost of every matching line in one aggregate, not a Python walk over each sale
+    line_totals = lines.aggregate(revenue=Sum('total_price'), cost=LINE_COST)
+    if filters.category:
+        # Sale-level totals aren't split by category, so report the category's lines
+        totals = {
+            'total_sales': line_totals['revenue'] or 0,
+            'total_subtotal': line_totals['revenue'] or 0,
+            'total_discount': None,
+            'total_transactions': None,
+        }
+    else:
+        # Subtotal is reported as the amount charged, as in the rollup; older
+        # and admin-created sales never had Sale.subtotal filled in
+        totals = sales.aggregate(
+            total_sales=Sum('total_amount'),
+            total_subtotal=Sum('total_amount'),
+            total_discount=Sum('discount'),
+            total_transactions=Count('id'),
+        )
+    totals['total_cost'] = line_totals['cost'] or 0
+    products = lines.values(
+        'product_id', 'product__name', category__name=F('product__category__name')
+    ).annotate(quantity=Sum('quantity'), revenue=Sum('total_price'))
+    payments = sales.values('payment_method').annotate(count=Count('id'), total=Sum('total_amount'))
+    return _segment_from(totals, products, payments)
+
+
+def _rollup_segment(start, end, filters):
+    # Everything is read from the pre-aggregated daily rollup, so the cost
+    # depends on the number of days, not the number of sales
+    lines = sales_lines(start, end, filters.payment_method, filters.category)
+    line_totals = lines.aggregate(revenue=Sum('revenue'), cost=Sum('cost'))
+    if filters.category:
+        # Sale-level totals aren't split by category, so report the category's lines
+        sale_totals = {'sale_count': None, 'total_amount': line_totals['revenue'] or 0, 'discount': None}
+    else:
+        sale_totals = sales_totals(start, end, filters.payment_method)
+    totals = {
+        'total_sales': sale_totals['total_amount'],
+        'total_subtotal': sale_totals['total_amount'],
+        'total_discount': sale_totals['discount'],
+        'total_transactions': sale_totals['sale_count'],
+        'total_cost': line_totals['cost'] or 0,
+    }
+    products = lines.values('product_id', 'product__name', 'category__name').annotate(
+        quantity=Sum('quantity'), revenue=Sum('revenue')
+    )
+    breakdown = DailySalesTotal.objects.filter(day__range=(start, end))
+    if filters.payment_method:
+        breakdown = breakdown.filter(payment_method=filters.payment_method)
+    payments = breakdown.values('payment_method').annotate(count=Sum('sale_count'), total=Sum('total_amount'))
+    return _segment_from(totals, products, payments)
+
+
+def _segment_from(totals, products, payments):
+    return {
+        'totals': totals,
+        'products': {
+            row['product_id']: (row['product__name'], row['category__name'], row['quantity'], row['revenue'])
+            for row in products.order_by()
+        },
+        'payments': {row['payment_method']: (row['count'], row['total']) for row in payments.order_by()},
+    }
+
+
+def compute_segment(start, end, filters):
+    """Figures for local days start..end that can be added to another range's"""
+    if filters.customer_search or filters.invoice_search:
+        return _raw_segment(start, end, filters)
+    return _rollup_segment(start, end, filters)
+
+
+def _add(values):
+    # None means "not available for these filters", e.g. discounts of one category's lines
+    present = [value for value in values if value is not None]
+    return sum(present) if present else None
+
+
+def combine(segments):
+    """The report figures of consecutive ranges, in the shape the template reads"""
+    totals = {field: _add(segment['totals'][field] for segment in segments) for field in TOTAL_FIELDS}
+    products, categories, payments = {}, {}, {}
+    merged = {}
+    for segment in segments:
+        for product_id, (name, category, quantity, revenue) in segment['products'].items():
+            row = merged.setdefault(product_id, [name, category, 0, 0])
+            row[2] += quantity
+            row[3] += revenue
+        for method, (count, total) in segment['payments'].items():
+            row = payments.setdefault(method, {'payment_method': method, 'count': 0, 'total': 0})
+            row['count'] += count
+            row['total'] += total
+    for product_id, (name, category, quantity, revenue) in merged.items():
+        row = products.setdefault((name, category), {
+            'product__name': name, 'category__name': category, 'total_quantity': 0, 'total_revenue': 0,
+        })
+        row['total_quantity'] += quantity
+        row['total_revenue'] += revenue
+        row = categories.setdefault(category, {
+            'category__name': category, 'total_quantity': 0, 'total_revenue': 0, 'product_count': 0,
+        })
+        row['total_quantity'] += quantity
+        row['total_revenue'] += revenue
+        row['product_count'] += 1
+
+    transactions = totals['total_transactions']
+    return {
+        'financial_data': {
+            'total_sales': totals['total_sales'],
+            'total_subtotal': totals['total_subtotal'],
+            'total_discount': totals['total_discount'],
+            'average_sale': totals['total_sales'] / transactions if transactions else None,
+            'total_transactions': transactions,
+        },
+        'total_cost': totals['total_cost'] or 0,
+        'top_products': sorted(products.values(), key=lambda row: -row['total_quantity'])[:TOP_LIMIT],
+        'top_categories': sorted(categories.values(), key=lambda row: -row['total_revenue'])[:TOP_LIMIT],
+        'payment_breakdown': sorted(payments.values(), key=lambda row: -row['total']),
+    }
+
+
+def _closed_days_version(start, end):
+    state = DailySalesTotal.objects.filter(day__range=(start, end)).aggregate(
+        latest=Max('updated_at'), rows=Count('id')
+    )
+    return state['latest'], state['rows']
+
+
+class ReportCache:
+    def __init__(self, maxsize=None, max_rows=None):
+        self.maxsize = maxsize or getattr(settings, 'REPORT_CACHE_SIZE', 256)
+        self.max_rows = max_rows or getattr(settings, 'REPORT_CACHE_MAX_ROWS', 200000)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (start, end, filters) -> (version, segment), least recently used first
+        self.rows = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _rows(segment):
+        return len(segment['products']) + 1
+
+    def get(self, start, end, filters):
+        """Figures for the closed days start..end, computed only if the rollup has changed"""
+        key = (start, end, filters)
+        # Read before computing: a change that lands in between leaves an
+        # entry that fails its next check rather than one that never does
+        version = _closed_days_version(start, end)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            if entry is not None:
+                self.stale += 1
+
+        segment = compute_segment(start, end, filters)
+        rows = self._rows(segment)
+        if rows > self.max_rows:
+            return segment
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.rows -= self._rows(old[1])
+            self._entries[key] = (version, segment)
+            self.rows += rows
+            while len(self._entries) > self.maxsize or self.rows > self.max_rows:
+                self.rows -= self._rows(self._entries.popitem(last=False)[1][1])
+                self.evictions += 1
+        return segment
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.rows = 0
+            self.hits = self.misses = self.stale = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'rows': self.rows,
+                'max_rows': self.max_rows,
+            }
+
+
+report_cache = ReportCache()
+
+
+def sales_report_figures(start, end, filters, today=None):
+    """Report figures for local days start..end; only days from today on are computed every time"""
+    today = today or timezone.localdate()
+    segments = []
+    if start < today:
+        segments.append(report_cache.get(start, min(end, today - timedelta(days=1)), filters))
+    if end >= today:
+        segments.append(compute_segment(max(start, today), end, filters))
+    return combine(segments)
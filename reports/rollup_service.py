@@ -0,0 +1,201 @@
+from collections import defaultdict
+from decimal import Decimal
+from functools import reduce
+from operator import or_
+
+from django.db import transaction, IntegrityError
+from django.db.models import Sum, Count, Max, Q
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from pharmacy.date_windows import range_window, within
+from sales.models import Sale, SaleItem, LINE_COST
+from .models import DailySalesRollup, DailySalesTotal
+
+LINE_KEY = ('day', 'payment_method', 'category_id', 'product_id')
+LINE_MEASURES = ('quantity', 'revenue', 'cost')
+TOTAL_KEY = ('day', 'payment_method')
+TOTAL_MEASURES = ('sale_count', 'total_amount', 'discount', 'final_amount')
+
+
+def _apply_deltas(model, key_fields, measures, deltas):
+    """
+    Add {key tuple: {measure: delta}} onto rollup rows with a fixed number of queries.
+
+    Existing rows are locked and updated with bulk_update, missing rows are
+    inserted with bulk_create. If another worker inserts the same key first
+    the unique constraint fires and the whole batch is retried as updates.
+    """
+    if not deltas:
+        return
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                matches = reduce(or_, [Q(**dict(zip(key_fields, key))) for key in deltas])
+                existing = {
+                    tuple(getattr(row, field) for field in key_fields): row
+                    for row in model.objects.select_for_update().filter(matches)
+                }
+                to_update, to_create = [], []
+                # bulk_update skips auto_now, so stamp updated_at by hand where the model has one
+                stamped = [field for field in ('updated_at',) if hasattr(model, field)]
+                now = timezone.now()
+                for key, values in deltas.items():
+                    row = existing.get(key)
+                    if row is None:
+                        to_create.append(model(**dict(zip(key_fields, key)), **values))
+                    else:
+                        for measure, value in values.items():
+                            setattr(row, measure, getattr(row, measure) + value)
+                        for field in stamped:
+                            setattr(row, field, now)
+                        to_update.append(row)
+                if to_update:
+                    model.objects.bulk_update(to_update, [*measures, *stamped])
+                model.objects.bulk_create(to_create)
+            return
+        except IntegrityError:
+            if attempt:
+                raise
+
+
+def _sale_deltas(sale, items, sign):
+    day = timezone.localdate(sale.sale_date)
+    lines = defaultdict(lambda: {'quantity': 0, 'revenue': Decimal('0'), 'cost': Decimal('0')})
+    for item in items:
+        key = (day, sale.payment_method, item.product.category_id, item.product_id)
+        lines[key]['quantity'] += sign * item.quantity
+        lines[key]['revenue'] += sign * item.total_price
+        lines[key]['cost'] += sign * item.quantity * item.unit_cost
+    totals = {
+        (day, sale.payment_method): {
+            'sale_count': sign,
+            'total_amount': sign * sale.total_amount,
+            'discount': sign * sale.discount,
+            'final_amount': sign * sale.final_amount,
+        }
+    }
+    return dict(lines), totals
+
+
+def _merge(into, deltas):
+    for key, values in deltas.items():
+        row = into.setdefault(key, dict.fromkeys(values, 0))
+        for measure, value in values.items():
+            row[measure] += value
+
+
+def record_sales(sales, sign=1):
+    """Add (sale, items) pairs to the rollups with one set of queries for the whole batch"""
+    lines, totals = {}, {}
+    for sale, items in sales:
+        sale_lines, sale_totals = _sale_deltas(sale, items, sign)
+        _merge(lines, sale_lines)
+        _merge(totals, sale_totals)
+    with transaction.atomic():
+        _apply_deltas(DailySalesRollup, LINE_KEY, LINE_MEASURES, lines)
+        _apply_deltas(DailySalesTotal, TOTAL_KEY, TOTAL_MEASURES, totals)
+
+
+def record_sale(sale, items, sign=1):
+    """Add a paid sale to the rollups (sign=-1 takes it back out)"""
+    lines, totals = _sale_deltas(sale, items, sign)
+    with transaction.atomic():
+        _apply_deltas(DailySalesRollup, LINE_KEY, LINE_MEASURES, lines)
+        _apply_deltas(DailySalesTotal, TOTAL_KEY, TOTAL_MEASURES, totals)
+
+
+def record_refund(sale, items):
+    record_sale(sale, items, sign=-1)
+
+
+def rebuild_rollup(start, end):
+    """Recompute both rollup tables for local days start..end from the raw sales"""
+    local_day = TruncDate('sale_date', tzinfo=timezone.get_current_timezone())
+    paid_sales = Sale.objects.filter(within('sale_date', range_window(start, end)), status='paid')
+
+    lines = (
+        SaleItem.objects.filter(sale__in=paid_sales)
+        .annotate(day=TruncDate('sale__sale_date', tzinfo=timezone.get_current_timezone()))
+        .values('day', 'sale__payment_method', 'product__category_id', 'product_id')
+        .annotate(
+            total_quantity=Sum('quantity'),
+            total_revenue=Sum('total_price'),
+            total_cost=LINE_COST,
+        )
+        .order_by()
+    )
+    totals = (
+        paid_sales.annotate(day=local_day)
+        .values('day', 'payment_method')
+        .annotate(
+            count=Count('id'),
+            amount=Sum('total_amount'),
+            total_discount=Sum('discount'),
+            final=Sum('final_amount'),
+        )
+        .order_by()
+    )
+
+    with transaction.atomic():
+        DailySalesRollup.objects.filter(day__range=(start, end)).delete()
+        DailySalesTotal.objects.filter(day__range=(start, end)).delete()
+        DailySalesRollup.objects.bulk_create(
+            (
+                DailySalesRollup(
+                    day=row['day'],
+                    payment_method=row['sale__payment_method'],
+                    category_id=row['product__category_id'],
+                    product_id=row['product_id'],
+                    quantity=row['total_quantity'],
+                    revenue=row['total_revenue'],
+                    cost=row['total_cost'],
+                )
+                for row in lines.iterator()
+            ),
+            batch_size=1000,
+        )
+        DailySalesTotal.objects.bulk_create(
+            [
+                DailySalesTotal(
+                    day=row['day'],
+                    payment_method=row['payment_method'],
+                    sale_count=row['count'],
+                    total_amount=row['amount'],
+                    discount=row['total_discount'],
+                    final_amount=row['final'],
+                )
+                for row in totals
+            ],
+            batch_size=1000,
+        )
+
+
+def rollup_version():
+    """Changes whenever any rollup total is written, added or removed"""
+    state = DailySalesTotal.objects.aggregate(latest=Max('updated_at'), rows=Count('id'))
+    return state['latest'], state['rows']
+
+
+def sales_totals(start, end, payment_method=''):
+    """Sale-level totals for local days start..end, shaped like the old Sale aggregates"""
+    rows = DailySalesTotal.objects.filter(day__range=(start, end))
+    if payment_method:
+        rows = rows.filter(payment_method=payment_method)
+    totals = rows.aggregate(
+        sale_count=Sum('sale_count'),
+        total_amount=Sum('total_amount'),
+        discount=Sum('discount'),
+        final_amount=Sum('final_amount'),
+    )
+    return {key: value or 0 for key, value in totals.items()}
+
+
+def sales_lines(start, end, payment_method='', category=''):
+    """Rollup line rows for local days start..end, ready for values()/annotate()"""
+    rows = DailySalesRollup.objects.filter(day__range=(start, end))
+    if payment_method:
+        rows = rows.filter(payment_method=payment_method)
+    if category:
+        rows = rows.filter(category__name=category)
+    return rows
@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from inventory.alert_service import stock_alerts_changed
+from sales.signals import sale_completed, sale_refunded, sale_edited, sales_paid
+from .live_service import broker
+from .rollup_service import record_sale, record_sales, record_refund, rebuild_rollup
+from .tasks import rebuild_rollup_task
+
+
+@receiver(sale_completed)
+def add_sale_to_rollup(sender, sale, items, **kwargs):
+    if sale.status == 'paid':
+        record_sale(sale, items)
+
+
+@receiver(sale_refunded)
+def remove_sale_from_rollup(sender, sale, items, **kwargs):
+    record_refund(sale, items)
+
+
+@receiver(sales_paid)
+def add_paid_sales_to_rollup(sender, sales, **kwargs):
+    record_sales(sales)
+
+
+@receiver(sale_edited)
+def rebuild_rollup_for_sale_day(sender, sale, **kwargs):
+    # Admin edits can change anything about a sale, so recompute its whole day
+    day = timezone.localdate(sale.sale_date)
+    if getattr(settings, 'BACKGROUND_JOBS', False):
+        rebuild_rollup_task.enqueue(start=str(day), end=str(day))
+    else:
+        rebuild_rollup(day, day)
+
+
+# Live dashboard events go out after commit. inventory is installed before reports, so its
+# on_commit hooks have already refreshed the cached dashboard figures by then.
+
+@receiver(sale_completed)
+def publish_sale_completed(sender, sale, items, **kwargs):
+    data = {
+        'sale_id': sale.id,
+        'final_amount': str(sale.final_amount),
+        'product_ids': [item.product_id for item in items],
+    }
+    transaction.on_commit(lambda: broker.publish('sale_completed', data))
+
+
+@receiver(sale_refunded)
+def publish_sale_refunded(sender, sale, items, **kwargs):
+    data = {'sale_id': sale.id, 'final_amount': str(sale.final_amount)}
+    transaction.on_commit(lambda: broker.publish('sale_refunded', data))
+
+
+@receiver(sales_paid)
+def publish_sales_paid(sender, sales, **kwargs):
+    # One event per batch, so the dashboard is recomputed once however many payments settled
+    data = {
+        'sale_ids': [sale.id for sale, _ in sales],
+        'final_amount': str(sum(sale.final_amount for sale, _ in sales)),
+        'product_ids': sorted({item.product_id for _, items in sales for item in items}),
+    }
+    transaction.on_commit(lambda: broker.publish('sales_paid', data))
+
+
+@receiver(stock_alerts_changed)
+def publish_stock_alerts(sender, raised, cleared, **kwargs):
+    data = {
+        'raised': [{'product_id': pk, 'kind': kind} for pk, kind in raised],
+        'cleared': [{'product_id': pk, 'kind': kind} for pk, kind in cleared],
+    }
+    transaction.on_commit(lambda: broker.publish('stock_alerts', data))
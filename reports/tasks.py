@@ -0,0 +1,22 @@
+from datetime import date
+
+from jobs.queue_service import task, JobOutput
+from .export_service import sales_report_pdf
+from .rollup_service import rebuild_rollup
+
+
+@task(priority=5)
+def sales_report_pdf_task(start_date, end_date, **filters):
+    start_date, end_date = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    return JobOutput(
+        sales_report_pdf(start_date, end_date, **filters),
+        f'sales_report_{start_date}_to_{end_date}.pdf',
+        'application/pdf',
+    )
+
+
+@task()
+def rebuild_rollup_task(start, end):
+    start, end = date.fromisoformat(start), date.fromisoformat(end)
+    rebuild_rollup(start, end)
+    return {'start': str(start), 'end': str(end)}
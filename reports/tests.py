@@ -1,3 +1,727 @@
-from django.test import TestCase
+import asyncio
+import csv
+import re
+import time
+import tracemalloc
+from datetime import timedelta
+from decimal import Decimal
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from pharmacy.date_windows import day_window, month_window, range_window, within
+from pharmacy.query_plans import capture_selects, full_table_scans
+from inventory.models import Category, Supplier, Product
+from inventory.search_service import product_index
+from jobs.models import Job
+from jobs.queue_service import work
+from sales.checkout_service import checkout
+from sales.models import Sale, SaleItem
+from sales.signals import sale_edited
+from . import live_service
+from .live_service import DashboardHub, InMemoryBroker
+from .export_service import export_sales, sales_csv, sales_pdf
+from .models import DailySalesRollup, DailySalesTotal
+from .report_service import (
+    ReportCache, _raw_segment, _rollup_segment, combine, compute_segment, normalize_filters, report_cache, sales_report_figures,
+)
+
+
+def make_products(count, stock=1000):
+    category = Category.objects.create(name='Analgesics')
+    supplier = Supplier.objects.create(
+        name='Supplier', contact_person='Contact', phone='0700000000', address='Eldoret'
+    )
+    return [
+        Product.objects.create(
+            name=f'Product {i}', category=category, supplier=supplier,
+            cost_price=Decimal('6.00'), selling_price=Decimal('10.00'), quantity_in_stock=stock,
+        )
+        for i in range(count)
+    ]
+
+
+class DailySalesRollupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass', is_superuser=True)
+        self.products = make_products(2)
+
+    def _rollup_state(self):
+        lines = sorted(DailySalesRollup.objects.values_list(
+            'day', 'payment_method', 'product_id', 'quantity', 'revenue', 'cost'))
+        totals = sorted(DailySalesTotal.objects.values_list(
+            'day', 'payment_method', 'sale_count', 'total_amount', 'discount', 'final_amount'))
+        return lines, totals
+
+    def test_checkout_and_refund_update_rollup(self):
+        a, b = self.products
+        checkout(self.user, [{'id': a.id, 'quantity': 2}, {'id': b.id, 'quantity': 1}],
+                 discount=Decimal('5'))
+        sale, _ = checkout(self.user, [{'id': a.id, 'quantity': 3}], payment_method='mpesa')
+
+        today = timezone.localdate()
+        cash = DailySalesTotal.objects.get(day=today, payment_method='cash')
+        self.assertEqual((cash.sale_count, cash.total_amount, cash.final_amount),
+                         (1, Decimal('30.00'), Decimal('25.00')))
+        line = DailySalesRollup.objects.get(day=today, payment_method='cash', product=a)
+        self.assertEqual((line.quantity, line.revenue, line.cost), (2, Decimal('20.00'), Decimal('12.00')))
+
+        self.client.force_login(self.user)
+        self.client.post(f'/sales/refund/{sale.id}/')
+        mpesa = DailySalesTotal.objects.get(day=today, payment_method='mpesa')
+        self.assertEqual((mpesa.sale_count, mpesa.total_amount), (0, Decimal('0.00')))
+
+    def test_rebuild_matches_incremental_rollup(self):
+        a, b = self.products
+        for _ in range(3):
+            checkout(self.user, [{'id': a.id, 'quantity': 1}, {'id': b.id, 'quantity': 2}])
+        incremental = self._rollup_state()
+
+        DailySalesRollup.objects.all().delete()
+        DailySalesTotal.objects.all().delete()
+        today = timezone.localdate().isoformat()
+        call_command('rebuild_sales_rollup', start=today, end=today, stdout=open('/dev/null', 'w'))
+        self.assertEqual(self._rollup_state(), incremental)
+
+    def test_dashboard_api_reads_rollup(self):
+        checkout(self.user, [{'id': self.products[0].id, 'quantity': 4}])
+        self.client.force_login(self.user)
+        data = self.client.get('/reports/api/dashboard/').json()
+        self.assertEqual(data['today_sales']['count'], 1)
+        self.assertEqual(Decimal(data['today_sales']['total']), Decimal('40'))
+
+
+
+class BackgroundReportJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass')
+        self.products = make_products(1)
+        self.sale, _ = checkout(self.user, [{'id': self.products[0].id, 'quantity': 2}])
+        self.client.force_login(self.user)
+
+    def test_pdf_renders_inline(self):
+        response = self.client.get('/reports/sales/pdf/')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+
+    def test_pdf_can_be_built_by_a_worker(self):
+        today = timezone.localdate()
+        response = self.client.get(f'/reports/sales/pdf/?start_date={today}&end_date={today}&background=1')
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json()['status_url']
+        self.assertEqual(self.client.get(status_url).json()['status'], 'queued')
+
+        work(burst=True)
+        status = self.client.get(status_url).json()
+        self.assertEqual(status['status'], 'succeeded')
+        pdf = self.client.get(status['output_url'])
+        self.assertTrue(pdf.content.startswith(b'%PDF'))
+        self.assertIn(f'sales_report_{today}_to_{today}.pdf', pdf['Content-Disposition'])
+
+    @override_settings(BACKGROUND_JOBS=True)
+    def test_admin_edits_queue_the_rollup_rebuild(self):
+        Sale.objects.filter(pk=self.sale.pk).update(discount=Decimal('5.00'), final_amount=Decimal('15.00'))
+        self.sale.refresh_from_db()
+        sale_edited.send(sender=Sale, sale=self.sale)
+        self.assertEqual(DailySalesTotal.objects.get().final_amount, Decimal('20.00'))
+
+        self.assertEqual(Job.objects.get().name, 'reports.tasks.rebuild_rollup_task')
+        work(burst=True)
+        self.assertEqual(DailySalesTotal.objects.get().final_amount, Decimal('15.00'))
+
+
+def pdf_page_count(data):
+    """Check every cross-reference entry points at its object and return the page count"""
+    xref = int(re.search(rb'startxref\n(\d+)\n%%EOF\n$', data).group(1))
+    lines = data[xref:].split(b'\n')
+    assert lines[0] == b'xref'
+    for obj_id in range(1, int(lines[1].split()[1])):
+        offset = int(lines[2 + obj_id][:10])
+        assert data[offset:].startswith(b'%d 0 obj' % obj_id), obj_id
+    return int(re.search(rb'/Type /Pages /Kids \[[^\]]*\] /Count (\d+)', data).group(1))
+
+
+class SalesExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass')
+        self.products = make_products(2)
+        other = Category.objects.create(name='Antibiotics')
+        Product.objects.filter(pk=self.products[1].pk).update(category=other)
+        for i in range(60):
+            checkout(self.user, [
+                {'id': self.products[0].id, 'quantity': 1},
+                {'id': self.products[1].id, 'quantity': 1},
+            ] if i % 2 else [{'id': self.products[0].id, 'quantity': 2}],
+                customer_name=f'Customer {i}', payment_method='mpesa' if i % 3 else 'cash')
+        self.client.force_login(self.user)
+
+    def _csv(self, query=''):
+        response = self.client.get(f'/reports/sales/csv/{query}')
+        self.assertTrue(response.streaming)
+        return list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+
+    def test_csv_lists_every_sale(self):
+        rows = self._csv()
+        self.assertEqual(rows[0][:3], ['Date', 'Receipt', 'Customer'])
+        self.assertEqual(len(rows), 61)
+        self.assertEqual(rows[1][2], 'Customer 0')
+        self.assertEqual(rows[1][5:8], ['20.00', '0.00', '20.00'])
+
+    def test_csv_applies_the_report_filters(self):
+        self.assertEqual(len(self._csv('?payment_method=cash')), 1 + 20)
+        # Sales with lines in the category are listed once however many lines match
+        self.assertEqual(len(self._csv('?category=Antibiotics')), 1 + 30)
+        self.assertEqual(len(self._csv('?customer_search=Customer 1')), 1 + 11)
+        sale = Sale.objects.get(customer_name='Customer 7')
+        rows = self._csv(f'?invoice_search=%23{sale.pk}')
+        self.assertEqual([row[1] for row in rows[1:]], [f'#{sale.pk}'])
+        self.assertEqual(len(self._csv('?invoice_search=INV-1')), 1)
+
+    def test_background_pdf_keeps_the_invoice_filter(self):
+        sale = Sale.objects.get(customer_name='Customer 7')
+        response = self.client.get('/reports/sales/pdf/', {'invoice_search': sale.pk, 'background': 1})
+        job = Job.objects.get(pk=response.json()['job'])
+        self.assertEqual(job.kwargs['invoice_search'], str(sale.pk))
+        with patch('reports.export_service.sales_pdf', wraps=sales_pdf) as pdf:
+            work(burst=True)
+        self.assertEqual([sale.pk for sale in pdf.call_args.args[0]], [sale.pk])
+
+    def test_report_pages_through_every_sale(self):
+        seen = []
+        query = 'payment_method=mpesa'
+        with patch('reports.views.REPORT_PAGE_SIZE', 15):
+            for _ in range(3):
+                response = self.client.get(f'/reports/sales/?{query}')
+                self.assertEqual(response.context['sales_count'], 40)
+                seen += [sale.pk for sale in response.context['sales']]
+                query = response.context['next_page'] or ''
+                if query:
+                    self.assertContains(response, 'Older sales')
+                    self.assertIn('payment_method=mpesa', query)
+        self.assertEqual(query, '')
+        self.assertEqual(seen, list(Sale.objects.filter(payment_method='mpesa').order_by('-sale_date', '-id')
+                                    .values_list('pk', flat=True)))
+
+        response = self.client.get('/reports/sales/', {'cursor': 'not-a-cursor'})
+        self.assertContains(response, 'showing the latest sales')
+        self.assertEqual(len(response.context['sales']), 60)
+
+    def test_pdf_streams_every_sale(self):
+        response = self.client.get('/reports/sales/pdf/')
+        self.assertTrue(response.streaming)
+        data = b''.join(response.streaming_content)
+        self.assertTrue(data.startswith(b'%PDF-1.4'))
+        self.assertEqual(pdf_page_count(data), 2)
+
+    def test_exports_read_sales_in_chunks(self):
+        sales = export_sales(timezone.localdate(), timezone.localdate())
+        with patch('reports.export_service.EXPORT_CHUNK_SIZE', 25), \
+                CaptureQueriesContext(connection) as queries:
+            rows = list(sales_csv(sales))
+        self.assertEqual(len(rows), 61)
+        self.assertEqual(len(queries), 1)
+
+
+@tag('benchmark')
+class SalesExportBenchmark(TestCase):
+    """Time and peak Python memory of exporting 100k sales"""
+
+    SALES = 100000
+    CSV_BUDGET_SECONDS = 15
+    PDF_BUDGET_SECONDS = 30
+    MEMORY_BUDGET_MB = 16
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user('manager', password='pass')
+        Sale.objects.bulk_create([
+            Sale(
+                served_by=user, customer_name=f'Customer {i}', payment_method='cash', status='paid',
+                subtotal=Decimal('150.00'), total_amount=Decimal('150.00'), final_amount=Decimal('150.00'),
+            )
+            for i in range(cls.SALES)
+        ], batch_size=5000)
+
+    def _time(self, stream):
+        started = time.perf_counter()
+        chunks = size = 0
+        for chunk in stream:
+            chunks += 1
+            size += len(chunk)
+        return chunks, size, time.perf_counter() - started
+
+    def _peak_mb(self, stream):
+        # tracemalloc slows Python several times over, so memory is measured
+        # in a separate pass over the ~11k sales of customers 'Customer 1*'
+        tracemalloc.start()
+        try:
+            for _ in stream:
+                pass
+            return tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+
+    def test_export_100k_sales(self):
+        today = timezone.localdate()
+        sales = export_sales(today, today)
+        lines, _, csv_seconds = self._time(sales_csv(sales))
+        self.assertEqual(lines, self.SALES + 1)
+        _, size, pdf_seconds = self._time(sales_pdf(sales, today, today))
+
+        subset = export_sales(today, today, customer_search='Customer 1')
+        csv_peak = self._peak_mb(sales_csv(subset))
+        pdf_peak = self._peak_mb(sales_pdf(subset, today, today))
+        report = (f'CSV {csv_seconds:.1f}s peak {csv_peak:.1f}MB, '
+                  f'PDF {pdf_seconds:.1f}s {size / 2 ** 20:.1f}MB peak {pdf_peak:.1f}MB')
+        self.assertLess(csv_seconds, self.CSV_BUDGET_SECONDS, report)
+        self.assertLess(pdf_seconds, self.PDF_BUDGET_SECONDS, report)
+        self.assertLess(max(csv_peak, pdf_peak), self.MEMORY_BUDGET_MB, report)
+
+
+class SalesReportCostTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass', is_superuser=True)
+        product = make_products(1)[0]
+        for days_ago in range(0, 360, 12):
+            sale, _ = checkout(self.user, [{'id': product.id, 'quantity': 1}])
+            Sale.objects.filter(pk=sale.pk).update(sale_date=timezone.now() - timedelta(days=days_ago))
+        call_command('rebuild_sales_rollup', stdout=open('/dev/null', 'w'))
+        self.client.force_login(self.user)
+
+    def _report_queries(self, days):
+        report_cache.clear()
+        start = (timezone.localdate() - timedelta(days=days)).isoformat()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/reports/sales/', {'start_date': start})
+        self.assertEqual(response.status_code, 200)
+        return len(ctx), response.context
+
+    def test_twelve_month_report_costs_the_same_as_one_day(self):
+        # From yesterday, so both reports have closed days and today
+        one_day, _ = self._report_queries(1)
+        twelve_months, context = self._report_queries(365)
+        self.assertEqual(one_day, twelve_months)
+        self.assertEqual(context['financial_data']['total_transactions'], 30)
+        self.assertEqual(context['total_profit'], Decimal('120.00'))
+
+
+class SalesReportProfitQueryTests(TestCase):
+    """Customer-filtered reports read raw sales; their cost must not be computed per sale"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass', is_superuser=True)
+        self.products = make_products(3)
+        self.client.force_login(self.user)
+
+    def _sell(self, count):
+        for _ in range(count):
+            checkout(self.user, [{'id': p.id, 'quantity': 2} for p in self.products],
+                     customer_name='Jane Wanjiku')
+
+    def _report(self):
+        report_cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/reports/sales/', {'customer_search': 'Jane'})
+        return len(ctx), response.context
+
+    def test_query_count_is_constant_whatever_the_number_of_sales(self):
+        self._sell(2)
+        few, _ = self._report()
+        self._sell(20)
+        many, context = self._report()
+
+        self.assertEqual(few, many)
+        # 22 sales x 3 lines x 2 units: revenue 1320, cost 792
+        self.assertEqual(context['total_profit'], Decimal('528.00'))
+
+    def test_sale_cost_uses_annotation_or_prefetch(self):
+        self._sell(1)
+        with self.assertNumQueries(1):
+            sale = Sale.objects.with_cost().get()
+            self.assertEqual(sale.total_cost_price, Decimal('36.00'))
+        with self.assertNumQueries(2):
+            sale = Sale.objects.prefetch_related('items').get()
+            self.assertEqual(sale.total_cost_price, Decimal('36.00'))
+        sale = Sale.objects.get()
+        with self.assertNumQueries(1):
+            self.assertEqual(sale.total_cost_price, Decimal('36.00'))
+
+
+class ReportCacheTests(TestCase):
+    def setUp(self):
+        report_cache.clear()
+        self.user = User.objects.create_user('manager', password='pass', is_superuser=True)
+        self.products = make_products(3)
+        self.today = timezone.localdate()
+        # One sale today, three on each of two closed days
+        for days_ago in (0, 3, 10):
+            for product in self.products[:1 if days_ago == 0 else 3]:
+                self._sell(product, days_ago, method='mpesa' if days_ago == 3 else 'cash')
+        call_command('rebuild_sales_rollup', stdout=open('/dev/null', 'w'))
+        self.client.force_login(self.user)
+
+    def _sell(self, product, days_ago=0, method='cash'):
+        sale, _ = checkout(self.user, [{'id': product.id, 'quantity': 2}],
+                           payment_method=method, customer_name='Jane Wanjiku')
+        Sale.objects.filter(pk=sale.pk).update(sale_date=timezone.now() - timedelta(days=days_ago))
+        return sale
+
+    def _report(self, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/reports/sales/', {
+                'start_date': (self.today - timedelta(days=30)).isoformat(), **params,
+            })
+        self.assertEqual(response.status_code, 200)
+        return len(ctx), response.context
+
+    def test_closed_days_are_served_from_the_cache(self):
+        cold, first = self._report()
+        warm, second = self._report()
+        self.assertLess(warm, cold)
+        self.assertEqual(second['financial_data'], first['financial_data'])
+        self.assertEqual(second['top_products'], first['top_products'])
+        self.assertEqual(report_cache.stats()['hits'], 1)
+        self.assertEqual(report_cache.stats()['hit_rate'], 0.5)
+
+    def test_equivalent_filters_share_an_entry(self):
+        self._report(customer_search='Jane', payment_method='cash')
+        self._report(customer_search='  jane ', payment_method='CASH')
+        self.assertEqual(report_cache.stats()['size'], 1)
+        self.assertEqual(
+            normalize_filters('cash', '', 'jane', '#12'),
+            normalize_filters(' CASH', '', ' JANE ', '12'),
+        )
+
+    def test_split_figures_match_one_pass_over_the_range(self):
+        start = self.today - timedelta(days=30)
+        for filters in [
+            normalize_filters(),
+            normalize_filters(payment_method='cash'),
+            normalize_filters(category='Analgesics'),
+            normalize_filters(customer_search='jane'),
+        ]:
+            with self.subTest(filters=filters):
+                cached = sales_report_figures(start, self.today, filters)
+                self.assertEqual(cached, combine([compute_segment(start, self.today, filters)]))
+        figures = sales_report_figures(start, self.today, normalize_filters())
+        # 7 sales of 2 units at 10.00
+        self.assertEqual(figures['financial_data']['total_transactions'], 7)
+        self.assertEqual(figures['financial_data']['total_sales'], Decimal('140.00'))
+        self.assertEqual(figures['top_products'][0]['total_quantity'], 6)
+        self.assertEqual(figures['top_categories'][0]['product_count'], 3)
+
+    def test_raw_and_rollup_segments_agree(self):
+        # Unpaid sales are in neither; the raw path must leave them out like the rollup
+        pending = self._sell(self.products[1], 3)
+        refunded = self._sell(self.products[2], 10, method='mpesa')
+        Sale.objects.filter(pk=pending.pk).update(status='pending')
+        Sale.objects.filter(pk=refunded.pk).update(status='refunded')
+        # A sale mixing categories, and legacy sales that never had a subtotal
+        syrup = Product.objects.create(
+            name='Cough Syrup', category=Category.objects.create(name='Syrups'), supplier=self.products[0].supplier,
+            cost_price=Decimal('3.00'), selling_price=Decimal('8.00'), quantity_in_stock=10,
+        )
+        mixed, _ = checkout(self.user, [{'id': self.products[0].id, 'quantity': 1}, {'id': syrup.id, 'quantity': 2}])
+        Sale.objects.filter(pk=mixed.pk).update(sale_date=timezone.now() - timedelta(days=3))
+        Sale.objects.update(subtotal=0)
+        call_command('rebuild_sales_rollup', stdout=open('/dev/null', 'w'))
+        start = self.today - timedelta(days=30)
+        for filters in [
+            normalize_filters(),
+            normalize_filters(payment_method='mpesa'),
+            normalize_filters(category='Analgesics'),
+            normalize_filters(category='Syrups'),
+        ]:
+            with self.subTest(filters=filters):
+                raw = _raw_segment(start, self.today, filters)
+                rollup = _rollup_segment(start, self.today, filters)
+                self.assertEqual(raw['products'], rollup['products'])
+                self.assertEqual(raw['totals'], rollup['totals'])
+                if not filters.category:
+                    self.assertEqual(raw['payments'], rollup['payments'])
+        syrups = _raw_segment(start, self.today, normalize_filters(category='Syrups'))['totals']
+        self.assertEqual((syrups['total_sales'], syrups['total_subtotal']), (Decimal('16.00'), Decimal('16.00')))
+
+    def test_customer_search_narrows_top_products(self):
+        other, _ = checkout(self.user, [{'id': self.products[2].id, 'quantity': 5}], customer_name='Otieno')
+        figures = sales_report_figures(self.today, self.today, normalize_filters(customer_search='jane'))
+        self.assertEqual([row['total_quantity'] for row in figures['top_products']], [2])
+        self.assertNotIn(self.products[2].name, [row['product__name'] for row in figures['top_products']])
+
+    def test_todays_sales_are_always_recomputed(self):
+        _, before = self._report()
+        self._sell(self.products[0])
+        _, after = self._report()
+        self.assertEqual(after['financial_data']['total_transactions'],
+                         before['financial_data']['total_transactions'] + 1)
+        self.assertEqual(report_cache.stats()['hits'], 1)
+
+    def test_a_refund_on_a_closed_day_invalidates_it(self):
+        _, before = self._report()
+        past_sale = Sale.objects.filter(sale_date__lt=day_window()[0]).first()
+        response = self.client.post(f'/sales/refund/{past_sale.pk}/')
+        self.assertTrue(response.json()['success'])
+        _, after = self._report()
+        self.assertEqual(after['financial_data']['total_transactions'],
+                         before['financial_data']['total_transactions'] - 1)
+        self.assertEqual(report_cache.stats()['stale'], 1)
+
+    def test_lru_is_bounded_by_entries_and_rows(self):
+        cache = ReportCache(maxsize=2, max_rows=100)
+        yesterday = self.today - timedelta(days=1)
+        for method in ('cash', 'mpesa', 'card'):
+            cache.get(yesterday - timedelta(days=30), yesterday, normalize_filters(payment_method=method))
+        stats = cache.stats()
+        self.assertEqual((stats['size'], stats['evictions']), (2, 1))
+
+        # Three products and the totals take four rows; two such entries exceed six
+        cache = ReportCache(maxsize=10, max_rows=6)
+        cache.get(yesterday - timedelta(days=30), yesterday, normalize_filters())
+        cache.get(yesterday - timedelta(days=20), yesterday, normalize_filters())
+        self.assertEqual(cache.stats()['size'], 1)
+        self.assertLessEqual(cache.stats()['rows'], 6)
+
+    def test_invoice_search_matches_the_receipt_number(self):
+        sale = Sale.objects.filter(sale_date__lt=day_window()[0]).first()
+        _, context = self._report(invoice_search=f'#{sale.pk}')
+        self.assertEqual(list(context['sales']), [sale])
+        self.assertEqual(context['financial_data']['total_transactions'], 1)
+        _, context = self._report(invoice_search='INV-1')
+        self.assertEqual(list(context['sales']), [])
+
+    def test_stats_endpoint(self):
+        self._report()
+        self.assertEqual(self.client.get('/reports/api/report-cache/stats/').json()['misses'], 1)
+
+
+class DateWindowTests(TestCase):
+    def test_day_window_follows_local_midnight(self):
+        day = timezone.localdate()
+        lower, upper = day_window(day)
+        self.assertEqual(timezone.localtime(lower).date(), day)
+        self.assertEqual(timezone.localtime(lower).hour, 0)
+        self.assertEqual(upper - lower, timedelta(days=1))
+        self.assertEqual(lower.utcoffset(), timedelta(0))
+
+    def test_month_and_range_windows(self):
+        lower, upper = month_window(timezone.datetime(2024, 12, 15).date())
+        self.assertEqual(timezone.localtime(lower).date(), timezone.datetime(2024, 12, 1).date())
+        self.assertEqual(timezone.localtime(upper).date(), timezone.datetime(2025, 1, 1).date())
+        start = timezone.datetime(2024, 2, 27).date()
+        lower, upper = range_window(start, start + timedelta(days=2))
+        self.assertEqual(upper - lower, timedelta(days=3))
+
+    def test_sale_just_before_local_midnight_belongs_to_that_day(self):
+        user = User.objects.create_user('cashier', password='pass')
+        day = timezone.localdate() - timedelta(days=2)
+        lower, upper = day_window(day)
+        sale = Sale.objects.create(served_by=user, total_amount=Decimal('10.00'))
+        Sale.objects.filter(pk=sale.pk).update(sale_date=upper - timedelta(seconds=1))
+        self.assertTrue(Sale.objects.filter(within('sale_date', (lower, upper)), pk=sale.pk).exists())
+        self.assertFalse(Sale.objects.filter(within('sale_date', day_window(day + timedelta(days=1)))).exists())
+
+
+class HotPathQueryPlanTests(TestCase):
+    """EXPLAIN the queries behind the busiest pages on a seeded catalogue"""
+
+    PRODUCTS = 3000
+    SALES = 3000
+    # Small lookup tables that are meant to be listed in full, and the daily
+    # totals rollup (one row per day and payment method) counted for revalidation
+    ALLOWED_FULL_SCANS = {
+        'django_session', 'auth_user', 'inventory_category', 'inventory_supplier', 'reports_dailysalestotal',
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('manager', password='pass', is_superuser=True)
+        categories = [Category.objects.create(name=f'Category {i}') for i in range(20)]
+        supplier = Supplier.objects.create(
+            name='Supplier', contact_person='Contact', phone='0700000000', address='Eldoret'
+        )
+        today = timezone.localdate()
+        Product.objects.bulk_create([
+            Product(
+                name=f'Product {i:05d}',
+                generic_name=f'Generic {i % 400}',
+                barcode=f'6161{i:08d}',
+                category=categories[i % 20],
+                supplier=supplier,
+                cost_price=Decimal('60.00'),
+                selling_price=Decimal('100.00'),
+                quantity_in_stock=5 if i % 20 == 0 else 500,
+                is_active=i % 25 != 0,
+                expiry_date=today + timedelta(days=(i % 730) - 30),
+            )
+            for i in range(cls.PRODUCTS)
+        ], batch_size=500)
+        products = list(Product.objects.values_list('pk', flat=True))
+
+        now = timezone.now()
+        Sale.objects.bulk_create([
+            Sale(
+                served_by=cls.user, status='paid', payment_method='cash',
+                total_amount=Decimal('100.00'), subtotal=Decimal('100.00'), final_amount=Decimal('100.00'),
+            )
+            for _ in range(cls.SALES)
+        ], batch_size=500)
+        sales = list(Sale.objects.values_list('pk', flat=True))
+        for offset, pk in enumerate(sales):
+            # auto_now_add can't be overridden on insert, so spread the dates afterwards
+            if offset % 30 == 0:
+                Sale.objects.filter(pk__in=sales[offset:offset + 30]).update(
+                    sale_date=now - timedelta(days=offset // 30)
+                )
+        SaleItem.objects.bulk_create([
+            SaleItem(sale_id=pk, product_id=products[i % len(products)], quantity=1,
+                     unit_price=Decimal('100.00'), unit_cost=Decimal('60.00'), total_price=Decimal('100.00'))
+            for i, pk in enumerate(sales)
+        ], batch_size=500)
+        call_command('rebuild_sales_rollup', stdout=open('/dev/null', 'w'))
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def assertNoFullTableScans(self, url, params=None):
+        with capture_selects() as statements:
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200)
+        for sql, sql_params in statements:
+            scanned = set(full_table_scans(sql, sql_params)) - self.ALLOWED_FULL_SCANS
+            self.assertFalse(scanned, f'{url} scans {scanned} in full:\n{sql}')
+
+    def test_dashboard(self):
+        self.assertNoFullTableScans('/inventory/dashboard/')
+
+    def test_pos_system(self):
+        self.assertNoFullTableScans('/sales/pos/')
+
+    def test_search_products_api(self):
+        # The word index reads the catalogue once when it's built, not on every keystroke
+        product_index.build()
+        self.assertNoFullTableScans('/sales/api/search-products/', {'q': 'Generic 12'})
+        self.assertNoFullTableScans('/sales/api/search-products/', {'q': '616100000123'})
+
+    def test_sales_report(self):
+        self.assertNoFullTableScans('/reports/sales/')
+
+    def test_daily_sales_summary(self):
+        self.assertNoFullTableScans('/sales/daily-summary/')
+
+    def test_sales_history_date_filter(self):
+        today = timezone.localdate()
+        self.assertNoFullTableScans('/sales/history/', {
+            'date_from': (today - timedelta(days=7)).isoformat(), 'date_to': today.isoformat(),
+        })
+
+    def test_date_window_uses_sale_date_index_where_date_cast_cannot(self):
+        today = timezone.localdate()
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # Make the planner show whether an index is usable at all, not its cost guess on a small table
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        cast = Sale.objects.filter(sale_date__date=today).values_list('pk', flat=True)
+        window = Sale.objects.filter(within('sale_date', day_window(today))).values_list('pk', flat=True)
+        self.assertIn('sales_sale', full_table_scans(*cast.query.sql_with_params()))
+        self.assertNotIn('sales_sale', full_table_scans(*window.query.sql_with_params()))
+        self.assertEqual(set(cast), set(window))
+
+    def test_sale_lines_are_found_through_the_composite_indexes_alone(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, SaleItem._meta.db_table)
+        indexed = [c['columns'] for c in constraints.values() if c['index'] and not c['primary_key']]
+        self.assertCountEqual(indexed, [['sale_id', 'product_id'], ['product_id', 'sale_id']])
+        for lines in [SaleItem.objects.filter(sale_id=1), SaleItem.objects.filter(product_id=1)]:
+            self.assertNotIn('sales_saleitem', full_table_scans(*lines.values_list('pk').query.sql_with_params()))
+
+
+class LiveDashboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('manager', password='pass')
+        self.products = make_products(2, stock=12)
+
+    async def _next(self, stream):
+        return await asyncio.wait_for(stream.__anext__(), timeout=5)
+
+    def _sell(self, product, quantity):
+        with self.captureOnCommitCallbacks(execute=True):
+            checkout(self.user, [{'id': product.id, 'quantity': quantity}])
+
+    async def test_each_event_is_computed_once_and_fanned_out(self):
+        hub = DashboardHub(InMemoryBroker())
+        streams = [hub.subscribe() for _ in range(3)]
+        for stream in streams:
+            self.assertTrue((await self._next(stream)).startswith('event: snapshot'))
+        await asyncio.sleep(0)  # let the hub start listening
+
+        with patch('reports.live_service.dashboard_snapshot', wraps=live_service.dashboard_snapshot) as snapshot:
+            hub.broker.publish('sale_completed', {'sale_id': 1, 'product_ids': []})
+            messages = [await self._next(stream) for stream in streams]
+        self.assertEqual(snapshot.call_count, 1)
+        self.assertEqual(len(set(messages)), 1)
+        self.assertTrue(messages[0].startswith('event: sale_completed'))
+
+        for stream in streams:
+            await stream.aclose()
+        self.assertFalse(hub.clients)
+        await hub.stop()
+
+    async def test_checkout_pushes_sale_and_low_stock_events(self):
+        broker = InMemoryBroker()
+        hub = DashboardHub(broker)
+        stream = hub.subscribe()
+        await self._next(stream)
+        await asyncio.sleep(0)
+
+        with patch('reports.signals.broker', broker):
+            await sync_to_async(self._sell)(self.products[0], 3)
+        # The stock change raises the alert before the sale is recorded
+        alert_event = await self._next(stream)
+        self.assertTrue(alert_event.startswith('event: stock_alerts'))
+        self.assertIn(f'"product_id": {self.products[0].id}, "kind": "low_stock"', alert_event)
+        sale_event = await self._next(stream)
+        self.assertIn('"today_revenue": "30.00"', sale_event)
+        low_stock_event = await self._next(stream)
+        self.assertTrue(low_stock_event.startswith('event: low_stock'))
+        self.assertIn(f'"id": {self.products[0].id}', low_stock_event)
+
+        await stream.aclose()
+        await hub.stop()
+
+    async def test_events_endpoint_streams_server_sent_events(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get('/reports/api/dashboard/events/')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = aiter(response.streaming_content)
+        first = await asyncio.wait_for(anext(content), timeout=5)
+        self.assertTrue(first.decode().startswith('event: snapshot'))
+        await content.aclose()
+        await live_service.hub.stop()
+
+    async def test_dashboard_opens_the_stream_under_asgi(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get('/inventory/dashboard/')
+        self.assertContains(response, 'new EventSource')
+
+    def test_stream_is_not_served_under_wsgi(self):
+        # A never-ending response would hold a sync worker for good
+        self.client.force_login(self.user)
+        response = self.client.get('/reports/api/dashboard/events/')
+        self.assertEqual(response.status_code, 204)
+        self.assertNotContains(self.client.get('/inventory/dashboard/'), 'new EventSource')
+
+    @override_settings(LIVE_EVENTS=False)
+    async def test_stream_can_be_turned_off(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get('/reports/api/dashboard/events/')
+        self.assertEqual(response.status_code, 204)
+        self.assertNotContains(await self.async_client.get('/inventory/dashboard/'), 'new EventSource')
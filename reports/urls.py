@@ -5,5 +5,10 @@ app_name = 'reports'
 
 urlpatterns = [
     path('sales/', views.sales_report, name='sales_report'),
+    path('sales/pdf/', views.generate_pdf_report, name='sales_report_pdf'),
+    path('sales/csv/', views.export_sales_csv, name='sales_report_csv'),
     path('stock/', views.stock_report, name='stock_report'),
+    path('api/dashboard/', views.dashboard_api, name='dashboard_api'),
+    path('api/dashboard/events/', views.dashboard_events, name='dashboard_events'),
+    path('api/report-cache/stats/', views.report_cache_stats_api, name='report_cache_stats_api'),
 ]
\ No newline at end of file
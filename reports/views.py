@@ -1,22 +1,34 @@
+from django.conf import settings
 from django.shortcuts import render
+from django.urls import reverse
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import Sum, Count, F, Q, Avg
+from django.db.models import Sum, Count, F, Max
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 from datetime import datetime, timedelta
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.template.loader import render_to_string
-from sales.models import Sale, SaleItem
-from inventory.models import Product, Category
+from sales.models import Sale
+from sales.pagination import InvalidCursor, keyset_page
+from inventory.alert_service import alert_counts, low_stock_products
+from inventory.models import AlertState, Product, Category
+from inventory.stock_service import with_stock_at
+from pharmacy.conditional import conditional
+from pharmacy.date_windows import day_window
+from .rollup_service import sales_totals, rollup_version
+from .report_service import (
+    normalize_filters, report_cache, report_sales, report_sales_count, sales_report_figures,
+)
+from .live_service import hub, live_events_enabled
+from .export_service import export_sales, sales_csv, sales_pdf
+from .tasks import sales_report_pdf_task
+from jobs.queue_service import enqueue
 from accounts.models import UserProfile
 import json
 
-# For PDF generation
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-import io
+# The sales table on the report page is paged, newest first; totals cover the full range
+REPORT_PAGE_SIZE = 200
 
 @login_required
 def sales_report(request):
@@ -32,94 +44,55 @@ def sales_report(request):
     
     # Set default date range (last 30 days)
     if not start_date:
-        start_date = timezone.now().date() - timedelta(days=30)
+        start_date = timezone.localdate() - timedelta(days=30)
     else:
         start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
     
     if not end_date:
-        end_date = timezone.now().date()
+        end_date = timezone.localdate()
     else:
         end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
     
-    # Build query filters
-    filters = Q(sale_date__date__range=[start_date, end_date])
+    filters = normalize_filters(payment_method, category, customer_search, invoice_search)
+    figures = sales_report_figures(start_date, end_date, filters)
+    financial_data = figures['financial_data']
+    total_cost = figures['total_cost']
     
-    if payment_method:
-        filters &= Q(payment_method=payment_method)
-    
-    if customer_search:
-        filters &= Q(customer_name__icontains=customer_search)
-    
-    if invoice_search:
-        filters &= Q(invoice_number__icontains=invoice_search)
-    
-    if category:
-        filters &= Q(items__product__category__name=category)
-    
-    # Get sales with filters
-    sales = Sale.objects.filter(filters).select_related('served_by').prefetch_related('items__product').distinct()
-    
-    # Financial calculations
-    financial_data = sales.aggregate(
-        total_sales=Sum('total_amount'),
-        total_subtotal=Sum('subtotal'),
-        #total_tax=Sum('tax_amount'),
-        total_discount=Sum('discount'),
-        average_sale=Avg('total_amount'),
-        total_transactions=Count('id')
-    )
-    
-    # Calculate total profit
-    total_cost = sum(sale.total_cost_price for sale in sales)
     total_profit = (financial_data['total_subtotal'] or 0) - total_cost
     profit_margin = (total_profit / total_cost * 100) if total_cost > 0 else 0
     
-    # Top selling products
-    top_products = SaleItem.objects.filter(
-        sale__sale_date__date__range=[start_date, end_date]
-    ).values(
-        'product__name', 'product__category__name'
-    ).annotate(
-        total_quantity=Sum('quantity'),
-        total_revenue=Sum('total_price')
-    ).order_by('-total_quantity')[:10]
-    
-    # Top selling categories
-    top_categories = SaleItem.objects.filter(
-        sale__sale_date__date__range=[start_date, end_date]
-    ).values(
-        'product__category__name'
-    ).annotate(
-        total_quantity=Sum('quantity'),
-        total_revenue=Sum('total_price'),
-        product_count=Count('product', distinct=True)
-    ).order_by('-total_revenue')[:10]
-    
-    # Payment method breakdown
-    payment_breakdown = sales.values('payment_method').annotate(
-        count=Count('id'),
-        total=Sum('total_amount')
-    ).order_by('-total')
-    
     # Low stock alerts
-    low_stock_products = Product.objects.filter(
-        quantity_in_stock__lte=F('minimum_stock_level'),
-        is_active=True
-    )
+    low_stock = low_stock_products().select_related('category')
     
     # Get all categories and payment methods for filters
     all_categories = Category.objects.all()
     payment_methods = Sale.PAYMENT_METHODS
     
+    # Keyset pages, so the last page of a long range costs the same as the first
+    sales = report_sales(start_date, end_date, filters)
+    try:
+        page, next_cursor = keyset_page(sales, request.GET.get('cursor'), REPORT_PAGE_SIZE)
+    except InvalidCursor:
+        messages.error(request, 'That page of sales could not be found; showing the latest sales.')
+        page, next_cursor = keyset_page(sales, None, REPORT_PAGE_SIZE)
+    latest_page = request.GET.copy()
+    latest_page.pop('cursor', None)
+    next_page = latest_page.copy()
+    next_page['cursor'] = next_cursor
+    
     context = {
-        'sales': sales,
+        'sales': page,
+        'sales_count': report_sales_count(start_date, end_date, filters),
+        'next_page': next_page.urlencode() if next_cursor else '',
+        'paged': bool(request.GET.get('cursor')),
+        'latest_page': latest_page.urlencode(),
         'financial_data': financial_data,
         'total_profit': total_profit,
         'profit_margin': profit_margin,
-        'top_products': top_products,
-        'top_categories': top_categories,
-        'payment_breakdown': payment_breakdown,
-        'low_stock_products': low_stock_products,
+        'top_products': figures['top_products'],
+        'top_categories': figures['top_categories'],
+        'payment_breakdown': figures['payment_breakdown'],
+        'low_stock_products': low_stock,
         'start_date': start_date,
         'end_date': end_date,
         'all_categories': all_categories,
@@ -129,146 +102,86 @@ def sales_report(request):
             'category': category,
             'customer_search': customer_search,
             'invoice_search': invoice_search,
-        }
+        },
+        'background_jobs': getattr(settings, 'BACKGROUND_JOBS', False),
     }
     
     return render(request, 'reports/sales_report.html', context)
 
 @login_required
-def generate_pdf_report(request):
-    """Generate PDF report"""
-    
-    # Get same data as sales_report
+def report_cache_stats_api(request):
+    """Hit/miss counters for the sales report cache in this worker"""
+    return JsonResponse(report_cache.stats())
+
+def _export_filters(request):
+    """Date range and filters of an export, the same parameters as the sales report"""
     start_date = request.GET.get('start_date')
     end_date = request.GET.get('end_date')
     
     if not start_date:
-        start_date = timezone.now().date() - timedelta(days=30)
+        start_date = timezone.localdate() - timedelta(days=30)
     else:
         start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
     
     if not end_date:
-        end_date = timezone.now().date()
+        end_date = timezone.localdate()
     else:
         end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
     
-    sales = Sale.objects.filter(
-        sale_date__date__range=[start_date, end_date]
-    ).select_related('served_by')
-    
-    # Create PDF
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    elements = []
-    
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=18,
-        spaceAfter=30,
-        alignment=1  # Center alignment
-    )
-    
-    # Add title
-    title = Paragraph("Eldoret Chemist - Sales Report", title_style)
-    elements.append(title)
-    elements.append(Spacer(1, 12))
-    
-    # Add date range
-    date_range = Paragraph(f"Period: {start_date} to {end_date}", styles['Normal'])
-    elements.append(date_range)
-    elements.append(Spacer(1, 12))
-    
-    # Financial summary
-    financial_data = sales.aggregate(
-        total_sales=Sum('total_amount'),
-        total_subtotal=Sum('subtotal'),
-        #total_tax=Sum('tax_amount'),
-        total_transactions=Count('id')
-    )
-    
-    summary_data = [
-        ['Financial Summary', ''],
-        ['Total Sales', f"KES {financial_data['total_sales'] or 0:,.2f}"],
-        ['Subtotal', f"KES {financial_data['total_subtotal'] or 0:,.2f}"],
-        ['Tax Amount', f"KES {financial_data['total_tax'] or 0:,.2f}"],
-        ['Total Transactions', str(financial_data['total_transactions'] or 0)],
-    ]
-    
-    summary_table = Table(summary_data, colWidths=[3*inch, 2*inch])
-    summary_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 14),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
-    
-    elements.append(summary_table)
-    elements.append(Spacer(1, 12))
-    
-    # Sales details table
-    if sales.exists():
-        sales_data = [['Date', 'Invoice #', 'Customer', 'Payment Method', 'Total']]
-        
-        for sale in sales[:50]:  # Limit to first 50 for PDF
-            sales_data.append([
-                sale.sale_date.strftime('%Y-%m-%d'),
-                sale.invoice_number or f"#{sale.id}",
-                sale.customer_name or 'Walk-in Customer',
-                sale.get_payment_method_display(),
-                f"KES {sale.total_amount:,.2f}"
-            ])
-        
-        sales_table = Table(sales_data, colWidths=[1.5*inch, 1.5*inch, 2*inch, 1.5*inch, 1.5*inch])
-        sales_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-        
-        elements.append(sales_table)
-    
-    doc.build(elements)
-    
-    buffer.seek(0)
-    response = HttpResponse(buffer.getvalue(), content_type='application/pdf')
+    filters = {
+        key: request.GET[key]
+        for key in ('payment_method', 'category', 'customer_search', 'invoice_search') if request.GET.get(key)
+    }
+    return start_date, end_date, filters
+
+@login_required
+def generate_pdf_report(request):
+    """Sales report PDF, streamed page by page"""
+    start_date, end_date, filters = _export_filters(request)
+    
+    if request.GET.get('background'):
+        job = enqueue(
+            sales_report_pdf_task, created_by=request.user,
+            start_date=str(start_date), end_date=str(end_date), **filters,
+        )
+        return JsonResponse({'job': job.pk, 'status_url': reverse('jobs:job_status', args=[job.pk])}, status=202)
+    
+    sales = export_sales(start_date, end_date, **filters)
+    response = StreamingHttpResponse(sales_pdf(sales, start_date, end_date), content_type='application/pdf')
     response['Content-Disposition'] = f'attachment; filename="sales_report_{start_date}_to_{end_date}.pdf"'
     
     return response
 
 @login_required
+def export_sales_csv(request):
+    """Every sale in the report range as CSV, streamed as it is read"""
+    start_date, end_date, filters = _export_filters(request)
+    sales = export_sales(start_date, end_date, **filters)
+    response = StreamingHttpResponse(sales_csv(sales), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="sales_{start_date}_to_{end_date}.csv"'
+    return response
+
+def _dashboard_validator(request):
+    # Totals come from the rollup, the low stock count from products and the feed from the newest sales
+    return (
+        timezone.localdate(),
+        rollup_version(),
+        tuple(Product.objects.aggregate(latest=Max('updated_at'), count=Count('id')).values()),
+        Sale.objects.aggregate(latest=Max('id'))['latest'],
+    )
+
+@login_required
+@conditional(_dashboard_validator)
 def dashboard_api(request):
     """API endpoint for dashboard data"""
-    today = timezone.now().date()
-    
-    # Today's sales
-    today_sales = Sale.objects.filter(sale_date__date=today).aggregate(
-        total=Sum('total_amount'),
-        count=Count('id')
-    )
+    today = timezone.localdate()
     
-    # This month's sales
-    month_start = today.replace(day=1)
-    month_sales = Sale.objects.filter(sale_date__date__gte=month_start).aggregate(
-        total=Sum('total_amount'),
-        count=Count('id')
-    )
+    # Today's and this month's sales, from the daily rollup
+    today_sales = sales_totals(today, today)
+    month_sales = sales_totals(today.replace(day=1), today)
     
     # Low stock count
-    low_stock_count = Product.objects.filter(
-        quantity_in_stock__lte=F('minimum_stock_level'),
-        is_active=True
-    ).count()
+    low_stock_count = AlertState.objects.filter(kind=AlertState.LOW_STOCK).count()
     
     # Recent sales
     recent_sales = Sale.objects.select_related('served_by')[:5]
@@ -277,7 +190,7 @@ def dashboard_api(request):
     for sale in recent_sales:
         recent_sales_data.append({
             'id': sale.id,
-            'invoice_number': sale.invoice_number or f"#{sale.id}",
+            'invoice_number': f"#{sale.id}",
             'customer_name': sale.customer_name or 'Walk-in Customer',
             'total_amount': str(sale.total_amount),
             'payment_method': sale.get_payment_method_display(),
@@ -287,12 +200,12 @@ def dashboard_api(request):
     
     data = {
         'today_sales': {
-            'total': str(today_sales['total'] or 0),
-            'count': today_sales['count'] or 0
+            'total': str(today_sales['total_amount']),
+            'count': today_sales['sale_count']
         },
         'month_sales': {
-            'total': str(month_sales['total'] or 0),
-            'count': month_sales['count'] or 0
+            'total': str(month_sales['total_amount']),
+            'count': month_sales['sale_count']
         },
         'low_stock_count': low_stock_count,
         'recent_sales': recent_sales_data
@@ -300,24 +213,55 @@ def dashboard_api(request):
     
     return JsonResponse(data)
 
+@login_required
+async def dashboard_events(request):
+    """Server-Sent Events stream of sales and low stock alerts; needs an ASGI server"""
+    if not live_events_enabled(request):
+        # 204 tells EventSource to stop reconnecting
+        return HttpResponse(status=204)
+    response = StreamingHttpResponse(hub.subscribe(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @login_required
 def stock_report(request):
     """Enhanced stock report with alerts"""
     products = Product.objects.filter(is_active=True).select_related('category', 'supplier')
     
-    # Stock alerts
-    low_stock = products.filter(quantity_in_stock__lte=F('minimum_stock_level'))
-    expired = products.filter(expiry_date__lt=timezone.now().date())
-    expiring_soon = products.filter(
-        expiry_date__gte=timezone.now().date(),
-        expiry_date__lte=timezone.now().date() + timedelta(days=30)
-    )
-    
-    # Stock value calculation
-    total_stock_value = products.aggregate(
-        cost_value=Sum(F('quantity_in_stock') * F('cost_price')),
-        selling_value=Sum(F('quantity_in_stock') * F('selling_price'))
-    )
+    # Stock alerts, kept current by alert_service as stock moves
+    low_stock = low_stock_products().select_related('category', 'supplier')
+    alerts = AlertState.objects.select_related('product').order_by('expiry_date', 'product__name')
+    expired = alerts.filter(kind=AlertState.EXPIRED)
+    expiring_soon = alerts.filter(kind=AlertState.EXPIRING_SOON)
+    counts = alert_counts()
+    
+    # Stock value calculation, optionally as it stood at the end of a past day
+    as_of = request.GET.get('as_of', '')
+    end_of_day = None
+    if as_of:
+        try:
+            as_of_date = parse_date(as_of)
+            end_of_day = day_window(as_of_date)[1] if as_of_date else None
+        except (ValueError, OverflowError):  # e.g. 2024-02-30, or a year the clock can't reach
+            pass
+        if end_of_day is None:
+            messages.error(request, f'"{as_of}" is not a valid date; showing current stock.')
+            as_of = ''
+        elif as_of_date >= timezone.localdate():
+            # Today and later days are valued at the current stock
+            end_of_day = None
+            as_of = ''
+    if end_of_day is not None:
+        total_stock_value = with_stock_at(products, end_of_day).aggregate(
+            cost_value=Sum(F('stock_at') * F('cost_price')),
+            selling_value=Sum(F('stock_at') * F('selling_price'))
+        )
+    else:
+        total_stock_value = products.aggregate(
+            cost_value=Sum(F('quantity_in_stock') * F('cost_price')),
+            selling_value=Sum(F('quantity_in_stock') * F('selling_price'))
+        )
     
     context = {
         'products': products,
@@ -325,9 +269,10 @@ def stock_report(request):
         'expired': expired,
         'expiring_soon': expiring_soon,
         'total_stock_value': total_stock_value,
-        'low_stock_count': low_stock.count(),
-        'expired_count': expired.count(),
-        'expiring_soon_count': expiring_soon.count(),
+        'as_of': as_of,
+        'low_stock_count': counts[AlertState.LOW_STOCK],
+        'expired_count': counts[AlertState.EXPIRED],
+        'expiring_soon_count': counts[AlertState.EXPIRING_SOON],
     }
     
     return render(request, 'reports/stock_report.html', context)
\ No newline at end of file
@@ -5,6 +5,7 @@ from .models import Sale, SaleItem
 from django.contrib import admin
 from django.utils.html import format_html
 from .models import Sale, SaleItem
+from .signals import sale_edited
 
 class SaleItemInline(admin.TabularInline):
     model = SaleItem
@@ -24,6 +25,10 @@ class SaleAdmin(admin.ModelAdmin):
     
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('served_by')
+    
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        sale_edited.send(sender=Sale, sale=form.instance)
 
 @admin.register(SaleItem)
 class SaleItemAdmin(admin.ModelAdmin):
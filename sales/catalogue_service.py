@@ -0,0 +1,106 @@
+"""
+Versioned product catalogue for POS tills.
+
+A till downloads the sellable catalogue once, keeps it client-side and then
+only asks for the products changed since the version it holds. The version
+is the latest Product.updated_at in microseconds; stock changes bump
+updated_at too, so they show up in the deltas.
+
+Tills that send ``Accept: application/x-msgpack`` get MessagePack bodies
+when the optional msgpack package is installed (pip install msgpack), and
+JSON otherwise; JSON is always served when it's missing.
+"""
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max
+
+from inventory.models import Category, Product
+
+try:
+    import msgpack
+except ImportError:  # optional; tills fall back to JSON
+    msgpack = None
+
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+CATALOGUE_FIELDS = ['id', 'name', 'generic_name', 'barcode', 'price', 'stock', 'category_id']
+# Deltas overlap the till's version by this much, so rows written by a
+# transaction that committed after the till last synced are still sent
+DELTA_OVERLAP = timedelta(seconds=10)
+
+
+def sellable_products():
+    return Product.objects.filter(is_active=True, quantity_in_stock__gt=0)
+
+
+def catalogue_state():
+    """(version, number of sellable products); both change whenever the snapshot would"""
+    latest = Product.objects.aggregate(latest=Max('updated_at'))['latest']
+    version = int(latest.timestamp() * 1_000_000) if latest else 0
+    return version, sellable_products().count()
+
+
+def catalogue_etag(version, count):
+    return f'"catalogue-{version}-{count}"'
+
+
+def _rows(queryset):
+    return [
+        [pk, name, generic_name or '', barcode or '', str(price), stock, category_id]
+        for pk, name, generic_name, barcode, price, stock, category_id in queryset.order_by().values_list(
+            'id', 'name', 'generic_name', 'barcode', 'selling_price', 'quantity_in_stock', 'category_id'
+        ).iterator(chunk_size=2000)
+    ]
+
+
+def catalogue_snapshot(version, count):
+    """Every sellable product as compact rows, plus the category names they refer to"""
+    return {
+        'version': version,
+        'count': count,
+        'fields': CATALOGUE_FIELDS,
+        'categories': list(Category.objects.values_list('id', 'name')),
+        'products': _rows(sellable_products()),
+    }
+
+
+def version_time(version):
+    """The updated_at a catalogue version stands for; ValueError if no catalogue could have it"""
+    if version < 0:
+        raise ValueError(f'{version} is not a catalogue version')
+    try:
+        return datetime.fromtimestamp(version / 1_000_000, tz=dt_timezone.utc)
+    except (OverflowError, OSError) as error:
+        raise ValueError(f'{version} is not a catalogue version') from error
+
+
+def catalogue_changes(since):
+    """
+    Products changed after version ``since``.
+
+    Rows that are still for sale come back in ``products``; products that were
+    deactivated or sold out come back in ``removed``. Tills compare their row
+    count with ``count`` afterwards and fetch a full snapshot if it differs,
+    which also covers products deleted outright. Raises ValueError, before
+    any query, if ``since`` is out of range.
+    """
+    since = version_time(since)
+    version, count = catalogue_state()
+    changed = Product.objects.filter(updated_at__gt=since - DELTA_OVERLAP)
+    return {
+        'version': version,
+        'count': count,
+        'fields': CATALOGUE_FIELDS,
+        'products': _rows(changed.filter(is_active=True, quantity_in_stock__gt=0)),
+        'removed': list(
+            changed.exclude(is_active=True, quantity_in_stock__gt=0).values_list('id', flat=True)
+        ),
+    }
+
+
+def encode(data, accept=''):
+    """(body, content type), msgpack when the till asks for it and it's installed"""
+    if msgpack is not None and MSGPACK_CONTENT_TYPE in accept:
+        return msgpack.packb(data), MSGPACK_CONTENT_TYPE
+    return json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':')), 'application/json'
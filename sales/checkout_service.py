@@ -0,0 +1,94 @@
+from decimal import Decimal
+
+from django.db import transaction
+
+from inventory.stock_service import lock_products, apply_stock_changes, InsufficientStock
+from .models import Sale, SaleItem
+from .signals import sale_completed
+
+
+class CheckoutError(ValueError):
+    """Raised when a cart cannot be turned into a sale"""
+
+
+def merge_cart_lines(items):
+    """Collapse cart lines into {product_id: quantity}, keeping cart order"""
+    quantities = {}
+    for item in items:
+        try:
+            product_id = int(item['id'])
+            quantity = int(item['quantity'])
+        except (KeyError, TypeError, ValueError):
+            raise CheckoutError('Invalid cart line')
+        if quantity <= 0:
+            raise CheckoutError('Quantity must be at least 1')
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return quantities
+
+
+def checkout(user, items, customer_name='', customer_phone='',
+             payment_method='cash', discount=Decimal('0'), status='paid'):
+    """
+    Turn a POS cart into a Sale with a fixed number of queries.
+
+    Products are loaded and row-locked in one query (in primary key order),
+    the sale totals are written once, stock is decremented with a single
+    conditional UPDATE (plus one ledger insert) and sale lines are inserted
+    with bulk_create.
+    Returns (sale, sale_items).
+    """
+    quantities = merge_cart_lines(items)
+    if not quantities:
+        raise CheckoutError('No items in cart')
+
+    with transaction.atomic():
+        products = lock_products(list(quantities), is_active=True)
+
+        for product_id, quantity in quantities.items():
+            product = products.get(product_id)
+            if product is None:
+                raise CheckoutError(f'Product not found: {product_id}')
+            if quantity > product.quantity_in_stock:
+                raise CheckoutError(
+                    f'Insufficient stock for {product.name}. Available: {product.quantity_in_stock}'
+                )
+
+        sale_items = []
+        subtotal = Decimal('0')
+        for product_id, quantity in quantities.items():
+            product = products[product_id]
+            product.quantity_in_stock -= quantity
+            total_price = product.selling_price * quantity
+            subtotal += total_price
+            sale_items.append(SaleItem(
+                product=product,
+                quantity=quantity,
+                unit_price=product.selling_price,
+                unit_cost=product.cost_price,
+                total_price=total_price,
+            ))
+
+        sale = Sale.objects.create(
+            customer_name=customer_name,
+            customer_phone=customer_phone,
+            payment_method=payment_method,
+            subtotal=subtotal,
+            total_amount=subtotal,
+            discount=discount,
+            served_by=user,
+            status=status,
+        )
+
+        try:
+            apply_stock_changes(
+                {pk: -qty for pk, qty in quantities.items()}, 'sale', f'Sale #{sale.id}'
+            )
+        except InsufficientStock as e:
+            raise CheckoutError(str(e))
+
+        for sale_item in sale_items:
+            sale_item.sale = sale
+        SaleItem.objects.bulk_create(sale_items)
+        sale_completed.send(sender=Sale, sale=sale, items=sale_items)
+
+    return sale, sale_items
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from sales.reconciliation_service import process_inbox, release_unsent_payments, BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = ('Settle M-Pesa callbacks waiting in the inbox and release sales whose payment '
+            'request was never sent (once, or continuously with --loop)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--loop', action='store_true', help='Keep polling the inbox')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait between polls of an empty inbox')
+
+    def _report(self, outcomes):
+        summary = ', '.join(f'{count} {outcome}' for outcome, count in sorted(outcomes.items()))
+        self.stdout.write(f'Processed {sum(outcomes.values())} callbacks' + (f' ({summary})' if summary else ''))
+
+    def _release(self):
+        released = release_unsent_payments()
+        if released:
+            self.stdout.write(f'Cancelled {released} sales whose payment request was never sent')
+
+    def handle(self, *args, **options):
+        if not options['loop']:
+            self._report(process_inbox(options['batch_size']))
+            self._release()
+            return
+        try:
+            while True:
+                outcomes = process_inbox(options['batch_size'])
+                self._release()
+                if outcomes:
+                    self._report(outcomes)
+                else:
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
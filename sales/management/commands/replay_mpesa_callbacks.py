@@ -0,0 +1,60 @@
+import json
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from sales.models import MpesaCallback
+from sales.reconciliation_service import record_callback, requeue_callbacks, process_inbox
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay M-Pesa callbacks: requeue inbox rows for settling again, or append '
+        'callbacks recovered elsewhere (one JSON payload per line) with --file'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkout-request-id', action='append', default=[],
+                            help='Requeue the callbacks for this CheckoutRequestID (repeatable)')
+        parser.add_argument('--outcome', choices=[value for value, _ in MpesaCallback.OUTCOMES],
+                            help='Requeue callbacks that were processed with this outcome')
+        parser.add_argument('--since', help='Only callbacks received on or after this day (YYYY-MM-DD)')
+        parser.add_argument('--file', help='Append the callbacks in this JSON lines file to the inbox')
+        parser.add_argument('--process', action='store_true', help='Settle the inbox straight away')
+
+    def handle(self, *args, **options):
+        if options['file']:
+            count = 0
+            with open(options['file']) as lines:
+                for number, line in enumerate(lines, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        record_callback(json.loads(line))
+                    except ValueError:
+                        raise CommandError(f'Line {number} is not valid JSON')
+                    count += 1
+            self.stdout.write(f'Appended {count} callbacks to the inbox')
+        elif options['checkout_request_id'] or options['outcome'] or options['since']:
+            callbacks = MpesaCallback.objects.filter(processed_at__isnull=False)
+            if options['checkout_request_id']:
+                callbacks = callbacks.filter(checkout_request_id__in=options['checkout_request_id'])
+            if options['outcome']:
+                callbacks = callbacks.filter(outcome=options['outcome'])
+            if options['since']:
+                try:
+                    since = datetime.strptime(options['since'], '%Y-%m-%d')
+                except ValueError:
+                    raise CommandError(f'Invalid date "{options["since"]}", expected YYYY-MM-DD')
+                callbacks = callbacks.filter(received_at__gte=timezone.make_aware(since))
+            self.stdout.write(f'Requeued {requeue_callbacks(callbacks)} callbacks')
+        else:
+            raise CommandError('Give --file, or choose callbacks with --checkout-request-id, --outcome or --since')
+
+        if options['process']:
+            outcomes = process_inbox()
+            self.stdout.write(self.style.SUCCESS(
+                f'Processed {sum(outcomes.values())} callbacks: '
+                + ', '.join(f'{count} {outcome}' for outcome, count in sorted(outcomes.items()))
+            ))
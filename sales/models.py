@@ -2,9 +2,22 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
 from inventory.models import Product
+from inventory.stock_service import apply_stock_changes, InsufficientStock
 from decimal import Decimal
 
 
+# Cost of a set of sale lines, usable in aggregate() and annotate()
+LINE_COST = models.Sum(models.F('quantity') * models.F('unit_cost'))
+
+
+class SaleQuerySet(models.QuerySet):
+    def with_cost(self):
+        """Annotate each sale with items_cost, the cost price of its lines"""
+        return self.annotate(
+            items_cost=models.Sum(models.F('items__quantity') * models.F('items__unit_cost'))
+        )
+
+
 class Sale(models.Model):
     PAYMENT_METHODS = [
         ('cash', 'Cash'),
@@ -31,8 +44,23 @@ class Sale(models.Model):
     served_by = models.ForeignKey(User, on_delete=models.CASCADE)
     subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     
+    objects = SaleQuerySet.as_manager()
+    
     class Meta:
         ordering = ['-sale_date']
+        indexes = [
+            # Keyset pagination of the sales history walks (sale_date, id)
+            models.Index(fields=['sale_date', 'id'], name='sale_date_id_idx'),
+            # Lets the history totals be answered from the index alone
+            models.Index(
+                fields=['sale_date', 'payment_method', 'status', 'final_amount', 'discount'],
+                name='sale_history_totals_idx',
+            ),
+            # Revenue figures only count paid sales
+            models.Index(fields=['sale_date'], condition=models.Q(status='paid'), name='sale_paid_date_idx'),
+            models.Index(fields=['payment_method', 'sale_date'], name='sale_method_date_idx'),
+            models.Index(fields=['status', 'sale_date'], name='sale_status_date_idx'),
+        ]
     
     def __str__(self):
         return f"Sale #{self.id} - KES {self.final_amount}"
@@ -40,7 +68,12 @@ class Sale(models.Model):
     @property
     def total_cost_price(self):
         """Calculate total cost price for all items in this sale"""
-        return sum(item.total_cost_price for item in self.items.all())
+        # Prefer a with_cost() annotation, then prefetched items, then one aggregate query
+        if hasattr(self, 'items_cost'):
+            return self.items_cost or Decimal('0')
+        if 'items' in getattr(self, '_prefetched_objects_cache', {}):
+            return sum((item.total_cost_price for item in self.items.all()), Decimal('0'))
+        return self.items.aggregate(cost=LINE_COST)['cost'] or Decimal('0')
     
     @property
     def total_profit(self):
@@ -53,13 +86,22 @@ class Sale(models.Model):
 
 
 class SaleItem(models.Model):
-    sale = models.ForeignKey(Sale, on_delete=models.CASCADE, related_name='items')
-    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    # Both foreign keys lead one of the composite indexes below, so they need no index of their own
+    sale = models.ForeignKey(Sale, on_delete=models.CASCADE, related_name='items', db_index=False)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, db_index=False)
     quantity = models.PositiveIntegerField()
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
     unit_cost = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
     
+    class Meta:
+        indexes = [
+            # A sale's lines (receipts, prefetches, deleting a sale)
+            models.Index(fields=['sale', 'product'], name='saleitem_sale_product_idx'),
+            # Per-product sales history (top products, reorder history)
+            models.Index(fields=['product', 'sale'], name='saleitem_product_sale_idx'),
+        ]
+    
     def save(self, *args, **kwargs):
         self.unit_price = self.product.selling_price
         self.unit_cost = self.product.cost_price
@@ -67,11 +109,13 @@ class SaleItem(models.Model):
         
         # Only reduce stock on create, not on update
         if not self.pk:  # Only on create
-            if self.product.quantity_in_stock >= self.quantity:
-                self.product.quantity_in_stock -= self.quantity
-                self.product.save()
-            else:
-                raise ValueError(f"Insufficient stock for {self.product.name}")
+            try:
+                apply_stock_changes(
+                    {self.product_id: -self.quantity}, 'sale', f"Sale #{self.sale_id}"
+                )
+            except InsufficientStock:
+                raise InsufficientStock(f"Insufficient stock for {self.product.name}")
+            self.product.quantity_in_stock -= self.quantity
         
         super().save(*args, **kwargs)
         
@@ -115,7 +159,40 @@ class MpesaTransaction(models.Model):
     checkout_request_id = models.CharField(max_length=100, unique=True)
     mpesa_receipt_number = models.CharField(max_length=50, blank=True, null=True)
     status = models.CharField(max_length=20, choices=TRANSACTION_STATUS, default='pending')
+    result_description = models.CharField(max_length=255, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    settled_at = models.DateTimeField(null=True, blank=True)
     
     def __str__(self):
-        return f"M-Pesa {self.phone_number} - {self.amount}"
\ No newline at end of file
+        return f"M-Pesa {self.phone_number} - {self.amount}"
+
+
+class MpesaCallback(models.Model):
+    """
+    Inbox of STK push callbacks exactly as Daraja delivered them.
+
+    Rows are only ever appended; processing stamps processed_at and outcome
+    but never touches the payload.
+    """
+    OUTCOMES = [
+        ('settled', 'Settled'),
+        ('duplicate', 'Duplicate'),
+        ('unmatched', 'Unmatched'),
+        ('invalid', 'Invalid'),
+    ]
+
+    checkout_request_id = models.CharField(max_length=100, blank=True, db_index=True)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    outcome = models.CharField(max_length=10, choices=OUTCOMES, blank=True)
+
+    class Meta:
+        indexes = [
+            # The batch worker only ever reads the unprocessed tail
+            models.Index(fields=['id'], condition=models.Q(processed_at__isnull=True),
+                         name='mpesa_callback_inbox_idx'),
+        ]
+
+    def __str__(self):
+        return f"Callback {self.checkout_request_id or self.pk} ({self.outcome or 'unprocessed'})"
\ No newline at end of file
@@ -1,50 +1,103 @@
-import requests
+"""
+M-Pesa Daraja client.
+
+One MpesaService per process caches the OAuth access token until just before
+it expires and sends every call over a pooled keep-alive session. An STK push
+is then one round trip, not a token fetch plus a fresh TLS handshake each time.
+MPESA_BASE_URL can point at a local stub of the Daraja API for testing.
+"""
 import base64
-from datetime import datetime
+import threading
+import time
+
+import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+# Refresh the OAuth token this many seconds before Daraja says it expires
+TOKEN_EXPIRY_MARGIN = 60
+# (connect, read) seconds; an STK push that hasn't answered by then won't
+DEFAULT_TIMEOUT = (3.05, 15)
+
+
+class MpesaError(Exception):
+    """Raised when Daraja can't be reached or refuses a request"""
+
+
+def format_phone(phone_number):
+    """07XXXXXXXX / 7XXXXXXXX / 2547XXXXXXXX -> 2547XXXXXXXX"""
+    phone_number = phone_number.strip().lstrip('+')
+    if phone_number.startswith('0'):
+        return '254' + phone_number[1:]
+    if not phone_number.startswith('254'):
+        return '254' + phone_number
+    return phone_number
+
 
 class MpesaService:
-    def __init__(self):
-        self.consumer_key = settings.MPESA_CONSUMER_KEY
-        self.consumer_secret = settings.MPESA_CONSUMER_SECRET
-        self.business_short_code = settings.MPESA_BUSINESS_SHORT_CODE
-        self.passkey = settings.MPESA_PASSKEY
-        self.base_url = settings.MPESA_BASE_URL
-        self.callback_url = settings.MPESA_CALLBACK_URL
-    
-    def get_access_token(self):
-        url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
-        auth_string = f"{self.consumer_key}:{self.consumer_secret}"
-        auth_b64 = base64.b64encode(auth_string.encode()).decode()
-        
-        headers = {'Authorization': f'Basic {auth_b64}'}
-        response = requests.get(url, headers=headers)
-        return response.json().get('access_token') if response.status_code == 200 else None
-    
-    def initiate_stk_push(self, phone_number, amount, account_reference):
-        token = self.get_access_token()
-        if not token:
-            return {'success': False, 'message': 'Failed to get token'}
-        
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    """
+    Daraja client shared by every request in the process.
+
+    The OAuth token is cached until shortly before it expires, and all calls go
+    through one keep-alive requests.Session, so an STK push is a single pooled
+    round trip in the common case. Use get_mpesa_service() rather than building
+    one per request.
+    """
+
+    def __init__(self, base_url=None, consumer_key=None, consumer_secret=None,
+                 business_short_code=None, passkey=None, callback_url=None,
+                 timeout=DEFAULT_TIMEOUT, pool_size=10):
+        self.consumer_key = consumer_key or settings.MPESA_CONSUMER_KEY
+        self.consumer_secret = consumer_secret or settings.MPESA_CONSUMER_SECRET
+        self.business_short_code = business_short_code or settings.MPESA_BUSINESS_SHORT_CODE
+        self.passkey = passkey or settings.MPESA_PASSKEY
+        self.base_url = (base_url or settings.MPESA_BASE_URL).rstrip('/')
+        self.callback_url = callback_url or settings.MPESA_CALLBACK_URL
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._token = None
+        self._token_expires_at = 0
+        self._token_lock = threading.Lock()
+
+    def get_access_token(self, force_refresh=False):
+        with self._token_lock:
+            if not force_refresh and self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+            try:
+                response = self.session.get(
+                    f"{self.base_url}/oauth/v1/generate",
+                    params={'grant_type': 'client_credentials'},
+                    auth=(self.consumer_key, self.consumer_secret),
+                    timeout=self.timeout,
+                )
+                response.raise_for_status()
+                data = response.json()
+                self._token = data['access_token']
+            except (requests.RequestException, ValueError, KeyError) as e:
+                self._token = None
+                raise MpesaError(f'Failed to get token: {e}')
+            expires_in = int(data.get('expires_in', 3599))
+            self._token_expires_at = time.monotonic() + max(expires_in - TOKEN_EXPIRY_MARGIN, 0)
+            return self._token
+
+    def _password(self, timestamp):
         password_string = f"{self.business_short_code}{self.passkey}{timestamp}"
-        password = base64.b64encode(password_string.encode()).decode()
-        
-        # Format phone number
-        if phone_number.startswith('0'):
-            phone_number = '254' + phone_number[1:]
-        elif not phone_number.startswith('254'):
-            phone_number = '254' + phone_number
-        
-        url = f"{self.base_url}/mpesa/stkpush/v1/processrequest"
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'
-        }
-        
-        payload = {
+        return base64.b64encode(password_string.encode()).decode()
+
+    def stk_push_payload(self, phone_number, amount, account_reference):
+        # Daraja checks the timestamp against Nairobi time
+        timestamp = timezone.localtime().strftime('%Y%m%d%H%M%S')
+        phone_number = format_phone(phone_number)
+        return {
             'BusinessShortCode': self.business_short_code,
-            'Password': password,
+            'Password': self._password(timestamp),
             'Timestamp': timestamp,
             'TransactionType': 'CustomerPayBillOnline',
             'Amount': int(amount),
@@ -53,15 +106,80 @@ class MpesaService:
             'PhoneNumber': phone_number,
             'CallBackURL': self.callback_url,
             'AccountReference': account_reference,
-            'TransactionDesc': f"Payment for {account_reference}"
+            'TransactionDesc': f"Payment for {account_reference}",
         }
-        
-        response = requests.post(url, json=payload, headers=headers)
-        result = response.json()
-        
-        if result.get('ResponseCode') == '0':
+
+    def _post(self, path, payload):
+        response = None
+        for attempt in range(2):
+            token = self.get_access_token(force_refresh=attempt > 0)
+            response = self.session.post(
+                f"{self.base_url}{path}",
+                json=payload,
+                headers={'Authorization': f'Bearer {token}'},
+                timeout=self.timeout,
+            )
+            # A token revoked before its advertised expiry gets one refresh and retry
+            if response.status_code != 401:
+                break
+        return response
+
+    def initiate_stk_push(self, phone_number, amount, account_reference):
+        try:
+            response = self._post(
+                '/mpesa/stkpush/v1/processrequest',
+                self.stk_push_payload(phone_number, amount, account_reference),
+            )
+            result = response.json()
+        except MpesaError as e:
+            return {'success': False, 'message': str(e)}
+        except (requests.RequestException, ValueError) as e:
+            return {'success': False, 'message': f'Error: {e}'}
+
+        if response.status_code == 200 and result.get('ResponseCode') == '0':
             return {
                 'success': True,
-                'checkout_request_id': result.get('CheckoutRequestID')
+                'checkout_request_id': result.get('CheckoutRequestID'),
+                'merchant_request_id': result.get('MerchantRequestID'),
             }
-        return {'success': False, 'message': result.get('ResponseDescription', 'STK push failed')}
\ No newline at end of file
+        return {
+            'success': False,
+            'message': result.get('errorMessage') or result.get('ResponseDescription') or 'STK push failed',
+        }
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncMpesaService:
+    """
+    asyncio front for ASGI views.
+
+    Calls run the shared pooled client in worker threads, so the event loop is
+    never blocked and the token cache and connection pool are the same ones
+    the sync views use.
+    """
+
+    def __init__(self, service=None):
+        self.service = service or get_mpesa_service()
+
+    async def get_access_token(self, force_refresh=False):
+        return await sync_to_async(self.service.get_access_token, thread_sensitive=False)(force_refresh)
+
+    async def initiate_stk_push(self, phone_number, amount, account_reference):
+        return await sync_to_async(self.service.initiate_stk_push, thread_sensitive=False)(
+            phone_number, amount, account_reference
+        )
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_mpesa_service():
+    """The process-wide client, created on first use"""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = MpesaService()
+        return _service
@@ -0,0 +1,41 @@
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor can't be decoded"""
+
+
+def encode_cursor(sale):
+    """Opaque cursor pointing just after ``sale`` in (-sale_date, -id) order"""
+    raw = f"{sale.sale_date.isoformat()}|{sale.pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        sale_date, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(sale_date), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor('Invalid cursor')
+
+
+def keyset_page(queryset, cursor=None, page_size=50):
+    """
+    Return (rows, next_cursor) for newest-first sales.
+
+    Instead of OFFSET, each page continues from the (sale_date, id) of the
+    last row served, so every page is an index range scan of page_size rows
+    no matter how deep the user scrolls.
+    """
+    queryset = queryset.order_by('-sale_date', '-id')
+    if cursor:
+        sale_date, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(sale_date__lt=sale_date) | Q(sale_date=sale_date, id__lt=pk)
+        )
+    rows = list(queryset[:page_size + 1])
+    next_cursor = encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+    return rows[:page_size], next_cursor
@@ -0,0 +1,267 @@
+"""
+M-Pesa callback inbox and reconciliation.
+
+mpesa_callback only appends the raw callback to the MpesaCallback inbox (one
+INSERT), so Daraja is acknowledged at once whatever else is going on.
+process_callbacks() later settles the inbox in batches. It matches callbacks
+to transactions by checkout_request_id and marks transactions and their sales
+completed/paid or failed/cancelled with a fixed number of queries per batch.
+Stock for failed payments goes back on the shelf.
+
+Settling is idempotent. A callback for a transaction that is already settled
+is recorded as a duplicate and changes nothing, so any part of the inbox can
+be replayed.
+
+A callback with no matching transaction waits out UNMATCHED_GRACE in case its
+transaction is still being committed. It stays out of the batches while it
+waits, so junk posted to the open callback URL can't hold up real callbacks
+queued behind it. release_unsent_payments() cancels pending sales whose STK
+push was never recorded (e.g. the worker sending it died) and puts their
+stock back.
+"""
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from inventory.stock_service import apply_stock_changes
+from .models import MpesaCallback, MpesaTransaction, Sale, SaleItem
+from .mpesa_service import get_mpesa_service
+from .signals import sales_paid, sales_cancelled
+
+BATCH_SIZE = 500
+# A callback can beat the commit of its own MpesaTransaction; it is retried
+# for this long before being recorded as unmatched
+UNMATCHED_GRACE = timedelta(minutes=10)
+# A pending M-Pesa sale still without a transaction this long after it was
+# made had its push lost; longer than a push job's lease so it isn't cut short
+UNSENT_PUSH_TIMEOUT = timedelta(minutes=15)
+
+
+def parse_callback(payload):
+    """(checkout_request_id, result_code, result_description, receipt number) of an STK callback"""
+    callback = payload['Body']['stkCallback']
+    metadata = {
+        item['Name']: item.get('Value')
+        for item in callback.get('CallbackMetadata', {}).get('Item', [])
+    }
+    receipt = metadata.get('MpesaReceiptNumber')
+    return (
+        str(callback['CheckoutRequestID']),
+        int(callback['ResultCode']),
+        str(callback.get('ResultDesc', ''))[:255],
+        str(receipt) if receipt is not None else None,
+    )
+
+
+def record_callback(payload):
+    """Append a callback to the inbox; nothing else happens on the request path"""
+    try:
+        checkout_request_id = str(payload['Body']['stkCallback']['CheckoutRequestID'])[:100]
+    except (KeyError, TypeError):
+        checkout_request_id = ''
+    return MpesaCallback.objects.create(payload=payload, checkout_request_id=checkout_request_id)
+
+
+def _with_items(sales):
+    items = defaultdict(list)
+    for item in SaleItem.objects.filter(sale__in=sales).select_related('product'):
+        items[item.sale_id].append(item)
+    return [(sale, items[sale.pk]) for sale in sales]
+
+
+def mark_sales_paid(sales):
+    """Mark pending sales paid; call inside a transaction that holds their row locks"""
+    sales = [sale for sale in sales if sale.status == 'pending']
+    if not sales:
+        return []
+    Sale.objects.filter(pk__in=[sale.pk for sale in sales]).update(status='paid')
+    for sale in sales:
+        sale.status = 'paid'
+    pairs = _with_items(sales)
+    sales_paid.send(sender=Sale, sales=pairs)
+    return pairs
+
+
+def cancel_pending_sales(sales):
+    """
+    Cancel pending sales and restock their lines with one stock UPDATE.
+    Call inside a transaction that holds their row locks.
+    """
+    sales = [sale for sale in sales if sale.status == 'pending']
+    if not sales:
+        return []
+    Sale.objects.filter(pk__in=[sale.pk for sale in sales]).update(status='cancelled')
+    for sale in sales:
+        sale.status = 'cancelled'
+    pairs = _with_items(sales)
+    restock = Counter()
+    for _, items in pairs:
+        for item in items:
+            restock[item.product_id] += item.quantity
+    reference = f'Sale #{sales[0].pk} cancelled' if len(sales) == 1 else f'{len(sales)} sales cancelled'
+    apply_stock_changes(restock, 'refund', reference)
+    sales_cancelled.send(sender=Sale, sales=pairs)
+    return pairs
+
+
+def request_payment(sale_id, phone_number):
+    """
+    Send the STK push for a pending M-Pesa sale. On success the MpesaTransaction
+    the callback will settle is created, otherwise the sale is cancelled and
+    restocked. Returns the client's result dict.
+    """
+    sale = Sale.objects.get(pk=sale_id)
+    if sale.status != 'pending':
+        return {'success': False, 'message': f'Sale #{sale.id} is not awaiting payment'}
+    if sale.final_amount <= 0:
+        result = {'success': False, 'message': 'Invalid phone or amount'}
+    else:
+        result = get_mpesa_service().initiate_stk_push(phone_number, sale.final_amount, f"SALE{sale.id}")
+        if result['success'] and not result.get('checkout_request_id'):
+            # No callback could ever be matched to this push
+            result = {'success': False, 'message': 'M-Pesa did not return a checkout request ID'}
+
+    with transaction.atomic():
+        sale = Sale.objects.select_for_update().get(pk=sale_id)
+        if result['success']:
+            MpesaTransaction.objects.create(
+                sale=sale,
+                phone_number=phone_number,
+                amount=sale.final_amount,
+                checkout_request_id=result['checkout_request_id'],
+            )
+        else:
+            cancel_pending_sales([sale])
+    return result
+
+
+def process_callbacks(batch_size=BATCH_SIZE):
+    """
+    Settle up to batch_size unprocessed callbacks, oldest first.
+
+    Returns a Counter of outcomes. Concurrent workers skip each other's
+    locked rows, so several can drain the inbox at once.
+    """
+    return _process_batch(batch_size)[0]
+
+
+def _ready_callbacks(now):
+    # Unmatched callbacks still in their grace period are left for later
+    return MpesaCallback.objects.filter(processed_at__isnull=True).filter(
+        Q(received_at__lte=now - UNMATCHED_GRACE)
+        | Q(checkout_request_id='')
+        | Exists(MpesaTransaction.objects.filter(checkout_request_id=OuterRef('checkout_request_id')))
+    )
+
+
+def _process_batch(batch_size, after=0):
+    """Settle the next batch of ready callbacks with ids above ``after``; returns (outcomes, last id or None)"""
+    now = timezone.now()
+    with transaction.atomic():
+        callbacks = list(
+            _ready_callbacks(now).select_for_update(skip_locked=True)
+            .filter(id__gt=after)
+            .order_by('id')[:batch_size]
+        )
+        outcomes = {}
+        parsed = {}
+        for callback in callbacks:
+            try:
+                parsed[callback.pk] = parse_callback(callback.payload)
+            except (KeyError, TypeError, ValueError, AttributeError):
+                outcomes[callback.pk] = 'invalid'
+
+        transactions = {
+            tx.checkout_request_id: tx
+            for tx in MpesaTransaction.objects.select_for_update().select_related('sale')
+            .filter(checkout_request_id__in={values[0] for values in parsed.values()})
+            .order_by('pk')
+        }
+
+        settled = []
+        for callback in callbacks:
+            if callback.pk not in parsed:
+                continue
+            checkout_request_id, result_code, result_description, receipt = parsed[callback.pk]
+            tx = transactions.get(checkout_request_id)
+            if tx is None:
+                if now - callback.received_at < UNMATCHED_GRACE:
+                    continue
+                outcomes[callback.pk] = 'unmatched'
+            elif tx.status != 'pending':
+                outcomes[callback.pk] = 'duplicate'
+            else:
+                tx.status = 'completed' if result_code == 0 else 'failed'
+                tx.mpesa_receipt_number = receipt
+                tx.result_description = result_description
+                tx.settled_at = now
+                settled.append(tx)
+                outcomes[callback.pk] = 'settled'
+
+        if settled:
+            MpesaTransaction.objects.bulk_update(
+                settled, ['status', 'mpesa_receipt_number', 'result_description', 'settled_at']
+            )
+            mark_sales_paid([tx.sale for tx in settled if tx.status == 'completed'])
+            cancel_pending_sales([tx.sale for tx in settled if tx.status == 'failed'])
+
+        done = [callback for callback in callbacks if callback.pk in outcomes]
+        for callback in done:
+            callback.processed_at = now
+            callback.outcome = outcomes[callback.pk]
+        MpesaCallback.objects.bulk_update(done, ['processed_at', 'outcome'])
+
+    return Counter(outcomes.values()), callbacks[-1].pk if callbacks else None
+
+
+def process_inbox(batch_size=BATCH_SIZE):
+    """Run batches until the inbox holds nothing ready to settle; returns the total outcomes"""
+    totals = Counter()
+    after = 0
+    # Paged by id, so a batch whose callbacks were all left for later doesn't end the run
+    while True:
+        outcomes, after = _process_batch(batch_size, after)
+        totals.update(outcomes)
+        if after is None:
+            return totals
+
+
+def release_unsent_payments(now=None):
+    """
+    Cancel pending M-Pesa sales that still have no transaction after
+    UNSENT_PUSH_TIMEOUT and restock them. Returns the number cancelled.
+    """
+    cutoff = (now or timezone.now()) - UNSENT_PUSH_TIMEOUT
+    with transaction.atomic():
+        sales = list(
+            Sale.objects.select_for_update()
+            .filter(payment_method='mpesa', status='pending', sale_date__lt=cutoff)
+            .filter(~Exists(MpesaTransaction.objects.filter(sale=OuterRef('pk'))))
+            .order_by('pk')
+        )
+        return len(cancel_pending_sales(sales))
+
+
+def requeue_callbacks(callbacks):
+    """Mark callbacks unprocessed so the worker settles them again; returns how many"""
+    return callbacks.update(processed_at=None, outcome='')
+
+
+def payment_status(sale_id):
+    """Status of a sale's M-Pesa payment from the transaction row alone, or None"""
+    status = (
+        MpesaTransaction.objects.filter(sale_id=sale_id)
+        .values('status', 'mpesa_receipt_number', 'result_description')
+        .first()
+    )
+    if status is None:
+        # No transaction yet: the STK push may still be queued, or it failed to send
+        sale_status = Sale.objects.filter(pk=sale_id, payment_method='mpesa').values_list('status', flat=True).first()
+        if sale_status == 'pending':
+            status = {'status': 'pending'}
+        elif sale_status == 'cancelled':
+            status = {'status': 'failed', 'result_description': 'The payment request could not be sent'}
+    return status
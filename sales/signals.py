@@ -0,0 +1,21 @@
+from django.dispatch import Signal
+
+# Sent inside the checkout transaction once a sale and all its lines exist.
+# Arguments: sale, items (the SaleItem instances just created)
+sale_completed = Signal()
+
+# Sent inside the refund transaction after the sale is marked refunded.
+# Arguments: sale, items
+sale_refunded = Signal()
+
+# Sent after a sale or its lines were edited outside the POS (e.g. in the admin).
+# Arguments: sale
+sale_edited = Signal()
+
+# Sent inside the reconciliation transaction once pending sales are confirmed paid
+# (e.g. by M-Pesa callbacks). Arguments: sales, a list of (sale, items) pairs
+sales_paid = Signal()
+
+# Sent inside the transaction that cancelled pending sales and put their stock back.
+# Arguments: sales, a list of (sale, items) pairs
+sales_cancelled = Signal()
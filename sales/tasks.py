@@ -0,0 +1,11 @@
+from jobs.queue_service import task
+from .reconciliation_service import request_payment
+
+
+# Tills are waiting on these, so they jump the queue. A failed push cancels
+# the sale instead of being retried, so the customer is never prompted twice.
+# If the worker dies mid-push, release_unsent_payments() cancels the sale.
+@task(priority=10, max_attempts=1)
+def send_stk_push(sale_id, phone_number):
+    result = request_payment(sale_id, phone_number)
+    return {key: value for key, value in result.items() if key != 'merchant_request_id'}
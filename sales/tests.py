@@ -1,3 +1,733 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import skipIf
+from unittest.mock import patch
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, OperationalError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from inventory.models import Category, Supplier, Product
+from jobs.queue_service import work
+from reports.models import DailySalesTotal
+from .models import Sale, SaleItem, MpesaCallback, MpesaTransaction
+from .catalogue_service import MSGPACK_CONTENT_TYPE, msgpack
+from .checkout_service import checkout, CheckoutError
+from .mpesa_service import AsyncMpesaService, MpesaService, format_phone
+from .reconciliation_service import process_callbacks, process_inbox, record_callback, release_unsent_payments
+
+
+def make_catalogue(count, stock=100):
+    category = Category.objects.create(name=f'Category {Category.objects.count()}')
+    supplier = Supplier.objects.create(
+        name='Supplier', contact_person='Contact', phone='0700000000', address='Eldoret'
+    )
+    return [
+        Product.objects.create(
+            name=f'Product {i}',
+            category=category,
+            supplier=supplier,
+            cost_price=Decimal('60.00'),
+            selling_price=Decimal('100.00'),
+            quantity_in_stock=stock,
+        )
+        for i in range(count)
+    ]
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('cashier', password='pass')
+        self.products = make_catalogue(3, stock=5)
+
+    def test_checkout_creates_sale_and_decrements_stock(self):
+        items = [{'id': p.id, 'quantity': 2} for p in self.products]
+        sale, sale_items = checkout(self.user, items, discount=Decimal('50'))
+
+        self.assertEqual(sale.total_amount, Decimal('600.00'))
+        self.assertEqual(sale.subtotal, Decimal('600.00'))
+        self.assertEqual(sale.final_amount, Decimal('550.00'))
+        self.assertEqual(sale.items.count(), 3)
+        for product in self.products:
+            product.refresh_from_db()
+            self.assertEqual(product.quantity_in_stock, 3)
+
+    def test_duplicate_cart_lines_are_merged(self):
+        product = self.products[0]
+        sale, sale_items = checkout(self.user, [
+            {'id': product.id, 'quantity': 1},
+            {'id': product.id, 'quantity': 2},
+        ])
+        self.assertEqual(len(sale_items), 1)
+        self.assertEqual(sale_items[0].quantity, 3)
+
+    def test_insufficient_stock_rolls_back(self):
+        items = [
+            {'id': self.products[0].id, 'quantity': 1},
+            {'id': self.products[1].id, 'quantity': 6},
+        ]
+        with self.assertRaises(CheckoutError):
+            checkout(self.user, items)
+
+        self.assertFalse(Sale.objects.exists())
+        self.products[0].refresh_from_db()
+        self.assertEqual(self.products[0].quantity_in_stock, 5)
+
+
+class CheckoutQueryCountBenchmark(TestCase):
+    """Query counts for baskets of 1, 10 and 50 lines, set-based vs per-line saves"""
+
+    BASKET_SIZES = [1, 10, 50]
+
+    def setUp(self):
+        self.user = User.objects.create_user('cashier', password='pass')
+        self.products = make_catalogue(max(self.BASKET_SIZES))
+        # Sell everything once so every basket updates existing daily rollup rows
+        checkout(self.user, [{'id': p.id, 'quantity': 1} for p in self.products])
+
+    def _checkout_queries(self, size):
+        items = [{'id': p.id, 'quantity': 1} for p in self.products[:size]]
+        with CaptureQueriesContext(connection) as ctx:
+            checkout(self.user, items)
+        return len(ctx)
+
+    def _per_line_queries(self, size):
+        with CaptureQueriesContext(connection) as ctx:
+            sale = Sale.objects.create(served_by=self.user, status='paid')
+            for product in Product.objects.filter(pk__in=[p.pk for p in self.products[:size]]):
+                SaleItem.objects.create(sale=sale, product=product, quantity=1, unit_price=0)
+        return len(ctx)
+
+    def test_checkout_query_count_is_constant(self):
+        results = {
+            size: (self._checkout_queries(size), self._per_line_queries(size))
+            for size in self.BASKET_SIZES
+        }
+        set_based_counts = {checkout_count for checkout_count, _ in results.values()}
+        self.assertEqual(len(set_based_counts), 1, results)
+        for size, (checkout_count, per_line_count) in results.items():
+            if size > 1:
+                self.assertLess(checkout_count, per_line_count, results)
+
+
+class ConcurrentCheckoutStressTest(TransactionTestCase):
+    """Many tills selling the same product at once must never lose or oversell stock"""
+
+    WORKERS = 8
+    SALES_PER_WORKER = 10
+    STARTING_STOCK = 50
+
+    def setUp(self):
+        self.user = User.objects.create_user('cashier', password='pass')
+        self.product = make_catalogue(1, stock=self.STARTING_STOCK)[0]
+
+    def _till(self, barrier, outcomes):
+        try:
+            barrier.wait()
+            for _ in range(self.SALES_PER_WORKER):
+                while True:
+                    try:
+                        checkout(self.user, [{'id': self.product.id, 'quantity': 1}])
+                        outcomes.append('sold')
+                    except CheckoutError:
+                        outcomes.append('rejected')
+                    except OperationalError:
+                        # SQLite reports a busy database instead of blocking; retry like a till would
+                        time.sleep(0.001)
+                        continue
+                    break
+        finally:
+            connection.close()
+
+    def test_parallel_checkouts_keep_stock_consistent(self):
+        barrier = threading.Barrier(self.WORKERS)
+        outcomes = []
+        threads = [
+            threading.Thread(target=self._till, args=(barrier, outcomes))
+            for _ in range(self.WORKERS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        sold = outcomes.count('sold')
+        self.product.refresh_from_db()
+        self.assertEqual(len(outcomes), self.WORKERS * self.SALES_PER_WORKER)
+        self.assertEqual(sold, self.STARTING_STOCK)
+        self.assertEqual(self.product.quantity_in_stock, 0)
+        self.assertEqual(SaleItem.objects.filter(product=self.product).count(), sold)
+
+
+class StockUpdateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass', is_superuser=True)
+        self.product = make_catalogue(1, stock=10)[0]
+
+    def test_sale_item_save_uses_database_stock(self):
+        stale = Product.objects.get(pk=self.product.pk)
+        Product.objects.filter(pk=self.product.pk).update(quantity_in_stock=3)
+        sale = Sale.objects.create(served_by=self.user)
+        SaleItem.objects.create(sale=sale, product=stale, quantity=2, unit_price=0)
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity_in_stock, 1)
+        with self.assertRaises(ValueError):
+            SaleItem.objects.create(sale=sale, product=stale, quantity=2, unit_price=0)
+
+    def test_refund_restores_stock_once(self):
+        sale, _ = checkout(self.user, [{'id': self.product.id, 'quantity': 4}])
+        self.client.force_login(self.user)
+
+        first = self.client.post(f'/sales/refund/{sale.id}/').json()
+        second = self.client.post(f'/sales/refund/{sale.id}/').json()
+
+        self.assertTrue(first['success'])
+        self.assertFalse(second['success'])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity_in_stock, 10)
+
+
+class SalesHistoryPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('cashier', password='pass')
+        product = make_catalogue(1)[0]
+        self.sales = [
+            checkout(self.user, [{'id': product.id, 'quantity': 1}])[0]
+            for _ in range(7)
+        ]
+        # Two sales share a timestamp so the id tie-breaker is exercised
+        Sale.objects.filter(pk=self.sales[3].pk).update(sale_date=self.sales[4].sale_date)
+        self.client.force_login(self.user)
+
+    @patch('sales.views.HISTORY_PAGE_SIZE', 3)
+    def test_cursor_walks_every_sale_once_newest_first(self):
+        expected = list(Sale.objects.order_by('-sale_date', '-id').values_list('id', flat=True))
+        seen = []
+        cursor = None
+        while True:
+            data = self.client.get('/sales/api/history/', {'cursor': cursor} if cursor else {}).json()
+            self.assertLessEqual(len(data['sales']), 3)
+            seen += [row['id'] for row in data['sales']]
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(seen, expected)
+
+    def test_history_page_counts_items_without_loading_them(self):
+        response = self.client.get('/sales/history/')
+        self.assertEqual(response.context['totals']['count'], 7)
+        self.assertIsNone(response.context['next_cursor'])
+        first = response.context['sales'][0]
+        self.assertEqual(first.item_count, 1)
+        self.assertFalse(getattr(first, '_prefetched_objects_cache', {}))
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get('/sales/api/history/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+
+class CatalogueSyncTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('cashier', password='pass')
+        self.products = make_catalogue(3, stock=2)
+        Product.objects.filter(pk=self.products[2].pk).update(is_active=False)
+        # Pretend the catalogue was last touched an hour ago
+        Product.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        Product.objects.filter(pk=self.products[2].pk).update(updated_at=timezone.now() - timedelta(hours=2))
+        self.client.force_login(self.user)
+
+    def _snapshot(self, **headers):
+        return self.client.get('/sales/api/catalogue/', headers=headers)
+
+    def test_snapshot_lists_sellable_products_as_compact_rows(self):
+        data = self._snapshot().json()
+        self.assertEqual(data['fields'][:2], ['id', 'name'])
+        self.assertEqual(sorted(row[0] for row in data['products']), [p.pk for p in self.products[:2]])
+        self.assertEqual(data['count'], 2)
+
+    def test_unchanged_catalogue_revalidates_without_building_the_snapshot(self):
+        etag = self._snapshot()['ETag']
+        # Session and user lookups, then the version and count
+        with self.assertNumQueries(4):
+            response = self._snapshot(if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+
+        checkout(self.user, [{'id': self.products[0].id, 'quantity': 1}])
+        self.assertEqual(self._snapshot(if_none_match=etag).status_code, 200)
+
+    def test_changes_since_a_version_only_carry_changed_products(self):
+        version = self._snapshot().json()['version']
+        checkout(self.user, [{'id': self.products[0].id, 'quantity': 1}])
+        checkout(self.user, [{'id': self.products[1].id, 'quantity': 2}])
+
+        delta = self.client.get('/sales/api/catalogue/changes/', {'since': version}).json()
+        self.assertEqual([(row[0], row[5]) for row in delta['products']], [(self.products[0].pk, 1)])
+        self.assertEqual(delta['removed'], [self.products[1].pk])
+        self.assertEqual(delta['count'], 1)
+        self.assertGreater(delta['version'], version)
+
+    def test_changes_require_a_version(self):
+        for since in ['yesterday', '-1', '1' + '0' * 30, str(10 ** 18)]:
+            response = self.client.get('/sales/api/catalogue/changes/', {'since': since})
+            self.assertEqual(response.status_code, 400, since)
+
+    def test_msgpack_is_optional(self):
+        with patch('sales.catalogue_service.msgpack', None):
+            response = self._snapshot(accept=MSGPACK_CONTENT_TYPE)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response.json()['count'], 2)
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_tills_can_ask_for_msgpack(self):
+        response = self._snapshot(accept=MSGPACK_CONTENT_TYPE)
+        self.assertEqual(response['Content-Type'], MSGPACK_CONTENT_TYPE)
+        self.assertEqual(msgpack.unpackb(response.content)['count'], 2)
+
+
+class ConditionalResponseTests(TestCase):
+    # Queries a revalidation hit may run: session and user lookups, then the validator
+    REVALIDATION_QUERIES = {
+        '/sales/api/search-products/?q=product': 2 + 2,
+        '/sales/api/categories/': 2 + 1,
+        '/sales/daily-summary/': 2 + 2,
+        '/reports/api/dashboard/': 2 + 3,
+    }
+
+    def setUp(self):
+        self.user = User.objects.create_user('manager', password='pass', is_superuser=True)
+        self.products = make_catalogue(3, stock=10)
+        self.sale, _ = checkout(self.user, [{'id': self.products[0].id, 'quantity': 1}])
+        self.client.force_login(self.user)
+        self.urls = dict(self.REVALIDATION_QUERIES)
+        self.urls[f'/sales/receipt/{self.sale.id}/'] = 2 + 1
+
+    def _etags(self):
+        etags = {}
+        for url in self.urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            etags[url] = response['ETag']
+        return etags
+
+    def test_revalidation_hits_skip_the_view(self):
+        for url, etag in self._etags().items():
+            with CaptureQueriesContext(connection) as full:
+                self.client.get(url)
+            with self.assertNumQueries(self.urls[url]):
+                response = self.client.get(url, headers={'if-none-match': etag})
+            self.assertEqual(response.status_code, 304, url)
+            self.assertLessEqual(self.urls[url], len(full), url)
+
+    def test_changes_invalidate_the_validators(self):
+        etags = self._etags()
+        checkout(self.user, [{'id': self.products[1].id, 'quantity': 1}])
+        category = self.products[0].category
+        category.name = 'Renamed'
+        category.save()
+        self.client.post(f'/sales/refund/{self.sale.id}/')
+        for url, etag in etags.items():
+            response = self.client.get(url, headers={'if-none-match': etag})
+            self.assertEqual(response.status_code, 200, url)
+
+
+class StubDarajaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        daraja = self.server.daraja
+        daraja.connections.add(self.client_address)
+        if not self.path.startswith('/oauth/v1/generate'):
+            return self._reply(404, {})
+        with daraja.lock:
+            daraja.token_requests += 1
+            token = f'token-{daraja.token_requests}'
+            daraja.valid_tokens.add(token)
+        self._reply(200, {'access_token': token, 'expires_in': '3599'})
+
+    def do_POST(self):
+        daraja = self.server.daraja
+        daraja.connections.add(self.client_address)
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+        if token not in daraja.valid_tokens:
+            return self._reply(401, {'errorMessage': 'Invalid Access Token'})
+        with daraja.lock:
+            daraja.pushes.append(payload)
+            number = len(daraja.pushes)
+        self._reply(200, {
+            'MerchantRequestID': f'merchant-{number}',
+            'CheckoutRequestID': f'ws_CO_{number}',
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+        })
+
+
+class StubDaraja:
+    """Local stand-in for the Daraja OAuth and STK push endpoints"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.token_requests = 0
+        self.valid_tokens = set()
+        self.pushes = []
+        self.connections = set()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubDarajaHandler)
+        self.server.daemon_threads = True
+        self.server.daraja = self
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MpesaClientTests(SimpleTestCase):
+    def setUp(self):
+        self.daraja = StubDaraja().__enter__()
+        self.addCleanup(self.daraja.__exit__)
+        self.service = MpesaService(base_url=self.daraja.url)
+        self.addCleanup(self.service.close)
+
+    def test_token_and_connection_are_reused_across_pushes(self):
+        for i in range(5):
+            result = self.service.initiate_stk_push('0712345678', Decimal('150.50'), f'SALE{i}')
+            self.assertTrue(result['success'])
+            self.assertEqual(result['checkout_request_id'], f'ws_CO_{i + 1}')
+        self.assertEqual(self.daraja.token_requests, 1)
+        self.assertEqual(len(self.daraja.connections), 1)
+        push = self.daraja.pushes[0]
+        self.assertEqual(push['PhoneNumber'], '254712345678')
+        self.assertEqual(push['Amount'], 150)
+
+    def test_expired_token_is_refreshed(self):
+        self.service.initiate_stk_push('0712345678', 10, 'SALE')
+        self.service._token_expires_at = time.monotonic() - 1
+        self.service.initiate_stk_push('0712345678', 10, 'SALE')
+        self.assertEqual(self.daraja.token_requests, 2)
+
+    def test_revoked_token_is_refreshed_and_the_push_retried(self):
+        self.service.initiate_stk_push('0712345678', 10, 'SALE')
+        self.daraja.valid_tokens.clear()
+        result = self.service.initiate_stk_push('0712345678', 10, 'SALE')
+        self.assertTrue(result['success'])
+        self.assertEqual(self.daraja.token_requests, 2)
+        self.assertEqual(len(self.daraja.pushes), 2)
+
+    def test_unreachable_daraja_fails_cleanly(self):
+        self.daraja.__exit__()
+        service = MpesaService(base_url=self.daraja.url, timeout=(0.5, 0.5))
+        result = service.initiate_stk_push('0712345678', 10, 'SALE')
+        self.assertFalse(result['success'])
+        self.assertIn('Failed to get token', result['message'])
+
+    def test_concurrent_pushes_share_one_token(self):
+        threads = [
+            threading.Thread(target=self.service.initiate_stk_push, args=('0712345678', 10, 'SALE'))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.daraja.pushes), 8)
+        self.assertEqual(self.daraja.token_requests, 1)
+
+    async def test_async_client_shares_the_pooled_client(self):
+        client = AsyncMpesaService(self.service)
+        results = await asyncio.gather(*[
+            client.initiate_stk_push('712345678', 10, f'SALE{i}') for i in range(4)
+        ])
+        self.assertTrue(all(result['success'] for result in results))
+        self.assertEqual(self.daraja.token_requests, 1)
+        self.assertEqual(await client.get_access_token(), 'token-1')
+
+    def test_format_phone(self):
+        for number in ('0712345678', '712345678', '254712345678', '+254712345678'):
+            self.assertEqual(format_phone(number), '254712345678')
+
+
+def stk_callback(checkout_request_id, result_code=0, receipt='QKX0000001'):
+    callback = {
+        'MerchantRequestID': 'merchant',
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.' if result_code == 0
+        else 'Request cancelled by user',
+    }
+    if result_code == 0:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': 100},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+            {'Name': 'PhoneNumber', 'Value': 254712345678},
+        ]}
+    return {'Body': {'stkCallback': callback}}
+
+
+class MpesaReconciliationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('cashier', password='pass')
+        self.products = make_catalogue(2, stock=10)
+        self.sales = []
+        for i in range(3):
+            sale, _ = checkout(
+                self.user, [{'id': self.products[0].id, 'quantity': 2}],
+                payment_method='mpesa', status='pending',
+            )
+            MpesaTransaction.objects.create(
+                sale=sale, phone_number='254712345678', amount=sale.final_amount,
+                checkout_request_id=f'ws_CO_{i}',
+            )
+            self.sales.append(sale)
+
+    def _post(self, payload):
+        return self.client.post('/sales/mpesa/callback/', payload, content_type='application/json')
+
+    def _stock(self):
+        return Product.objects.get(pk=self.products[0].pk).quantity_in_stock
+
+    def test_callback_is_only_appended_to_the_inbox(self):
+        with self.assertNumQueries(1):
+            response = self._post(stk_callback('ws_CO_0'))
+        self.assertEqual(response.json()['ResultCode'], 0)
+        self.assertEqual(MpesaCallback.objects.get().checkout_request_id, 'ws_CO_0')
+        self.assertEqual(MpesaTransaction.objects.get(checkout_request_id='ws_CO_0').status, 'pending')
+        self.assertEqual(self._post('not json').status_code, 400)
+
+    def test_batch_settles_payments_and_failures(self):
+        self._post(stk_callback('ws_CO_0', receipt='QKX111'))
+        self._post(stk_callback('ws_CO_1', result_code=1032))
+        self.assertEqual(process_inbox(), {'settled': 2})
+
+        paid = MpesaTransaction.objects.select_related('sale').get(checkout_request_id='ws_CO_0')
+        self.assertEqual((paid.status, paid.mpesa_receipt_number, paid.sale.status),
+                         ('completed', 'QKX111', 'paid'))
+        failed = MpesaTransaction.objects.select_related('sale').get(checkout_request_id='ws_CO_1')
+        self.assertEqual((failed.status, failed.sale.status), ('failed', 'cancelled'))
+        self.assertEqual(failed.result_description, 'Request cancelled by user')
+        # Two pending sales still hold their stock, the cancelled one gave it back
+        self.assertEqual(self._stock(), 6)
+        total = DailySalesTotal.objects.get(payment_method='mpesa')
+        self.assertEqual((total.sale_count, total.final_amount), (1, Decimal('200.00')))
+
+    def test_duplicates_and_replays_are_idempotent(self):
+        self._post(stk_callback('ws_CO_0'))
+        self._post(stk_callback('ws_CO_0'))
+        self.assertEqual(process_inbox(), {'settled': 1, 'duplicate': 1})
+        self._post(stk_callback('ws_CO_0', result_code=1032))
+        call_command('replay_mpesa_callbacks', checkout_request_id=['ws_CO_0'], process=True, stdout=StringIO())
+        self.assertEqual(MpesaCallback.objects.filter(outcome='duplicate').count(), 3)
+        self.assertEqual(MpesaTransaction.objects.get(checkout_request_id='ws_CO_0').status, 'completed')
+        self.assertEqual(DailySalesTotal.objects.get(payment_method='mpesa').sale_count, 1)
+        self.assertEqual(self._stock(), 4)
+
+    def test_unmatched_callbacks_wait_out_the_grace_period(self):
+        callback = record_callback(stk_callback('ws_CO_unknown'))
+        record_callback({'Body': {}})
+        self.assertEqual(process_callbacks(), {'invalid': 1})
+        callback.refresh_from_db()
+        self.assertIsNone(callback.processed_at)
+
+        MpesaCallback.objects.filter(pk=callback.pk).update(received_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(process_callbacks(), {'unmatched': 1})
+
+    def test_waiting_callbacks_do_not_hold_up_the_inbox(self):
+        # More junk than a batch at the head of the inbox, then a real callback
+        for i in range(12):
+            record_callback(stk_callback(f'ws_CO_junk{i}'))
+        record_callback(stk_callback('ws_CO_0'))
+        self.assertEqual(process_inbox(batch_size=5), {'settled': 1})
+        self.assertEqual(Sale.objects.get(pk=self.sales[0].pk).status, 'paid')
+        self.assertEqual(MpesaCallback.objects.filter(processed_at__isnull=True).count(), 12)
+
+    def test_sales_whose_push_was_never_recorded_are_released(self):
+        stuck, _ = checkout(self.user, [{'id': self.products[0].id, 'quantity': 2}],
+                            payment_method='mpesa', status='pending')
+        self.assertEqual(self._stock(), 2)
+        self.assertEqual(release_unsent_payments(), 0)
+
+        Sale.objects.filter(pk__in=[stuck.pk, self.sales[0].pk]).update(
+            sale_date=timezone.now() - timedelta(hours=1)
+        )
+        out = StringIO()
+        call_command('process_mpesa_callbacks', stdout=out)
+        self.assertIn('Cancelled 1 sales', out.getvalue())
+        # Sales with a transaction wait for their callback instead
+        self.assertEqual(Sale.objects.get(pk=self.sales[0].pk).status, 'pending')
+        self.assertEqual(Sale.objects.get(pk=stuck.pk).status, 'cancelled')
+        self.assertEqual(self._stock(), 4)
+
+    def test_batch_query_count_does_not_grow_with_the_batch(self):
+        def settle(checkout_request_ids):
+            for checkout_request_id in checkout_request_ids:
+                record_callback(stk_callback(checkout_request_id))
+            with CaptureQueriesContext(connection) as queries:
+                process_callbacks()
+            return len(queries)
+
+        self.assertEqual(settle(['ws_CO_0']), settle(['ws_CO_1', 'ws_CO_2']))
+
+    def test_status_is_answered_from_the_transaction_row(self):
+        self.client.force_login(self.user)
+        sale = self.sales[0]
+        self.assertEqual(self.client.get(f'/sales/mpesa/status/{sale.id}/').json()['status'], 'pending')
+        record_callback(stk_callback('ws_CO_0'))
+        process_inbox()
+        with self.assertNumQueries(2 + 1):
+            response = self.client.get(f'/sales/mpesa/status/{sale.id}/')
+        self.assertEqual(response.json()['status'], 'completed')
+        self.assertEqual(self.client.get('/sales/mpesa/status/999999/').status_code, 404)
+
+    def test_replay_appends_callbacks_from_a_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'callbacks.jsonl')
+        with open(path, 'w') as lines:
+            lines.write('\n'.join(json.dumps(stk_callback(f'ws_CO_{i}')) for i in range(3)))
+        call_command('replay_mpesa_callbacks', file=path, process=True, stdout=StringIO())
+        self.assertEqual(Sale.objects.filter(status='paid').count(), 3)
+
+
+class MpesaInitiateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('cashier', password='pass')
+        self.client.force_login(self.user)
+        self.product = make_catalogue(1, stock=5)[0]
+
+    def _post(self):
+        return self.client.post('/sales/mpesa/initiate/', {
+            'phone_number': '0712345678',
+            'amount': 200,
+            'sale_data': {'items': [{'id': self.product.id, 'quantity': 2}], 'discount': 0},
+        }, content_type='application/json').json()
+
+    def _initiate(self, url):
+        with override_settings(MPESA_BASE_URL=url), patch('sales.mpesa_service._service', None):
+            return self._post()
+
+    def test_view_uses_the_shared_client(self):
+        with StubDaraja() as daraja, override_settings(MPESA_BASE_URL=daraja.url), \
+                patch('sales.mpesa_service._service', None):
+            for _ in range(2):
+                self.assertTrue(self._post()['success'])
+        self.assertEqual(daraja.token_requests, 1)
+
+    def test_push_creates_a_pending_sale_holding_its_stock(self):
+        with StubDaraja() as daraja:
+            result = self._initiate(daraja.url)
+        self.assertTrue(result['success'])
+        sale = Sale.objects.get(pk=result['sale_id'])
+        self.assertEqual((sale.status, sale.payment_method), ('pending', 'mpesa'))
+        self.assertEqual(sale.mpesa_transaction.checkout_request_id, result['checkout_request_id'])
+        self.assertEqual(daraja.pushes[0]['Amount'], 200)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity_in_stock, 3)
+
+    @override_settings(BACKGROUND_JOBS=True)
+    def test_push_can_be_queued(self):
+        result = self._post()
+        self.assertTrue(result['queued'])
+        status_url = f"/sales/mpesa/status/{result['sale_id']}/"
+        self.assertEqual(self.client.get(status_url).json()['status'], 'pending')
+
+        with StubDaraja() as daraja, override_settings(MPESA_BASE_URL=daraja.url), \
+                patch('sales.mpesa_service._service', None):
+            work(burst=True)
+        self.assertEqual(len(daraja.pushes), 1)
+        self.assertEqual(Sale.objects.get(pk=result['sale_id']).mpesa_transaction.checkout_request_id, 'ws_CO_1')
+        self.assertEqual(self.client.get(status_url).json()['status'], 'pending')
+
+    def test_failed_push_cancels_the_sale(self):
+        with StubDaraja() as daraja:
+            pass
+        result = self._initiate(daraja.url)
+        self.assertFalse(result['success'])
+        self.assertEqual(Sale.objects.get().status, 'cancelled')
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity_in_stock, 5)
+
+    def test_push_without_a_checkout_request_id_fails(self):
+        accepted = {'success': True, 'checkout_request_id': None, 'merchant_request_id': 'merchant'}
+        with patch('sales.reconciliation_service.get_mpesa_service') as service:
+            service.return_value.initiate_stk_push.return_value = accepted
+            result = self._post()
+        self.assertFalse(result['success'])
+        self.assertIn('checkout request ID', result['message'])
+        self.assertFalse(MpesaTransaction.objects.exists())
+        self.assertEqual(Sale.objects.get().status, 'cancelled')
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity_in_stock, 5)
+
+
+@tag('benchmark')
+class MpesaCallbackLoadTest(TestCase):
+    """Thousands of callbacks a minute through the inbox and the batch worker"""
+
+    CALLBACKS = 3000
+    PER_MINUTE = 3000
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user('cashier', password='pass')
+        product = make_catalogue(1, stock=cls.CALLBACKS * 2)[0]
+        sales = Sale.objects.bulk_create([
+            Sale(served_by=user, payment_method='mpesa', status='pending',
+                 subtotal=Decimal('100.00'), total_amount=Decimal('100.00'), final_amount=Decimal('100.00'))
+            for _ in range(cls.CALLBACKS)
+        ])
+        SaleItem.objects.bulk_create([
+            SaleItem(sale=sale, product=product, quantity=1, unit_price=Decimal('100.00'),
+                     unit_cost=Decimal('60.00'), total_price=Decimal('100.00'))
+            for sale in sales
+        ])
+        MpesaTransaction.objects.bulk_create([
+            MpesaTransaction(sale=sale, phone_number='254712345678', amount=Decimal('100.00'),
+                             checkout_request_id=f'ws_CO_{sale.pk}')
+            for sale in sales
+        ])
+
+    def test_thousands_of_callbacks_per_minute(self):
+        checkout_request_ids = list(MpesaTransaction.objects.values_list('checkout_request_id', flat=True))
+        # Every tenth payment is cancelled and every twentieth callback is delivered twice
+        payloads = [stk_callback(cid, result_code=1032 if i % 10 == 0 else 0, receipt=f'R{i}')
+                    for i, cid in enumerate(checkout_request_ids)]
+        payloads += payloads[::20]
+
+        started = time.perf_counter()
+        for payload in payloads:
+            self.client.post('/sales/mpesa/callback/', payload, content_type='application/json')
+        ingested = time.perf_counter()
+        outcomes = process_inbox()
+        finished = time.perf_counter()
+
+        self.assertEqual(outcomes, {'settled': self.CALLBACKS, 'duplicate': len(payloads) - self.CALLBACKS})
+        self.assertEqual(Sale.objects.filter(status='paid').count(), self.CALLBACKS * 9 // 10)
+        self.assertEqual(Sale.objects.filter(status='cancelled').count(), self.CALLBACKS // 10)
+        self.assertEqual(DailySalesTotal.objects.get().sale_count, self.CALLBACKS * 9 // 10)
+        per_minute = len(payloads) / (finished - started) * 60
+        self.assertGreater(per_minute, self.PER_MINUTE,
+                           f'ingest {ingested - started:.2f}s, settle {finished - ingested:.2f}s')
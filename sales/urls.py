@@ -7,9 +7,14 @@ urlpatterns = [
     path('pos/', views.pos_system, name='pos'),
     path('create/', views.create_sale, name='create_sale'),
     path('api/search-products/', views.search_products_api, name='search_products_api'),
+    path('api/barcode/stats/', views.barcode_cache_stats_api, name='barcode_cache_stats_api'),
+    path('api/barcode/<str:barcode>/', views.barcode_lookup_api, name='barcode_lookup_api'),
+    path('api/catalogue/', views.catalogue_api, name='catalogue_api'),
+    path('api/catalogue/changes/', views.catalogue_changes_api, name='catalogue_changes_api'),
     path('api/categories/', views.categories_api, name='categories_api'),
     path('process/', views.process_sale, name='process_sale'),
     path('history/', views.sales_history, name='sales_history'),
+    path('api/history/', views.sales_history_api, name='sales_history_api'),
     path('detail/<int:sale_id>/', views.sale_detail, name='sale_detail'),
     path('refund/<int:sale_id>/', views.refund_sale, name='refund_sale'),
     path('receipt/<int:sale_id>/', views.get_sale_receipt_data, name='receipt_data'),
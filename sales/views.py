@@ -2,19 +2,34 @@ import json
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse
-from django.db.models import Q, Sum, F
+from django.http import JsonResponse, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.db.models import Q, Sum, Count, Max
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.db import transaction
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 from decimal import Decimal
-from .models import Sale, SaleItem
+from pharmacy.date_windows import day_window, within
+from .models import Sale
+from inventory.alert_service import low_stock_products
 from inventory.models import Product, Category
 from .forms import SaleForm
+from .checkout_service import checkout, CheckoutError
+from .signals import sale_refunded
+from .pagination import keyset_page, InvalidCursor
+from reports.models import DailySalesRollup, DailySalesTotal
+from reports.rollup_service import rollup_version
+from pharmacy.conditional import conditional
+from inventory.stock_service import apply_stock_changes
+from inventory.search_service import search_products
+from inventory.barcode_service import barcode_cache, product_payload
+from .catalogue_service import catalogue_state, catalogue_etag, catalogue_snapshot, catalogue_changes, encode
 # Add these imports to your existing views.py
 from .models import MpesaTransaction
-#from .mpesa_service import MpesaService
+from .reconciliation_service import record_callback, request_payment, payment_status
+from .tasks import send_stk_push
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
@@ -22,6 +37,8 @@ from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
 
+HISTORY_PAGE_SIZE = 50
+
 @login_required
 def create_sale(request):
     """Traditional form-based sale creation"""
@@ -66,29 +83,31 @@ def create_sale(request):
 @login_required
 def pos_system(request):
     """Enhanced Point of Sale System"""
+    # Only the first cards are rendered; the till loads the full catalogue from catalogue_api
     products = Product.objects.filter(
         is_active=True, 
         quantity_in_stock__gt=0
-    ).select_related('category', 'supplier')
+    )[:12]
     
     categories = Category.objects.all()
     
     # Low stock alerts for POS
-    low_stock_products = Product.objects.filter(
-        quantity_in_stock__lte=F('minimum_stock_level'),
-        is_active=True
-    )
+    low_stock = low_stock_products()
     
     context = {
         'products': products,
         'categories': categories,
-        'low_stock_products': low_stock_products,
+        'low_stock_products': low_stock,
         'payment_methods': Sale.PAYMENT_METHODS,
     }
     
     return render(request, 'sales/pos.html', context)
 
+def _catalogue_validator(request):
+    return catalogue_state()
+
 @login_required
+@conditional(_catalogue_validator)
 def search_products_api(request):
     """Enhanced API endpoint for product search in POS"""
     query = request.GET.get('q', '')
@@ -99,33 +118,61 @@ def search_products_api(request):
         quantity_in_stock__gt=0
     )
     
-    if query:
-        products_query = products_query.filter(
-            Q(name__icontains=query) | 
-            Q(barcode__icontains=query) |
-            Q(generic_name__icontains=query)
-        )
-    
     if category_id:
         products_query = products_query.filter(category_id=category_id)
     
-    products = products_query.select_related('category')[:20]
+    products_query = products_query.select_related('category')
     
-    data = [{
-        'id': p.id,
-        'name': p.name,
-        'generic_name': p.generic_name or '',
-        'price': str(p.selling_price),
-        'cost_price': str(p.cost_price),
-        'stock': p.quantity_in_stock,
-        'barcode': p.barcode or '',
-        'category': p.category.name,
-        'is_low_stock': p.is_low_stock,
-        'profit_margin': str(p.profit_margin),
-    } for p in products]
+    if query:
+        # Ranked, typo-tolerant search with an exact barcode fast path
+        products = search_products(query, products_query, limit=20)
+    else:
+        products = products_query[:20]
+    
+    data = [product_payload(p) for p in products]
     
     return JsonResponse({'products': data})
 
+def _catalogue_response(request, data):
+    body, content_type = encode(data, request.headers.get('Accept', ''))
+    response = HttpResponse(body, content_type=content_type)
+    response['Vary'] = 'Accept'
+    return response
+
+@login_required
+def catalogue_api(request):
+    """Full sellable catalogue for tills to cache client-side, revalidated by ETag"""
+    version, count = catalogue_state()
+    etag = catalogue_etag(version, count)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = _catalogue_response(request, catalogue_snapshot(version, count))
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+@login_required
+def catalogue_changes_api(request):
+    """Products changed since the catalogue version a till already holds"""
+    try:
+        changes = catalogue_changes(int(request.GET.get('since', '')))
+    except ValueError:
+        return JsonResponse({'error': 'since must be a catalogue version'}, status=400)
+    return _catalogue_response(request, changes)
+
+@login_required
+def barcode_lookup_api(request, barcode):
+    """Exact barcode lookup for scanner input, served from the in-memory barcode cache"""
+    product = barcode_cache.get(barcode)
+    if product is None:
+        return JsonResponse({'error': 'Product not found'}, status=404)
+    return JsonResponse({'product': product})
+
+@login_required
+def barcode_cache_stats_api(request):
+    """Hit/miss counters for the barcode cache in this worker"""
+    return JsonResponse(barcode_cache.stats())
+
 @login_required
 @require_http_methods(["POST"])
 def process_sale(request):
@@ -148,61 +195,15 @@ def process_sale(request):
                 'message': 'No items in cart'
             })
         
-        # Calculate totals and validate items
-        subtotal = Decimal('0')
-        sale_items_data = []
-        
-        for item in items:
-            try:
-                product = Product.objects.get(id=item['id'], is_active=True)
-                quantity = int(item['quantity'])
-                
-                # Check stock availability
-                if quantity > product.quantity_in_stock:
-                    return JsonResponse({
-                        'success': False,
-                        'message': f'Insufficient stock for {product.name}. Available: {product.quantity_in_stock}'
-                    })
-                
-                item_total = product.selling_price * quantity
-                subtotal += item_total
-                
-                sale_items_data.append({
-                    'product': product,
-                    'quantity': quantity,
-                    'unit_price': product.selling_price,
-                    'unit_cost': product.cost_price,
-                    'total_price': item_total
-                })
-                
-            except Product.DoesNotExist:
-                return JsonResponse({
-                    'success': False,
-                    'message': f'Product not found: {item.get("name", "Unknown")}'
-                })
-        
-        # Create sale with transaction to ensure data consistency
-        with transaction.atomic():
-            # Create the sale record
-            sale = Sale.objects.create(
-                customer_name=customer_name,
-                customer_phone=customer_phone,
-                payment_method=payment_method,
-                total_amount=subtotal,
-                discount=discount,
-                served_by=request.user,
-                status='paid'
-            )
-            
-            # Create sale items and update stock
-            for item_data in sale_items_data:
-                SaleItem.objects.create(
-                    sale=sale,
-                    product=item_data['product'],
-                    quantity=item_data['quantity'],
-                    unit_price=item_data['unit_price'],
-                    unit_cost=item_data['unit_cost'],
-                )
+        # Stock check, stock decrement and sale lines run as one set-based checkout
+        sale, sale_items = checkout(
+            request.user,
+            items,
+            customer_name=customer_name,
+            customer_phone=customer_phone,
+            payment_method=payment_method,
+            discount=discount,
+        )
         
         # Prepare response data for receipt
         response_data = {
@@ -220,12 +221,12 @@ def process_sale(request):
                 'served_by': sale.served_by.get_full_name() or sale.served_by.username,
                 'items': [
                     {
-                        'name': item_data['product'].name,
-                        'quantity': item_data['quantity'],
-                        'unit_price': str(item_data['unit_price']),
-                        'total_price': str(item_data['total_price'])
+                        'name': item.product.name,
+                        'quantity': item.quantity,
+                        'unit_price': str(item.unit_price),
+                        'total_price': str(item.total_price)
                     }
-                    for item_data in sale_items_data
+                    for item in sale_items
                 ]
             }
         }
@@ -248,65 +249,92 @@ def process_sale(request):
             'message': f'Error processing sale: {str(e)}'
         })
 
-@login_required
-def sales_history(request):
-    """Enhanced sales history with filtering"""
-    
-    # Get filter parameters
-    search = request.GET.get('search', '')
-    payment_method = request.GET.get('payment_method', '')
-    status = request.GET.get('status', '')
-    date_from = request.GET.get('date_from', '')
-    date_to = request.GET.get('date_to', '')
+def _filtered_sales(request):
+    """Apply the sales history filters from the query string"""
+    filters = {
+        'search': request.GET.get('search', ''),
+        'payment_method': request.GET.get('payment_method', ''),
+        'status': request.GET.get('status', ''),
+        'date_from': request.GET.get('date_from', ''),
+        'date_to': request.GET.get('date_to', ''),
+    }
     
-    # Build query
-    sales_query = Sale.objects.select_related('served_by').prefetch_related('items__product')
+    sales_query = Sale.objects.all()
     
-    # Apply filters
-    if search:
+    if filters['search']:
         sales_query = sales_query.filter(
-            Q(customer_name__icontains=search) |
-            Q(customer_phone__icontains=search) |
-            Q(id__icontains=search)
+            Q(customer_name__icontains=filters['search']) |
+            Q(customer_phone__icontains=filters['search']) |
+            Q(id__icontains=filters['search'])
         )
     
-    if payment_method:
-        sales_query = sales_query.filter(payment_method=payment_method)
+    if filters['payment_method']:
+        sales_query = sales_query.filter(payment_method=filters['payment_method'])
     
-    if status:
-        sales_query = sales_query.filter(status=status)
+    if filters['status']:
+        sales_query = sales_query.filter(status=filters['status'])
     
+    # Compare sale_date against local day bounds rather than casting it, so its index is usable
+    date_from = parse_date(filters['date_from']) if filters['date_from'] else None
     if date_from:
-        sales_query = sales_query.filter(sale_date__date__gte=date_from)
+        sales_query = sales_query.filter(sale_date__gte=day_window(date_from)[0])
     
+    date_to = parse_date(filters['date_to']) if filters['date_to'] else None
     if date_to:
-        sales_query = sales_query.filter(sale_date__date__lte=date_to)
+        sales_query = sales_query.filter(sale_date__lt=day_window(date_to)[1])
     
-    sales = sales_query.order_by('-sale_date')
+    return sales_query, filters
+
+def _history_page(sales_query, cursor):
+    """One keyset page of sales with item counts; items themselves load on expand"""
+    page_query = sales_query.select_related('served_by').annotate(item_count=Count('items'))
+    return keyset_page(page_query, cursor, HISTORY_PAGE_SIZE)
+
+@login_required
+def sales_history(request):
+    """Enhanced sales history with filtering"""
+    sales_query, filters = _filtered_sales(request)
+    sales, next_cursor = _history_page(sales_query, None)
     
-    # Calculate totals for filtered results
-    totals = sales.aggregate(
+    # Totals only touch the sale columns, which the covering index on sale_date serves
+    totals = sales_query.aggregate(
         total_amount=Sum('final_amount'),
         total_discount=Sum('discount'),
-        count=Sum('id')
+        count=Count('id')
     )
     
     context = {
         'sales': sales,
+        'next_cursor': next_cursor,
         'totals': totals,
         'payment_methods': Sale.PAYMENT_METHODS,
         'status_choices': Sale.STATUS_CHOICES,
-        'filters': {
-            'search': search,
-            'payment_method': payment_method,
-            'status': status,
-            'date_from': date_from,
-            'date_to': date_to,
-        }
+        'filters': filters,
     }
     
     return render(request, 'sales/sales_history.html', context)
 
+@login_required
+def sales_history_api(request):
+    """Next page of sales history for infinite scroll"""
+    sales_query, filters = _filtered_sales(request)
+    try:
+        sales, next_cursor = _history_page(sales_query, request.GET.get('cursor'))
+    except InvalidCursor as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+    
+    data = [{
+        'id': sale.id,
+        'date': timezone.localtime(sale.sale_date).strftime('%b %d, %Y %H:%M'),
+        'customer_name': sale.customer_name or 'Walk-in Customer',
+        'item_count': sale.item_count,
+        'final_amount': str(sale.final_amount),
+        'payment_method': sale.get_payment_method_display(),
+        'served_by': f"{sale.served_by.first_name} {sale.served_by.last_name}",
+    } for sale in sales]
+    
+    return JsonResponse({'sales': data, 'next_cursor': next_cursor})
+
 @login_required
 def sale_detail(request, sale_id):
     """View individual sale details"""
@@ -333,24 +361,29 @@ def refund_sale(request, sale_id):
             'message': 'You do not have permission to process refunds'
         })
     
-    sale = get_object_or_404(Sale, id=sale_id)
-    
-    if sale.status != 'paid':
-        return JsonResponse({
-            'success': False,
-            'message': 'Only paid sales can be refunded'
-        })
+    get_object_or_404(Sale, id=sale_id)
     
     try:
         with transaction.atomic():
-            # Restore stock for all items
-            for item in sale.items.all():
-                item.product.quantity_in_stock += item.quantity
-                item.product.save()
+            # Lock the sale so two refund requests can't both restore stock
+            sale = Sale.objects.select_for_update().get(id=sale_id)
+            if sale.status != 'paid':
+                return JsonResponse({
+                    'success': False,
+                    'message': 'Only paid sales can be refunded'
+                })
+            
+            # Restore stock for all items in one atomic update
+            items = list(sale.items.select_related('product'))
+            restock = {}
+            for item in items:
+                restock[item.product_id] = restock.get(item.product_id, 0) + item.quantity
+            apply_stock_changes(restock, 'refund', f'Sale #{sale.id}')
             
             # Update sale status
             sale.status = 'refunded'
             sale.save()
+            sale_refunded.send(sender=Sale, sale=sale, items=items)
         
         return JsonResponse({
             'success': True,
@@ -363,7 +396,14 @@ def refund_sale(request, sale_id):
             'message': f'Error processing refund: {str(e)}'
         })
 
+def _receipt_validator(request, sale_id):
+    # Receipts only change when a sale is refunded or edited in the admin
+    return Sale.objects.filter(id=sale_id).values_list(
+        'status', 'payment_method', 'customer_name', 'customer_phone', 'discount', 'final_amount'
+    ).first()
+
 @login_required
+@conditional(_receipt_validator)
 def get_sale_receipt_data(request, sale_id):
     """Get sale data for receipt printing"""
     sale = get_object_or_404(
@@ -398,23 +438,32 @@ def get_sale_receipt_data(request, sale_id):
     
     return JsonResponse(receipt_data)
 
+def _categories_validator(request):
+    return tuple(Category.objects.aggregate(latest=Max('updated_at'), count=Count('id')).values())
+
 @login_required
+@conditional(_categories_validator)
 def categories_api(request):
     """API endpoint to get categories for filtering"""
     categories = Category.objects.all().values('id', 'name')
     return JsonResponse({'categories': list(categories)})
 
-@login_required 
+def _daily_summary_validator(request):
+    # New sales show up in the hourly figures, refunds and edits in the rollup
+    return timezone.localdate(), Sale.objects.aggregate(latest=Max('id'))['latest'], rollup_version()
+
+@login_required
+@conditional(_daily_summary_validator)
 def daily_sales_summary(request):
     """Get daily sales summary for dashboard"""
-    today = timezone.now().date()
+    today = timezone.localdate()
     
     # Today's sales by hour
     from django.db.models import Count
     from django.db.models.functions import TruncHour
     
     hourly_sales = Sale.objects.filter(
-        sale_date__date=today
+        within('sale_date', day_window(today))
     ).annotate(
         hour=TruncHour('sale_date')
     ).values('hour').annotate(
@@ -423,21 +472,21 @@ def daily_sales_summary(request):
     ).order_by('hour')
     
     # Payment method breakdown for today
-    payment_breakdown = Sale.objects.filter(
-        sale_date__date=today
+    payment_breakdown = DailySalesTotal.objects.filter(
+        day=today
     ).values('payment_method').annotate(
-        count=Count('id'),
+        count=Sum('sale_count'),
         total=Sum('final_amount')
     )
     
     # Top selling products today
-    top_products_today = SaleItem.objects.filter(
-        sale__sale_date__date=today
+    top_products_today = DailySalesRollup.objects.filter(
+        day=today
     ).values(
         'product__name'
     ).annotate(
         quantity_sold=Sum('quantity'),
-        revenue=Sum('total_price')
+        revenue=Sum('revenue')
     ).order_by('-quantity_sold')[:5]
     
     data = {
@@ -454,79 +503,11 @@ def daily_sales_summary(request):
 # Add these 3 new views to your views.py
 
 # Add these imports at the top of your views.py
-import requests
-import base64
-from datetime import datetime
 import json
 from decimal import Decimal
 from django.db import transaction
 from django.http import HttpResponse
 
-def check_payment_status(request, sale_id):
-    # Implement your logic here
-    return HttpResponse(f"Checking payment status for sale ID: {sale_id}")
-
-# Add MpesaService class
-class MpesaService:
-    def get_access_token(self):
-        url = f"{settings.MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials"
-        credentials = f"{settings.MPESA_CONSUMER_KEY}:{settings.MPESA_CONSUMER_SECRET}"
-        encoded_credentials = base64.b64encode(credentials.encode()).decode()
-        
-        headers = {'Authorization': f'Basic {encoded_credentials}'}
-        
-        try:
-            response = requests.get(url, headers=headers, timeout=30)
-            if response.status_code == 200:
-                return response.json().get('access_token')
-            return None
-        except:
-            return None
-    
-    def initiate_stk_push(self, phone, amount, account_reference):
-        token = self.get_access_token()
-        if not token:
-            return {'success': False, 'message': 'Failed to get token'}
-        
-        # Format phone
-        if phone.startswith('0'):
-            phone = '254' + phone[1:]
-        elif phone.startswith('7'):
-            phone = '254' + phone
-        
-        # Generate password
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        password_string = f"{settings.MPESA_BUSINESS_SHORT_CODE}{settings.MPESA_PASSKEY}{timestamp}"
-        password = base64.b64encode(password_string.encode()).decode()
-        
-        url = f"{settings.MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest"
-        headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
-        
-        payload = {
-            "BusinessShortCode": settings.MPESA_BUSINESS_SHORT_CODE,
-            "Password": password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerPayBillOnline",
-            "Amount": int(amount),
-            "PartyA": phone,
-            "PartyB": settings.MPESA_BUSINESS_SHORT_CODE,
-            "PhoneNumber": phone,
-            "CallBackURL": "https://httpbin.org/post",  # Temporary
-            "AccountReference": account_reference,
-            "TransactionDesc": "POS Payment"
-        }
-        
-        try:
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            data = response.json()
-            
-            if response.status_code == 200 and data.get('ResponseCode') == '0':
-                return {'success': True, 'checkout_request_id': data.get('CheckoutRequestID')}
-            else:
-                return {'success': False, 'message': data.get('errorMessage', 'STK push failed')}
-        except Exception as e:
-            return {'success': False, 'message': f'Error: {str(e)}'}
-
 # Add M-Pesa views
 @login_required
 @require_http_methods(["POST"])
@@ -534,20 +515,51 @@ def initiate_mpesa_payment(request):
     try:
         data = json.loads(request.body)
         phone_number = data.get('phone_number')
-        amount = Decimal(str(data.get('amount')))
+        sale_data = data.get('sale_data') or {}
         
-        if not phone_number or amount <= 0:
+        if not phone_number:
             return JsonResponse({'success': False, 'message': 'Invalid phone or amount'})
         
-        mpesa_service = MpesaService()
-        result = mpesa_service.initiate_stk_push(phone_number, amount, f"TEST{int(amount)}")
+        # The sale holds its stock while the customer confirms on their phone;
+        # the callback worker marks it paid or cancels it and restocks
+        sale, _ = checkout(
+            request.user,
+            sale_data.get('items', []),
+            customer_name=sale_data.get('customer_name', 'Walk-in Customer'),
+            customer_phone=phone_number,
+            payment_method='mpesa',
+            discount=Decimal(str(sale_data.get('discount', 0))),
+            status='pending',
+        )
+        if getattr(settings, 'BACKGROUND_JOBS', False):
+            send_stk_push.enqueue(sale_id=sale.id, phone_number=phone_number)
+            result = {'success': True, 'queued': True}
+        else:
+            result = request_payment(sale.id, phone_number)
+        if result['success']:
+            result['sale_id'] = sale.id
         
         return JsonResponse(result)
         
+    except CheckoutError as e:
+        return JsonResponse({'success': False, 'message': str(e)})
     except Exception as e:
         return JsonResponse({'success': False, 'message': str(e)})
 
 @csrf_exempt
 @require_http_methods(["POST"])
 def mpesa_callback(request):
-    return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Success'})
\ No newline at end of file
+    # Only append to the inbox here; process_mpesa_callbacks settles it
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Invalid JSON'}, status=400)
+    record_callback(payload)
+    return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Success'})
+
+@login_required
+def check_payment_status(request, sale_id):
+    status = payment_status(sale_id)
+    if status is None:
+        return JsonResponse({'status': 'unknown'}, status=404)
+    return JsonResponse(status)